@@ -61,5 +61,9 @@ def _prep_bins():
 _prep_bins()  # prepare before module imports
 
 from .patch import do_patch
-from .sslconnection import SSLContext, SSL, SSLConnection
-from .demux import force_routing_demux, reset_default_demux
+from .sslconnection import SSLContext, SSL, SSLConnection, ClientSessionCache
+from .demux import force_routing_demux, force_memory_demux, reset_default_demux
+from .demux.mmsg import BufferPool
+from .pybio import QueueBIO
+from .sansio import SSLEngine
+from .tickets import TicketKeyRing
@@ -0,0 +1,512 @@
+# asyncio integration: DTLS client and server endpoints on an event loop.
+
+# Copyright 2017 Ray Brown
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# The License is also distributed with this work in the file named "LICENSE."
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asyncio DTLS endpoints
+
+This module runs DTLS on asyncio event loops, without threads and without
+blocking calls. A single datagram endpoint, created with the loop's
+create_datagram_endpoint, carries the traffic of all of a server's peers:
+each datagram is fed to the sans-I/O engine of its peer (see the sansio
+module), and the datagrams that the engine produces are sent through the
+endpoint's transport. Retransmission timers are scheduled with the loop's
+call_at, and only while a handshake is in progress, so that an event loop
+can serve very many peers.
+
+A server keeps no state for a new address until the address has completed
+a cookie exchange, answering ClientHellos without a valid cookie with a
+HelloVerifyRequest. The number of peers is limited, and peers whose
+handshakes stall or fail are dropped.
+
+Applications supply protocols with the interface of asyncio.Protocol, one
+instance per peer. A protocol's connection_made method is called once the
+handshake with its peer has completed; data_received is called with the
+payload of each record received; connection_lost is called when the peer
+shuts the connection down, when the connection fails, or after the
+transport has been closed. When the endpoint's socket buffer fills up, every
+peer's protocol is paused with pause_writing, and resumed with
+resume_writing once it has drained.
+
+Classes:
+
+  DTLSTransport -- transport of a connection with an individual peer
+  DTLSServer -- server that accepts connections from many peers
+
+Functions:
+
+  create_dtls_server -- start serving DTLS on a local address
+  create_dtls_endpoint -- connect to a DTLS server
+"""
+
+import asyncio
+from collections import deque
+from logging import getLogger
+from .err import openssl_error
+from .sansio import SSLEngine
+from .sslconnection import WANT_READ, WANT_WRITE, ZERO_RETURN
+from .sslconnection import CERT_NONE, PROTOCOL_DTLS
+from .sslconnection import _MAX_RECORD_PLAINTEXT
+
+MAX_PEERS = 4096
+HANDSHAKE_TIMEOUT = 30  # seconds
+
+_logger = getLogger(__name__)
+
+
+class DTLSTransport(asyncio.Transport):
+    """Transport of a connection with an individual peer
+
+    Each write sends one record. The write buffer is the one of the endpoint,
+    which all of a server's connections share; records that cannot be
+    written until the peer's datagrams have been read, for example during a
+    renegotiation, are held back by the transport, and written in order once
+    they can be.
+    """
+
+    def __init__(self, loop, endpoint, engine, protocol_factory,
+                 handshake_waiter=None):
+        super(DTLSTransport, self).__init__()
+        self._loop = loop
+        self._endpoint = endpoint
+        self._engine = engine
+        self._protocol_factory = protocol_factory
+        self._protocol = None
+        self._handshake_waiter = handshake_waiter
+        self._timer = None
+        self._deadline = None
+        self._write_backlog = deque()
+        self._closing = False
+        self._paused = False
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return self._engine.peer_address
+        if name == "cipher":
+            return self._engine.cipher()
+        if name == "peercert":
+            return self._engine.getpeercert()
+        if name == "ssl_engine":
+            return self._engine
+        transport = self._endpoint.transport
+        if transport:
+            return transport.get_extra_info(name, default)
+        return default
+
+    def get_protocol(self):
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def is_closing(self):
+        return self._closing
+
+    def write(self, data):
+        """Send data to the peer in a record of its own"""
+
+        if self._closing or not self._protocol:
+            _logger.debug("Dropping write to closed or unconnected peer %s",
+                          self._engine.peer_address)
+            return
+        if self._write_backlog:
+            self._write_backlog.append(bytes(data))
+            return
+        try:
+            status = self._engine.write(data)
+        except openssl_error() as err:
+            self._fatal(err)
+            return
+        if status is WANT_READ or status is WANT_WRITE:
+            self._write_backlog.append(bytes(data))
+        elif status is ZERO_RETURN:
+            _logger.debug("Dropping write to peer %s, which has shut down",
+                          self._engine.peer_address)
+        self._flush()
+
+    def can_write_eof(self):
+        return False
+
+    def get_write_buffer_size(self):
+        transport = self._endpoint.transport
+        size = sum(len(data) for data in self._write_backlog)
+        return size + (transport.get_write_buffer_size() if transport else 0)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        transport = self._endpoint.transport
+        if transport:
+            transport.set_write_buffer_limits(high, low)
+
+    def close(self):
+        """Shut the connection down
+
+        A close-notify alert is sent to the peer, and the protocol's
+        connection_lost method is called with None.
+        """
+
+        if self._closing:
+            return
+        if self._protocol:
+            try:
+                self._engine.shutdown()
+            except openssl_error() as err:
+                _logger.debug("Shutdown with peer %s failed: %s",
+                              self._engine.peer_address, err)
+            self._flush()
+        self._connection_lost(None)
+
+    def abort(self):
+        """Drop the connection without notifying the peer"""
+
+        if not self._closing:
+            self._connection_lost(None)
+
+    def _datagram_received(self, data, address):
+        self._engine.receive_datagram(data, address)
+        self._process()
+
+    def _process(self):
+        try:
+            if not self._protocol:
+                if self._engine.do_handshake() is not None:
+                    return self._after_io()
+                self._connection_made()
+            while not self._closing:
+                data = self._engine.read(_MAX_RECORD_PLAINTEXT)
+                if data is WANT_READ:
+                    break
+                if data is ZERO_RETURN:
+                    # The peer has shut the connection down
+                    self.close()
+                    return
+                self._protocol.data_received(data)
+            self._write_held_back()
+        except openssl_error() as err:
+            self._fatal(err)
+            return
+        self._after_io()
+
+    def _write_held_back(self):
+        while self._write_backlog and not self._closing:
+            status = self._engine.write(self._write_backlog[0])
+            if status is WANT_READ or status is WANT_WRITE:
+                break
+            self._write_backlog.popleft()
+
+    def _after_io(self):
+        self._flush()
+        self._schedule_timer()
+
+    def _connection_made(self):
+        self._cancel_deadline()
+        self._protocol = self._protocol_factory()
+        self._protocol.connection_made(self)
+        if self._paused:
+            self._protocol.pause_writing()
+        if self._handshake_waiter and not self._handshake_waiter.done():
+            self._handshake_waiter.set_result(None)
+
+    def _flush(self):
+        for payload, address in self._engine.datagrams_to_send():
+            self._endpoint.sendto(payload, address)
+
+    def _schedule_timer(self):
+        # DTLS retransmits only while handshaking; established connections
+        # need no timer
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        timeout = self._engine.get_timeout()
+        if timeout is not None and not self._closing:
+            self._timer = self._loop.call_at(
+                self._loop.time() + timeout.total_seconds(), self._on_timer)
+
+    def _set_deadline(self, timeout):
+        self._deadline = self._loop.call_later(timeout, self._on_deadline)
+
+    def _cancel_deadline(self):
+        if self._deadline:
+            self._deadline.cancel()
+            self._deadline = None
+
+    def _on_deadline(self):
+        # The handshake has stalled: the peer has stopped responding, or
+        # keeps the connection half-open on purpose
+        self._deadline = None
+        self._fatal(asyncio.TimeoutError("DTLS handshake timed out"))
+
+    def _on_timer(self):
+        self._timer = None
+        try:
+            self._engine.handle_timeout()
+        except openssl_error() as err:
+            self._fatal(err)
+            return
+        self._after_io()
+
+    def _pause_writing(self):
+        self._paused = True
+        if self._protocol:
+            self._protocol.pause_writing()
+
+    def _resume_writing(self):
+        self._paused = False
+        if self._protocol:
+            self._protocol.resume_writing()
+
+    def _fatal(self, exc):
+        _logger.debug("Connection with peer %s failed: %s",
+                      self._engine.peer_address, exc)
+        if self._handshake_waiter and not self._handshake_waiter.done():
+            self._handshake_waiter.set_exception(exc)
+        # Send the alert, if any, that tells the peer of the failure
+        self._flush()
+        self._connection_lost(exc)
+
+    def _connection_lost(self, exc):
+        self._closing = True
+        if self._write_backlog:
+            _logger.debug("Dropping %d held back writes to peer %s",
+                          len(self._write_backlog), self._engine.peer_address)
+            self._write_backlog.clear()
+        self._cancel_deadline()
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._endpoint.remove(self)
+        if self._protocol:
+            self._loop.call_soon(self._protocol.connection_lost, exc)
+
+
+class _DTLSEndpoint(asyncio.DatagramProtocol):
+    """Datagram protocol that hands datagrams to peers' transports
+
+    A server's endpoint sets up a transport for an address only once the
+    address's cookie exchange has completed, and only while fewer than the
+    maximum number of peers are connected or handshaking. Transports whose
+    handshakes do not complete before the handshake timeout are dropped.
+    """
+
+    def __init__(self, loop, engine, protocol_factory, connected,
+                 max_peers=None, handshake_timeout=None):
+        self._loop = loop
+        self._engine = engine
+        self._protocol_factory = protocol_factory
+        self._connected = connected
+        self._max_peers = max_peers
+        self._handshake_timeout = handshake_timeout
+        self._peers = {}
+        self._paused = False
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        peer = self._peers.get(address)
+        if not peer:
+            if self._connected:
+                _logger.debug("Dropping datagram from non-peer %s", address)
+                return
+            if self._max_peers and len(self._peers) >= self._max_peers:
+                _logger.debug("Dropping datagram from %s: %d peers",
+                              address, len(self._peers))
+                return
+            engine = self._engine.listen(data, address)
+            for payload, _ in self._engine.datagrams_to_send():
+                self.sendto(payload, address)
+            if engine:
+                self.add(engine)._process()
+            return
+        peer._datagram_received(data, address)
+
+    def error_received(self, exc):
+        # Connected endpoints learn of an unreachable peer this way
+        _logger.debug("Endpoint error: %s", exc)
+        if self._connected:
+            for peer in list(self._peers.values()):
+                peer._fatal(exc)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        for peer in list(self._peers.values()):
+            peer._connection_lost(exc)
+
+    def pause_writing(self):
+        self._paused = True
+        for peer in list(self._peers.values()):
+            peer._pause_writing()
+
+    def resume_writing(self):
+        self._paused = False
+        for peer in list(self._peers.values()):
+            peer._resume_writing()
+
+    def add(self, engine, handshake_waiter=None):
+        peer = DTLSTransport(self._loop, self, engine, self._protocol_factory,
+                             handshake_waiter)
+        peer._paused = self._paused
+        if self._handshake_timeout:
+            peer._set_deadline(self._handshake_timeout)
+        self._peers[engine.peer_address] = peer
+        return peer
+
+    def remove(self, peer):
+        address = peer._engine.peer_address
+        if self._peers.get(address) is peer:
+            del self._peers[address]
+        if self._connected and self.transport:
+            self.transport.close()
+
+    def sendto(self, payload, address):
+        if not self.transport or self.transport.is_closing():
+            return
+        if self._connected:
+            self.transport.sendto(payload)
+        else:
+            self.transport.sendto(payload, address)
+
+
+class DTLSServer(object):
+    """Server that accepts connections from many peers
+
+    A connection is set up for every peer that completes the cookie
+    exchange; the protocol factory is called once the handshake with the
+    peer has completed.
+
+    Methods:
+
+      close -- close the endpoint and all connections
+      get_transports -- retrieve the transports of the current connections
+    """
+
+    def __init__(self, endpoint):
+        self._endpoint = endpoint
+
+    @property
+    def sockname(self):
+        transport = self._endpoint.transport
+        return transport.get_extra_info("sockname") if transport else None
+
+    def get_transports(self):
+        """Retrieve the transports of the current connections
+
+        Return:
+        list of DTLSTransport instances, including the ones of connections
+        whose handshakes are in progress
+        """
+
+        return list(self._endpoint._peers.values())
+
+    def close(self):
+        """Close the endpoint and all connections"""
+
+        for peer in self.get_transports():
+            peer.close()
+        if self._endpoint.transport:
+            self._endpoint.transport.close()
+
+
+async def create_dtls_server(protocol_factory, local_addr, keyfile, certfile,
+                             cert_reqs=CERT_NONE, ssl_version=PROTOCOL_DTLS,
+                             ca_certs=None, ciphers=None, mtu=None,
+                             cb_user_config_ssl_ctx=None,
+                             cb_user_config_ssl=None, loop=None,
+                             max_peers=MAX_PEERS,
+                             handshake_timeout=HANDSHAKE_TIMEOUT, **kwargs):
+    """Start serving DTLS on a local address
+
+    Arguments:
+    protocol_factory -- callable returning a protocol for a new peer
+    local_addr -- address tuple to bind the server's socket to
+    loop -- the event loop; defaults to the current event loop
+    max_peers -- maximum number of connections, including the ones whose
+                 handshakes are in progress; datagrams from further peers
+                 are dropped; None for no limit
+    handshake_timeout -- seconds after the cookie exchange after which to
+                         drop connections whose handshakes have not
+                         completed; None for no limit
+    kwargs -- additional keyword arguments for create_datagram_endpoint,
+              for example reuse_port
+    the remaining arguments match the ones of the SSLEngine class
+
+    Return:
+    DTLSServer instance
+    """
+
+    loop = loop or asyncio.get_event_loop()
+    engine_args = {}
+    if mtu:
+        engine_args["mtu"] = mtu
+    engine = SSLEngine(True, keyfile, certfile, cert_reqs, ssl_version,
+                       ca_certs, ciphers,
+                       cb_user_config_ssl_ctx=cb_user_config_ssl_ctx,
+                       cb_user_config_ssl=cb_user_config_ssl, **engine_args)
+    endpoint = _DTLSEndpoint(loop, engine, protocol_factory, False,
+                             max_peers, handshake_timeout)
+    await loop.create_datagram_endpoint(lambda: endpoint,
+                                        local_addr=local_addr, **kwargs)
+    return DTLSServer(endpoint)
+
+
+async def create_dtls_endpoint(protocol_factory, remote_addr, keyfile=None,
+                               certfile=None, cert_reqs=CERT_NONE,
+                               ssl_version=PROTOCOL_DTLS, ca_certs=None,
+                               ciphers=None, mtu=None,
+                               cb_user_config_ssl_ctx=None,
+                               cb_user_config_ssl=None, loop=None,
+                               handshake_timeout=None, **kwargs):
+    """Connect to a DTLS server
+
+    This coroutine completes once the handshake has completed.
+
+    Arguments:
+    protocol_factory -- callable returning the connection's protocol
+    remote_addr -- address tuple of the server
+    loop -- the event loop; defaults to the current event loop
+    handshake_timeout -- seconds after which to give up on the handshake,
+                         raising asyncio.TimeoutError; by default, the
+                         handshake fails only once DTLS retransmissions are
+                         exhausted
+    kwargs -- additional keyword arguments for create_datagram_endpoint,
+              for example local_addr
+    the remaining arguments match the ones of the SSLEngine class
+
+    Return:
+    tuple of the DTLSTransport and the protocol instance
+    """
+
+    loop = loop or asyncio.get_event_loop()
+    engine_args = {}
+    if mtu:
+        engine_args["mtu"] = mtu
+    engine = SSLEngine(False, keyfile, certfile, cert_reqs, ssl_version,
+                       ca_certs, ciphers,
+                       cb_user_config_ssl_ctx=cb_user_config_ssl_ctx,
+                       cb_user_config_ssl=cb_user_config_ssl, **engine_args)
+    endpoint = _DTLSEndpoint(loop, engine, protocol_factory, True)
+    transport = (await loop.create_datagram_endpoint(
+        lambda: endpoint, remote_addr=remote_addr, **kwargs))[0]
+    engine.peer_address = transport.get_extra_info("peername")
+    waiter = loop.create_future()
+    peer = endpoint.add(engine, waiter)
+    peer._process()
+    try:
+        await asyncio.wait_for(waiter, handshake_timeout)
+    except BaseException:
+        peer.abort()
+        raise
+    return peer, peer.get_protocol()
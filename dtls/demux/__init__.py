@@ -29,7 +29,9 @@ Connections must be used for receiving datagrams only. Outgoing traffic should
 be sent through the root socket.
 
 Varying implementations of this functionality are provided for different
-platforms.
+platforms. Alternatively, the memory BIO demux can be selected on any
+platform: its connections are not sockets, but pairs of OpenSSL memory BIO's
+that SSLConnection reads from and writes to directly.
 """
 
 import sys
@@ -42,22 +44,33 @@ else:
     _routing = False
 _default_demux = None
 
+def _select_demux(demux):
+    global UDPDemux, _default_demux
+    if UDPDemux is demux:
+        return False  # no change - already selected
+    if not _default_demux:
+        _default_demux = UDPDemux
+    UDPDemux = demux
+    return True
+
 def force_routing_demux():
     global _routing
-    if _routing:
-        return False  # no change - already loaded
-    global UDPDemux, _default_demux
     from . import router
-    _default_demux = UDPDemux
-    UDPDemux = router.UDPDemux
     _routing = True
-    return True  # new router loaded and switched
+    return _select_demux(router.UDPDemux)  # new router loaded and switched
+
+def force_memory_demux():
+    global _routing
+    from . import membio
+    _routing = False
+    return _select_demux(membio.UDPDemux)
 
 def reset_default_demux():
     global UDPDemux, _routing, _default_demux
     if _default_demux:
         UDPDemux = _default_demux
         _default_demux = None
-        _routing = not _routing
+        _routing = UDPDemux.__module__.endswith(".router")
 
-__all__ = ["UDPDemux", "force_routing_demux", "reset_default_demux"]
+__all__ = ["UDPDemux", "force_routing_demux", "force_memory_demux",
+           "reset_default_demux"]
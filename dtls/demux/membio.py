@@ -0,0 +1,430 @@
+# Memory BIO demux: feeds datagrams from the root socket directly into the
+# OpenSSL memory BIO's of connections.
+
+# Copyright 2017 Ray Brown
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# The License is also distributed with this work in the file named "LICENSE."
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memory BIO UDP Demux
+
+This module implements an in-process UDP demux. Unlike the other demux
+implementations, it does not create a socket per connection. Instead, each
+connection is a channel consisting of a pair of OpenSSL memory BIO's: one
+from which OpenSSL reads incoming records, and one into which it writes
+outgoing records. The demux receives datagrams from the root socket and
+writes their payloads into the read BIO of the channel that is associated
+with the sending peer. Outgoing records are drained from the write BIO's,
+packed into datagrams, and sent to the peer through the root socket.
+
+Since no datagram passes through the kernel more than once, and no file
+descriptors are consumed per peer, this demux suits servers with many
+concurrent peers. It can be used on any platform, but it must be selected
+explicitly with dtls.demux.force_memory_demux.
+
+Because all connections share the root socket, datagrams are received by
+whichever connection (or the listening connection) happens to be waiting
+for data, and handed to the channel for their peer. Datagrams from unknown
+peers are queued for the listening connection, except that non-blocking
+connections leave them at the root socket, so that the listening connection
+becomes readable in select loops. Channel contents are protected
+by a single lock per demux instance, which SSLConnection acquires around all
+OpenSSL calls on channels' BIO's.
+
+Classes:
+
+  UDPDemux -- a memory BIO UDP demux
+
+Exceptions:
+
+  InvalidSocketError -- exception raised for improper socket objects
+"""
+
+import sys
+import errno
+import socket
+from collections import deque
+from logging import getLogger
+from select import select
+from threading import RLock
+from time import monotonic
+from weakref import WeakValueDictionary
+from ..err import InvalidSocketError
+from ..openssl import BIO_new, BIO_s_mem, BIO_up_ref, BIO_read, BIO_write
+from ..openssl import BIO_reset, BIO_ctrl_pending, BIO_set_mem_eof_return
+from ..util import _BIO, _pack_records
+from .mmsg import BatchReceiver
+
+_logger = getLogger(__name__)
+
+UDP_MAX_DGRAM_LENGTH = 65527
+UDP_BATCH_SIZE = 64
+UDP_DEFAULT_MTU = 1400  # payload size safe for IPv4 and IPv6 paths
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+# Windows fails datagram reads into buffers that are too short, even peeks
+_PEEK_LENGTH = UDP_MAX_DGRAM_LENGTH if sys.platform.startswith('win') else 1
+_WAIT_INTERVAL = 0.05  # for waiting connections' polling of their channels
+
+
+class _Channel(object):
+    """Memory BIO pair associated with a peer
+
+    Instances are held by the connections using them; the demux keeps weak
+    references only.
+    """
+
+    def __init__(self, demux, peer_address):
+        self._demux = demux
+        self.peer_address = peer_address
+        self.rbio = _BIO(BIO_new(BIO_s_mem()))
+        self.wbio = _BIO(BIO_new(BIO_s_mem()))
+        # Reading from an empty BIO must be retryable, not end of file
+        BIO_set_mem_eof_return(self.rbio.value, -1)
+
+    def ssl_bios(self):
+        """Create references to this channel's BIO's for SSL_set_bio
+
+        Return:
+        a pair of owned read and write BIO wrappers
+        """
+
+        BIO_up_ref(self.rbio.value)
+        BIO_up_ref(self.wbio.value)
+        return _BIO(self.rbio.value), _BIO(self.wbio.value)
+
+    def feed(self, payload):
+        BIO_write(self.rbio.value, payload)
+
+    def reset(self):
+        BIO_reset(self.rbio.value)
+
+    def flush(self):
+        """Send the records written by OpenSSL to the peer
+
+        Return:
+        the number of datagrams sent
+        """
+
+        pending = BIO_ctrl_pending(self.wbio.value)
+        if not pending:
+            return 0
+        data = BIO_read(self.wbio.value, pending)
+        if not self.peer_address:
+            _logger.debug("Discarding %d bytes for unknown peer", len(data))
+            return 0
+        sent = 0
+        for datagram in _pack_records(data, self._demux.mtu):
+            try:
+                self._demux._io_socket.sendto(datagram, _MSG_DONTWAIT,
+                                              self.peer_address)
+            except socket.error as sock_err:
+                # DTLS recovers lost datagrams through retransmission
+                _logger.debug("Dropping datagram for peer %s: %s",
+                              self.peer_address, sock_err)
+            else:
+                sent += 1
+        return sent
+
+
+class UDPDemux(object):
+    """Memory BIO UDP demux
+
+    This class implements a demux that writes datagrams received from the
+    root socket into the memory BIO's of connections' channels, and that
+    sends the records connections write through the root socket.
+
+    Methods:
+
+      get_connection -- create or retrieve a connection's channel
+      adopt_connection -- bind the channel for unknown peers to a peer
+      remove_connection -- remove an existing connection
+      get_peer -- retrieve the peer address associated with a read BIO
+      service -- distribute datagrams from the root socket to connections
+      receive -- distribute datagrams on behalf of a waiting connection
+      forward -- forward a stored datagram to a connection
+      new_peer_pending -- check for queued datagrams from new peers
+    """
+
+    def __del__(self):
+        if hasattr(self, "_io_socket"):
+            self._io_socket.close()
+
+    def __init__(self, datagram_socket, mtu=UDP_DEFAULT_MTU, batch_size=1):
+        """Constructor
+
+        Arguments:
+        datagram_socket -- the root socket; this must be a bound, unconnected
+                           datagram socket
+        mtu -- the maximum payload length of outgoing datagrams
+        batch_size -- the maximum number of datagrams received from the root
+                      socket per service call
+        """
+
+        if (datagram_socket.type & socket.SOCK_DGRAM) != socket.SOCK_DGRAM:
+            raise InvalidSocketError("datagram_socket is not of " +
+                                     "type SOCK_DGRAM")
+        try:
+            datagram_socket.getsockname()
+        except:
+            raise InvalidSocketError("datagram_socket is unbound")
+        try:
+            datagram_socket.getpeername()
+        except:
+            pass
+        else:
+            raise InvalidSocketError("datagram_socket is connected")
+
+        self.datagram_socket = datagram_socket
+        # Connections outlive the listening socket's descriptor. Also, reads
+        # and writes are performed under the lock, and must never block or
+        # wait: the root socket's timeout and blocking mode, which are shared
+        # with the sockets of connections, are therefore bypassed
+        self._io_socket = socket.fromfd(datagram_socket.fileno(),
+                                        datagram_socket.family,
+                                        datagram_socket.type,
+                                        datagram_socket.proto)
+        self.mtu = mtu
+        self.batch_size = batch_size
+        self.payload = b""
+        self.payload_peer_address = None
+        self.connections = WeakValueDictionary()
+        self.lock = RLock()
+        self._channels_by_rbio = WeakValueDictionary()
+        self._new_peer_datagrams = deque()
+        self._receiver = None
+
+    def get_connection(self, address):
+        """Create or retrieve a channel
+
+        Arguments:
+        address -- a peer endpoint in IPv4/v6 address format; None refers
+                   to the channel for unknown peers
+
+        Return:
+        a channel, whose read and write BIO's are to be passed to SSL_set_bio
+        """
+
+        if address in self.connections:
+            return self.connections[address]
+        channel = _Channel(self, address)
+        self.connections[address] = channel
+        self._channels_by_rbio[channel.rbio.raw] = channel
+        _logger.debug("Created new channel for address: %s", address)
+        return channel
+
+    def adopt_connection(self, address):
+        """Bind the channel for unknown peers to a peer
+
+        The listening connection's SSL instance proceeds to the handshake
+        with a new peer after cookie exchange; its channel, which forward
+        last pointed at that peer, is therefore re-registered under the
+        peer's address. A new channel for unknown peers is created upon the
+        next call to get_connection with address None.
+
+        Return:
+        the adopted channel
+        """
+
+        channel = self.connections.pop(None)
+        assert channel.peer_address == address
+        self.connections[address] = channel
+        return channel
+
+    def remove_connection(self, address):
+        """Remove a channel
+
+        Arguments:
+        address -- an address whose channel has not yet been removed
+
+        Return:
+        the removed channel, or None if it did not exist
+        """
+
+        try:
+            _logger.debug("pop channel %s", repr(address))
+            return self.connections.pop(address)
+        except KeyError:
+            return None
+
+    def get_peer(self, rbio):
+        """Retrieve the peer address associated with a read BIO
+
+        Memory BIO's do not track peer addresses, as datagram BIO's do. This
+        method serves as the replacement for retrieving the peer address
+        from the datagram BIO of an SSL instance.
+
+        Arguments:
+        rbio -- a read BIO previously created by this demux
+
+        Return:
+        the peer address, or None if the BIO is not associated with a peer
+        """
+
+        channel = self._channels_by_rbio.get(rbio.raw)
+        if channel:
+            return channel.peer_address
+
+    def service(self):
+        """Service the root socket
+
+        Read from the root socket, observing its blocking mode and timeout,
+        and write received payloads into the channels of their peers. The
+        call returns without forwarding data if any of the following occurs:
+
+          * An error is encountered while reading from the root socket
+          * Reading from the root socket times out
+          * The root socket is non-blocking and has no data available
+          * An empty payload is received
+          * A non-empty payload is received from an unknown peer (a peer
+            for which get_connection has not yet been called); in this case,
+            the payload is held by this instance and will be forwarded when
+            the forward method is called
+
+        If the batch size is greater than one, then a batch of datagrams is
+        read. Datagrams from unknown peers are then handed out one per call
+        before the root socket is read again.
+
+        Return:
+        if the datagram received was from a new peer, then the peer's
+        address; otherwise None
+        """
+
+        if not self._new_peer_datagrams:
+            if not self._receiver:
+                self._receiver = BatchReceiver(self.batch_size,
+                                               UDP_MAX_DGRAM_LENGTH)
+            timeout = self.datagram_socket.gettimeout()
+            if timeout is not None:
+                deadline = monotonic() + timeout
+            # Waiting connections may queue datagrams from unknown peers
+            while not self._new_peer_datagrams:
+                wait = _WAIT_INTERVAL
+                if timeout is not None:
+                    wait = min(wait, max(deadline - monotonic(), 0))
+                if select([self._io_socket], [], [], wait)[0]:
+                    break
+                if wait < _WAIT_INTERVAL:
+                    if timeout:
+                        raise socket.timeout("timed out")
+                    raise socket.error(errno.EWOULDBLOCK,
+                                       "no datagram queued")
+        if not self._new_peer_datagrams:
+            with self.lock:
+                self._distribute(self._receiver.receive(
+                    self._io_socket, False))
+            if not self._new_peer_datagrams:
+                return
+        self.payload, self.payload_peer_address = \
+          self._new_peer_datagrams.popleft()
+        if self.payload_peer_address in self.connections:
+            self.forward()
+        else:
+            return self.payload_peer_address
+
+    def receive(self, timeout, channel=None):
+        """Receive datagrams on behalf of a waiting connection
+
+        Wait up to the given timeout for the root socket to become readable,
+        and write the datagrams that are then queued at the root socket into
+        the channels of their peers. Datagrams from unknown peers are queued
+        for the service method. Non-blocking callers (timeout zero) stop at
+        a datagram from an unknown peer instead, and leave it at the root
+        socket: select loops then find the listening connection readable.
+
+        Since other threads may receive datagrams for the given channel in
+        the meantime, this method returns early if the channel has input, and
+        waits no longer than a short interval in any case.
+
+        Arguments:
+        timeout -- the maximum time to wait in seconds; None waits
+                   indefinitely
+        channel -- the channel of the waiting connection
+
+        Return:
+        the number of datagrams received, or one if the channel already had
+        input
+        """
+
+        if channel and BIO_ctrl_pending(channel.rbio.value):
+            return 1
+        if timeout is None or timeout > _WAIT_INTERVAL:
+            timeout = _WAIT_INTERVAL
+        if not select([self._io_socket], [], [], timeout)[0]:
+            return 0
+        received = 0
+        with self.lock:
+            while received < UDP_BATCH_SIZE:
+                try:
+                    if not timeout:
+                        peer_address = self._io_socket.recvfrom(
+                            _PEEK_LENGTH, socket.MSG_PEEK | _MSG_DONTWAIT)[1]
+                        if peer_address not in self.connections:
+                            break
+                    datagram = self._io_socket.recvfrom(
+                        UDP_MAX_DGRAM_LENGTH, _MSG_DONTWAIT)
+                except socket.error as sock_err:
+                    if sock_err.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                        raise
+                    break
+                self._distribute([datagram])
+                received += 1
+        return received
+
+    def _distribute(self, datagrams):
+        with self.lock:
+            for payload, peer_address in datagrams:
+                if not payload:
+                    continue
+                channel = self.connections.get(peer_address)
+                if channel:
+                    channel.feed(payload)
+                else:
+                    self._new_peer_datagrams.append((payload, peer_address))
+        _logger.debug("Distributed %d datagrams", len(datagrams))
+
+    def new_peer_pending(self):
+        """Check for queued datagrams from new peers
+
+        Return:
+        True if datagrams from new peers are queued for the service method;
+        False otherwise
+        """
+
+        return bool(self._new_peer_datagrams)
+
+    def forward(self):
+        """Forward a stored datagram
+
+        When the service method returns the address of a new peer, it holds
+        the datagram from that peer in this instance. In this case, this
+        method will perform the forwarding step. The target channel is the
+        one associated with address None if get_connection has not been
+        called since the service method returned the new peer's address, and
+        the channel associated with the new peer's address if it has. In the
+        former case, the channel is pointed at the new peer, and its previous
+        content is discarded.
+        """
+
+        assert self.payload
+        assert self.payload_peer_address
+        with self.lock:
+            if self.payload_peer_address in self.connections:
+                channel = self.connections[self.payload_peer_address]
+            else:
+                channel = self.connections[None]  # propagate if not created
+                channel.reset()
+                channel.peer_address = self.payload_peer_address
+            channel.feed(self.payload)
+        self.payload = b""
+        self.payload_peer_address = None
@@ -0,0 +1,484 @@
+# Multiple-message I/O: batched datagram receive and send for the demux
+# implementations.
+
+# Copyright 2017 Ray Brown
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# The License is also distributed with this work in the file named "LICENSE."
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Multiple-message datagram I/O
+
+This module provides batched datagram reception and transmission for the
+demux implementations. Where the C library exports recvmmsg and sendmmsg
+(Linux), a single system call receives or sends many datagrams; elsewhere, a
+loop of recvfrom or sendto calls is used instead. When receiving, both code
+paths observe the blocking mode and timeout of the socket for the first
+datagram only: subsequent datagrams are only collected if they are already
+queued. When sending, both code paths stop at the first datagram that cannot
+be sent without blocking, and report how many datagrams were sent.
+
+Received datagrams can be placed into buffers taken from a pool, which are
+sized for typical datagrams; longer datagrams overflow into a shared buffer
+and are then copied out. Such datagrams' payloads are memoryview instances
+that must be released to the pool once they have been consumed.
+
+Classes:
+
+  BufferPool -- pool of reusable receive buffers
+  BatchReceiver -- reusable receive vector for batched datagram reception
+  BatchSender -- reusable send vector for batched datagram transmission
+"""
+
+import sys
+import errno
+import socket
+import struct
+from logging import getLogger
+from select import select
+from ctypes import CDLL, Structure, POINTER, get_errno, addressof, pointer
+from ctypes import c_void_p, c_int, c_uint, c_uint32, c_size_t, c_char
+from ctypes import c_char_p, cast, memmove, string_at
+
+_logger = getLogger(__name__)
+
+MSG_DONTWAIT = 0x40
+MSG_WAITFORONE = 0x10000
+SOCKADDR_MAXLEN = 128
+SCATTER_AVAILABLE = hasattr(socket.socket, "recvmsg_into")
+
+#
+# Library loading
+#
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        from ctypes.util import find_library
+        _libc = CDLL(find_library("c") or "libc.so.6", use_errno=True)
+        _libc.recvmmsg
+        _libc.sendmmsg
+    except (OSError, AttributeError):
+        _libc = None
+
+MMSG_AVAILABLE = _libc is not None
+
+
+class _iovec(Structure):
+    _fields_ = [("iov_base", c_void_p),
+                ("iov_len", c_size_t)]
+
+
+class _msghdr(Structure):
+    _fields_ = [("msg_name", c_void_p),
+                ("msg_namelen", c_uint32),
+                ("msg_iov", POINTER(_iovec)),
+                ("msg_iovlen", c_size_t),
+                ("msg_control", c_void_p),
+                ("msg_controllen", c_size_t),
+                ("msg_flags", c_int)]
+
+
+class _mmsghdr(Structure):
+    _fields_ = [("msg_hdr", _msghdr),
+                ("msg_len", c_uint)]
+
+
+if MMSG_AVAILABLE:
+    _recvmmsg = _libc.recvmmsg
+    _recvmmsg.argtypes = (c_int, POINTER(_mmsghdr), c_uint, c_int, c_void_p)
+    _recvmmsg.restype = c_int
+    _sendmmsg = _libc.sendmmsg
+    _sendmmsg.argtypes = (c_int, POINTER(_mmsghdr), c_uint, c_int)
+    _sendmmsg.restype = c_int
+
+
+def addr_tuple_from_sockaddr(data):
+    """Convert a raw sockaddr into an address tuple
+
+    The returned tuple has the same format as the address returned by
+    socket.recvfrom for the address family in question.
+    """
+
+    family = struct.unpack_from("=H", data)[0]
+    if family == socket.AF_INET6:
+        port, flowinfo = struct.unpack_from("!HI", data, 2)
+        scope_id = struct.unpack_from("=I", data, 24)[0]
+        return (socket.inet_ntop(socket.AF_INET6, data[8:24]), port,
+                flowinfo, scope_id)
+    assert family == socket.AF_INET
+    port = struct.unpack_from("!H", data, 2)[0]
+    return socket.inet_ntop(socket.AF_INET, data[4:8]), port
+
+
+def sockaddr_from_addr_tuple(address):
+    """Convert an address tuple into a raw sockaddr
+
+    This is the inverse of addr_tuple_from_sockaddr. Host parts must be
+    numeric addresses.
+    """
+
+    if len(address) == 4 or ":" in address[0]:
+        host, port = address[:2]
+        flowinfo, scope_id = (address[2:] + (0, 0))[:2]
+        return struct.pack("=H", socket.AF_INET6) + \
+          struct.pack("!HI", port, flowinfo) + \
+          socket.inet_pton(socket.AF_INET6, host) + \
+          struct.pack("=I", scope_id)
+    return struct.pack("=H", socket.AF_INET) + \
+      struct.pack("!H", address[1]) + \
+      socket.inet_pton(socket.AF_INET, address[0]) + b"\0" * 8
+
+
+def _raise_errno(err):
+    raise socket.error(err, errno.errorcode.get(err, str(err)))
+
+
+def _buffer_address(payload):
+    if isinstance(payload, bytes):
+        return cast(c_char_p(payload), c_void_p).value
+    return addressof(c_char.from_buffer(payload))
+
+
+class BufferPool(object):
+    """Pool of reusable receive buffers
+
+    Buffers are bytearray instances of a fixed size. Where the platform
+    supports scattering reads (recvmsg_into), the size can be chosen to fit
+    typical datagrams, such as the path MTU: longer datagrams are received
+    into an overflow buffer behind the pooled one, and returned as bytes
+    copies. Elsewhere, buffers are as long as maxsize. Buffers can also be
+    leased with get, filled by the caller, for example with recv_into, and
+    returned with release. Instances are not thread-safe.
+
+    Methods:
+
+      get -- take a buffer from the pool
+      release -- return the buffer of a received payload to the pool
+      receive -- receive a datagram into a pooled buffer
+    """
+
+    def __init__(self, bufsize, maxsize=None, max_free=256):
+        """Constructor
+
+        Arguments:
+        bufsize -- the size of pooled buffers where reads can be scattered
+        maxsize -- the maximum length of a received datagram; None for
+                   bufsize
+        max_free -- the maximum number of unused buffers retained
+        """
+
+        if maxsize is None:
+            maxsize = bufsize
+        if not SCATTER_AVAILABLE or bufsize > maxsize:
+            bufsize = maxsize
+        self.bufsize = bufsize
+        self.maxsize = maxsize
+        self._max_free = max_free
+        self._free = []
+        self._overflow = None
+        if maxsize > bufsize:
+            self._overflow = bytearray(maxsize - bufsize)
+
+    def get(self):
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.bufsize)
+
+    def release(self, payload):
+        """Return the buffer of a received payload to the pool
+
+        Payloads that are neither pooled buffers nor views of them are
+        ignored. The payload must not be used after it has been released.
+
+        Arguments:
+        payload -- a payload returned by receive or a pooled BatchReceiver,
+                   or a buffer taken with get
+        """
+
+        if isinstance(payload, memoryview):
+            buf = payload.obj
+            payload.release()
+        else:
+            buf = payload
+        if isinstance(buf, bytearray) and len(buf) == self.bufsize and \
+          len(self._free) < self._max_free:
+            self._free.append(buf)
+
+    def receive(self, sock, flags=0):
+        """Receive a datagram into a pooled buffer
+
+        The socket's blocking mode and timeout apply, and the same exceptions
+        as with recvfrom are raised.
+
+        Arguments:
+        sock -- the socket to receive from
+        flags -- flags passed to the receive call
+
+        Return:
+        a (payload, address) tuple; the payload is a memoryview of a pooled
+        buffer, or a bytes instance for a datagram that overflowed
+        """
+
+        buf = self.get()
+        try:
+            if self._overflow is None:
+                nbytes, address = sock.recvfrom_into(buf, 0, flags)
+            else:
+                nbytes, _, _, address = \
+                  sock.recvmsg_into([buf, self._overflow], 0, flags)
+        except:
+            self._free.append(buf)
+            raise
+        if nbytes > self.bufsize:
+            payload = bytes(buf) + \
+              bytes(memoryview(self._overflow)[:nbytes - self.bufsize])
+            self._free.append(buf)
+            return payload, address
+        return memoryview(buf)[:nbytes], address
+
+
+class BatchReceiver(object):
+    """Reusable receive vector
+
+    Instances of this class own the buffers and message headers needed to
+    receive a batch of datagrams, so that repeated batches do not allocate
+    per-datagram buffers. Instances are not thread-safe.
+
+    Methods:
+
+      receive -- receive a batch of datagrams from a socket
+    """
+
+    def __init__(self, count, bufsize, pool=None):
+        """Constructor
+
+        Arguments:
+        count -- the maximum number of datagrams received per batch
+        bufsize -- the maximum length of a received datagram
+        pool -- a BufferPool; if given, then datagrams are received into
+                its buffers, and payloads must be released to it
+        """
+
+        assert count > 0
+        self.count = count
+        self.bufsize = bufsize
+        self.pool = pool
+        if not MMSG_AVAILABLE:
+            return
+        self._names = ((c_char * SOCKADDR_MAXLEN) * count)()
+        self._msgs = (_mmsghdr * count)()
+        if pool:
+            # Each message scatters into a pooled buffer, followed by an
+            # overflow buffer of its own
+            overflow = bufsize - pool.bufsize
+            self._slots = [pool.get() for _ in range(count)]
+            self._buffers = ((c_char * overflow) * count)()
+            self._iovecs = (_iovec * (2 * count))()
+            for i in range(count):
+                self._iovecs[2 * i].iov_base = _buffer_address(self._slots[i])
+                self._iovecs[2 * i].iov_len = pool.bufsize
+                self._iovecs[2 * i + 1].iov_base = addressof(self._buffers[i])
+                self._iovecs[2 * i + 1].iov_len = overflow
+        else:
+            self._buffers = ((c_char * bufsize) * count)()
+            self._iovecs = (_iovec * count)()
+            for i in range(count):
+                self._iovecs[i].iov_base = addressof(self._buffers[i])
+                self._iovecs[i].iov_len = bufsize
+        iovlen = 2 if pool else 1
+        for i in range(count):
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = addressof(self._names[i])
+            hdr.msg_namelen = SOCKADDR_MAXLEN
+            hdr.msg_iov = pointer(self._iovecs[i * iovlen])
+            hdr.msg_iovlen = iovlen
+
+    def receive(self, sock, wait=True):
+        """Receive a batch of datagrams
+
+        The first datagram is awaited according to the socket's blocking mode
+        and timeout, with the same exceptions that recvfrom raises when none
+        arrives. Further datagrams are included only if they are queued at
+        the socket already.
+
+        Arguments:
+        sock -- the socket to receive from
+        wait -- if False, then the first datagram is not awaited either,
+                regardless of the socket's blocking mode; the socket error
+                EWOULDBLOCK is raised if no datagram is queued
+
+        Return:
+        a list of (payload, address) tuples in order of arrival; payloads
+        are memoryview instances of pooled buffers if this instance has a
+        pool, except for datagrams that overflowed these
+        """
+
+        if not MMSG_AVAILABLE:
+            return self._receive_loop(sock, wait)
+        timeout = sock.gettimeout()
+        if not wait:
+            flags = MSG_DONTWAIT
+        elif timeout is None:
+            flags = MSG_WAITFORONE
+        else:
+            if timeout and not select([sock], [], [], timeout)[0]:
+                raise socket.timeout("timed out")
+            flags = MSG_DONTWAIT
+        while True:
+            ret = _recvmmsg(sock.fileno(), self._msgs, self.count, flags, None)
+            if ret >= 0:
+                break
+            err = get_errno()
+            if err != errno.EINTR:
+                _raise_errno(err)
+        datagrams = []
+        for i in range(ret):
+            msg = self._msgs[i]
+            if self.pool:
+                payload = self._take_slot(i, msg.msg_len)
+            else:
+                payload = string_at(addressof(self._buffers[i]), msg.msg_len)
+            address = addr_tuple_from_sockaddr(
+                string_at(msg.msg_hdr.msg_name, msg.msg_hdr.msg_namelen))
+            msg.msg_hdr.msg_namelen = SOCKADDR_MAXLEN
+            datagrams.append((payload, address))
+        return datagrams
+
+    def _take_slot(self, i, length):
+        buf = self._slots[i]
+        if length > self.pool.bufsize:
+            return bytes(buf) + string_at(addressof(self._buffers[i]),
+                                          length - self.pool.bufsize)
+        self._slots[i] = self.pool.get()
+        self._iovecs[2 * i].iov_base = _buffer_address(self._slots[i])
+        return memoryview(buf)[:length]
+
+    def _recvfrom(self, sock, flags=0):
+        if self.pool:
+            return self.pool.receive(sock, flags)
+        return sock.recvfrom(self.bufsize, flags)
+
+    def _receive_loop(self, sock, wait):
+        if wait:
+            datagrams = [self._recvfrom(sock)]
+        elif hasattr(socket, "MSG_DONTWAIT"):
+            datagrams = [self._recvfrom(sock, socket.MSG_DONTWAIT)]
+        else:
+            if not select([sock], [], [], 0)[0]:
+                raise socket.error(errno.EWOULDBLOCK, "no datagram queued")
+            datagrams = [self._recvfrom(sock)]
+        while len(datagrams) < self.count and select([sock], [], [], 0)[0]:
+            try:
+                datagrams.append(self._recvfrom(sock))
+            except socket.error as sock_err:
+                if sock_err.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    raise
+                break
+        return datagrams
+
+
+class BatchSender(object):
+    """Reusable send vector
+
+    Instances of this class own the message headers needed to send a batch
+    of datagrams to individual destinations. Payloads are not copied: the
+    headers refer to the payload objects' own buffers for the duration of a
+    send call. Instances are not thread-safe.
+
+    Methods:
+
+      send -- send a batch of datagrams through a socket
+    """
+
+    def __init__(self, count):
+        """Constructor
+
+        Arguments:
+        count -- the maximum number of datagrams sent per system call
+        """
+
+        assert count > 0
+        self.count = count
+        if not MMSG_AVAILABLE:
+            return
+        self._names = ((c_char * SOCKADDR_MAXLEN) * count)()
+        self._iovecs = (_iovec * count)()
+        self._msgs = (_mmsghdr * count)()
+        self._name_cache = {}
+        for i in range(count):
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = addressof(self._names[i])
+            hdr.msg_iov = pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def send(self, sock, datagrams):
+        """Send a batch of datagrams
+
+        Datagrams are sent in order until either all have been sent, or one
+        cannot be sent without blocking. A socket error is raised only if
+        not even the first datagram can be sent for a reason other than the
+        socket's send buffer being full; since later datagrams are then not
+        attempted, the caller can tell which datagram failed.
+
+        Arguments:
+        sock -- the socket to send from
+        datagrams -- a sequence of (payload, address) tuples; payloads must
+                     be bytes objects or writable buffers, such as pooled
+                     payloads
+
+        Return:
+        the number of leading datagrams that were sent
+        """
+
+        if not MMSG_AVAILABLE:
+            return self._send_loop(sock, datagrams)
+        sent = 0
+        while sent < len(datagrams):
+            num = min(self.count, len(datagrams) - sent)
+            for i in range(num):
+                payload, address = datagrams[sent + i]
+                name = self._name_cache.get(address)
+                if name is None:
+                    if len(self._name_cache) >= 4096:
+                        self._name_cache.clear()
+                    name = self._name_cache[address] = \
+                      sockaddr_from_addr_tuple(address)
+                memmove(self._names[i], name, len(name))
+                self._msgs[i].msg_hdr.msg_namelen = len(name)
+                self._iovecs[i].iov_base = _buffer_address(payload)
+                self._iovecs[i].iov_len = len(payload)
+            ret = _sendmmsg(sock.fileno(), self._msgs, num, MSG_DONTWAIT)
+            if ret < 0:
+                err = get_errno()
+                if err == errno.EINTR:
+                    continue
+                if sent or err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                _raise_errno(err)
+            sent += ret
+            if ret < num:
+                break
+        return sent
+
+    def _send_loop(self, sock, datagrams):
+        sent = 0
+        for payload, address in datagrams:
+            try:
+                sock.sendto(payload, address)
+            except socket.error as sock_err:
+                if not sent and sock_err.errno not in (errno.EWOULDBLOCK,
+                                                       errno.EAGAIN):
+                    raise
+                break
+            sent += 1
+        return sent
@@ -28,6 +28,21 @@ connecting the destination socket to the peer endpoint.
 The OSNet demux requires operating system functionality that exists in the
 Linux kernel, but not in the Windows network stack.
 
+The root socket may be one of several sockets bound to the same port with
+SO_REUSEPORT (see dtls.sharding). The connected sockets are deliberately not
+bound with SO_REUSEPORT: they thus stay out of the root socket's reuseport
+group, so that they neither skew the kernel's hashing of unknown peers among
+the group's sockets, nor receive such peers' datagrams before they are
+connected.
+
+Every connected socket consumes a file descriptor, and lengthens the hash
+chains that the kernel searches for each incoming datagram. A demux can
+therefore be given a budget of connected sockets. Once the budget is
+exhausted, further peers are served through the root socket, which is then
+demultiplexed in software by a memory BIO demux (see the membio module); the
+listening connection is served through the memory BIO demux from the start,
+so that the root socket has a single reader.
+
 Classes:
 
   UDPDemux -- a network stack configuring UDP demux
@@ -40,7 +55,9 @@ Exceptions:
 
 import socket
 from logging import getLogger
+from weakref import WeakValueDictionary
 from ..err import InvalidSocketError
+from .membio import UDPDemux as _SharedDemux
 
 _logger = getLogger(__name__)
 
@@ -55,15 +72,29 @@ class UDPDemux(object):
     Methods:
 
       get_connection -- create a new connection or retrieve an existing one
+      remove_connection -- remove a connection from the fd budget
+      get_stats -- report the numbers of peers served through each path
       service -- this method does nothing for this type of demux
+      new_peer_pending -- this demux queues no datagrams
     """
 
-    def __init__(self, datagram_socket):
+    def __init__(self, datagram_socket, batch_size=1, mtu=None,
+                 max_connections=None, idle_timeout=None, fd_budget=None):
         """Constructor
 
         Arguments:
         datagram_socket -- the root socket; this must be a bound, unconnected
                            datagram socket
+        batch_size, mtu -- options of the shared demux, if there is an fd
+                           budget; otherwise accepted for interface
+                           compatibility with the other demuxes
+        max_connections, idle_timeout -- accepted for interface
+                           compatibility with the routing demux; this type of
+                           demux keeps no connection table
+        fd_budget -- the maximum number of peers served through connected
+                     sockets; further peers are served through the root
+                     socket by the shared demux; None for no limit, and no
+                     shared demux
         """
 
         if (datagram_socket.type & socket.SOCK_DGRAM) != socket.SOCK_DGRAM:
@@ -82,6 +113,16 @@ class UDPDemux(object):
 
         datagram_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._datagram_socket = datagram_socket
+        self.fd_budget = fd_budget
+        self.shared = None
+        if fd_budget is not None:
+            shared_options = {"batch_size": batch_size}
+            if mtu:
+                shared_options["mtu"] = mtu
+            self.shared = _SharedDemux(datagram_socket, **shared_options)
+        self.connections = WeakValueDictionary()
+        self._socket_peers_total = 0
+        self._shared_peers_total = 0
 
     def get_connection(self, address):
         """Create or retrieve a muxed connection
@@ -92,11 +133,18 @@ class UDPDemux(object):
 
         Return:
         a bound, connected datagram socket instance, or the root socket
-        in case address was None
+        in case address was None; None if the fd budget is exhausted, in
+        which case the peer is to be served by the shared demux
         """
 
         if not address:
             return self._datagram_socket
+        if self.fd_budget is not None and \
+          len(self.connections) >= self.fd_budget:
+            _logger.debug("Fd budget exhausted; sharing root socket " +
+                          "with address: %s", address)
+            self._shared_peers_total += 1
+            return
 
         # Create a new datagram socket bound to the same interface and port as
         # the root socket, but connected to the given peer
@@ -107,8 +155,43 @@ class UDPDemux(object):
         conn.bind(self._datagram_socket.getsockname())
         conn.connect(address)
         _logger.debug("Created new connection for address: %s", address)
+        self.connections[address] = conn
+        self._socket_peers_total += 1
         return conn
 
+    def remove_connection(self, address):
+        """Remove a connection from the fd budget
+
+        The connection's socket is not closed; its owner closes it.
+
+        Arguments:
+        address -- the address of a connection returned by get_connection
+
+        Return:
+        the removed socket, or None if it did not exist
+        """
+
+        return self.connections.pop(address, None)
+
+    def get_stats(self):
+        """Report the numbers of peers served through each path
+
+        Return:
+        a dictionary with the numbers of peers currently served through
+        connected sockets ("socket_peers") and through the shared root
+        socket ("shared_peers"), and of peers assigned to each path since
+        this demux was created ("socket_peers_total", "shared_peers_total")
+        """
+
+        shared_peers = 0
+        if self.shared:
+            shared_peers = len(self.shared.connections) - \
+              (None in self.shared.connections)
+        return {"socket_peers": len(self.connections),
+                "shared_peers": shared_peers,
+                "socket_peers_total": self._socket_peers_total,
+                "shared_peers_total": self._shared_peers_total}
+
     @staticmethod
     def service():
         """Service the root socket
@@ -119,3 +202,16 @@ class UDPDemux(object):
         """
 
         return True
+
+    @staticmethod
+    def new_peer_pending():
+        """Check for queued datagrams from new peers
+
+        This type of demux queues no datagrams; they remain at the root
+        socket.
+
+        Return:
+        False
+        """
+
+        return False
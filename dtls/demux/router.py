@@ -27,6 +27,13 @@ the connection that is associated with the sending peer.
 
 A routing UDP demux can be used on any platform.
 
+Datagrams are received into buffers from a pool, which are sized to the
+demux's MTU, and forwarded from these buffers without being copied. Longer
+datagrams overflow into a shared buffer, and are copied out.
+
+Connections are kept in a connection table (see the table module), which
+can be bounded in size and can expire idle connections.
+
 Classes:
 
   UDPDemux -- an explicitly routing UDP demux
@@ -38,13 +45,17 @@ Exceptions:
 """
 
 import socket
+from collections import deque, OrderedDict
 from logging import getLogger
-from weakref import WeakValueDictionary
 from ..err import InvalidSocketError
+from .mmsg import BufferPool, BatchReceiver, BatchSender
+from .table import ConnectionTable
 
 _logger = getLogger(__name__)
 
 UDP_MAX_DGRAM_LENGTH = 65527
+UDP_BATCH_SIZE = 64
+UDP_DEFAULT_MTU = 1500  # receive buffer size; longer datagrams overflow
 
 
 class UDPDemux(object):
@@ -58,7 +69,10 @@ class UDPDemux(object):
 
       remove_connection -- remove an existing connection
       service -- distribute datagrams from the root socket to connections
+      service_batch -- distribute a batch of datagrams to connections
       forward -- forward a stored datagram to a connection
+      forward_pending -- retry forwarding of datagrams not yet sent
+      new_peer_pending -- check for queued datagrams from new peers
     """
 
     _forwarding_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -68,12 +82,22 @@ class UDPDemux(object):
         for addr, conn in self.connections.items():
             conn.close()
 
-    def __init__(self, datagram_socket):
+    def __init__(self, datagram_socket, batch_size=1, mtu=UDP_DEFAULT_MTU,
+                 max_connections=None, idle_timeout=None):
         """Constructor
 
         Arguments:
         datagram_socket -- the root socket; this must be a bound, unconnected
                            datagram socket
+        batch_size -- the maximum number of datagrams received from the root
+                      socket per service call; values greater than one select
+                      batched servicing (see service_batch)
+        mtu -- the size of pooled receive buffers
+        max_connections -- the maximum number of peer connections; adding a
+                           connection beyond this number evicts the least
+                           recently used one
+        idle_timeout -- the time in seconds after which a connection that
+                        has not received a datagram may be evicted
         """
 
         if (datagram_socket.type & socket.SOCK_DGRAM) != socket.SOCK_DGRAM:
@@ -96,7 +120,13 @@ class UDPDemux(object):
         self.datagram_socket = datagram_socket
         self.payload = ""
         self.payload_peer_address = None
-        self.connections = WeakValueDictionary()
+        self.connections = ConnectionTable(max_connections, idle_timeout)
+        self.batch_size = batch_size
+        self._receiver = None
+        self._sender = None
+        self._new_peer_datagrams = deque()
+        self._pending_forwards = []
+        self._pool = BufferPool(mtu, UDP_MAX_DGRAM_LENGTH)
 
     def get_connection(self, address):
         """Create or retrieve a muxed connection
@@ -158,16 +188,32 @@ class UDPDemux(object):
             the payload is held by this instance and will be forwarded when
             the forward method is called
 
+        If batched servicing is selected, then an entire batch is read from
+        the root socket instead, and all datagrams from known peers in this
+        batch are forwarded. Datagrams from unknown peers are queued, and
+        handed out one per call in the manner described above before the
+        root socket is read again.
+
         Return:
         if the datagram received was from a new peer, then the peer's
         address; otherwise None
         """
 
-        self.payload, self.payload_peer_address = \
-          self.datagram_socket.recvfrom(UDP_MAX_DGRAM_LENGTH)
-        _logger.debug("Received datagram from peer: %s",
-                      self.payload_peer_address)
+        if not self._new_peer_datagrams and self.batch_size > 1:
+            self.service_batch()
+            if not self._new_peer_datagrams:
+                return
+        if self._new_peer_datagrams:
+            self.payload, self.payload_peer_address = \
+              self._new_peer_datagrams.popleft()
+        else:
+            self.payload, self.payload_peer_address = \
+              self._pool.receive(self.datagram_socket)
+            _logger.debug("Received datagram from peer: %s",
+                          self.payload_peer_address)
         if not self.payload:
+            self._pool.release(self.payload)
+            self.payload = ""
             self.payload_peer_address = None
             return
         if self.payload_peer_address in self.connections:
@@ -175,6 +221,97 @@ class UDPDemux(object):
         else:
             return self.payload_peer_address
 
+    def service_batch(self, max_datagrams=None):
+        """Service the root socket in batched mode
+
+        Read as many datagrams as are available from the root socket, up to
+        the given maximum, using a single system call where the platform
+        supports it. Only the first datagram is awaited according to the root
+        socket's blocking mode and timeout. Received datagrams are grouped by
+        peer, and those from known peers are forwarded to their connections
+        in order of arrival, using a single vectorized send where the
+        platform supports it. Datagrams from unknown peers are queued, to be
+        handed out by subsequent calls to the service method. Datagrams that
+        cannot be forwarded without blocking are kept for forward_pending.
+
+        Arguments:
+        max_datagrams -- the maximum number of datagrams to read; defaults to
+                         this instance's batch size or UDP_BATCH_SIZE,
+                         whichever is greater
+
+        Return:
+        the number of datagrams that were forwarded to known peers
+        """
+
+        count = max_datagrams or max(self.batch_size, UDP_BATCH_SIZE)
+        if not self._receiver or self._receiver.count != count:
+            self._receiver = BatchReceiver(count, UDP_MAX_DGRAM_LENGTH,
+                                           self._pool)
+        by_peer = OrderedDict()
+        for payload, peer_address in \
+          self._receiver.receive(self.datagram_socket):
+            if payload:
+                by_peer.setdefault(peer_address, []).append(payload)
+            else:
+                self._pool.release(payload)
+        _logger.debug("Received datagram batch from %d peers", len(by_peer))
+        for peer_address, payloads in by_peer.items():
+            conn = self.connections.get(peer_address)
+            if conn is None:
+                self._new_peer_datagrams.extend(
+                    (payload, peer_address) for payload in payloads)
+                continue
+            conn_address = conn.getsockname()
+            self._pending_forwards.extend(
+                (payload, conn_address) for payload in payloads)
+        return self.forward_pending()
+
+    def forward_pending(self):
+        """Forward datagrams that batched servicing has not yet sent
+
+        Datagrams are submitted to the connections in a single vectorized
+        send where the platform supports it. Only those that were not sent,
+        because the forwarding socket's send buffer filled up, are retained
+        and retried by the next call to this method or to service_batch. A
+        datagram that cannot be sent for any other reason is dropped, as the
+        network would.
+
+        Return:
+        the number of datagrams that were forwarded
+        """
+
+        if not self._sender:
+            self._sender = BatchSender(UDP_BATCH_SIZE)
+        pending = self._pending_forwards
+        forwarded = 0
+        while pending:
+            try:
+                sent = self._sender.send(self._forwarding_socket, pending)
+            except socket.error as sock_err:
+                _logger.debug("Dropping datagram for connection %s: %s",
+                              pending[0][1], sock_err)
+                sent = 1
+            else:
+                forwarded += sent
+                if not sent:
+                    break
+            for payload, _ in pending[:sent]:
+                self._pool.release(payload)
+            del pending[:sent]
+        if pending:
+            _logger.debug("Deferred forwarding of %d datagrams", len(pending))
+        return forwarded
+
+    def new_peer_pending(self):
+        """Check for queued datagrams from new peers
+
+        Return:
+        True if datagrams from new peers, received during batched
+        servicing, are queued for the service method; False otherwise
+        """
+
+        return bool(self._new_peer_datagrams)
+
     def forward(self):
         """Forward a stored datagram
 
@@ -197,5 +334,6 @@ class UDPDemux(object):
         _logger.debug("Forwarding datagram from peer: %s, default: %s",
                       self.payload_peer_address, default)
         self._forwarding_socket.sendto(self.payload, conn.getsockname())
+        self._pool.release(self.payload)
         self.payload = ""
         self.payload_peer_address = None
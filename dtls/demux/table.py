@@ -0,0 +1,220 @@
+# Connection table: bounded, evicting table of a demux's peer connections.
+
+# Copyright 2017 Ray Brown
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# The License is also distributed with this work in the file named "LICENSE."
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Connection Table
+
+This module provides the table in which a demux keeps its connections, keyed
+by peer address as returned by recvfrom. Entries are kept in order of use, so
+that lookups, insertions and evictions all take constant time. A table can be
+bounded in size, in which case adding a connection evicts the least recently
+used one, and connections can be expired when no datagram has been routed to
+them for a given time.
+
+Evicted connections are closed. The owner of a connection, typically the
+SSLConnection that reads from it, can register a hook to be notified first.
+Owners are referenced weakly: once an owner is finalized, its connection is
+removed from the table and closed as well, instead of lingering until the
+garbage collector finalizes the socket.
+
+The connection for unknown peers, stored under address None, is never
+evicted and does not count towards the table's size.
+
+Classes:
+
+  ConnectionTable -- bounded table of peer connections
+"""
+
+from collections import OrderedDict
+from logging import getLogger
+from time import monotonic
+from weakref import WeakMethod
+
+_logger = getLogger(__name__)
+
+_CONN = 0
+_LAST_USED = 1
+_OWNER = 2
+
+
+class ConnectionTable(object):
+    """Bounded table of peer connections
+
+    This class supports the mapping operations that demuxes perform on their
+    connections. Lookups through indexing and the get method mark a
+    connection as recently used; membership tests do not.
+
+    Methods:
+
+      get -- retrieve a connection and mark it as used
+      pop -- remove a connection without closing it
+      set_owner -- register the eviction hook of a connection's owner
+      expire -- evict connections that have been idle for too long
+      items -- list the table's addresses and connections
+    """
+
+    def __init__(self, max_size=None, idle_timeout=None):
+        """Constructor
+
+        Arguments:
+        max_size -- the maximum number of peer connections; None for no limit
+        idle_timeout -- the time in seconds after which a connection to which
+                        no datagram has been routed can be evicted; idle
+                        connections are evicted when connections are added,
+                        and by the expire method; None for no limit
+        """
+
+        if max_size is not None and max_size < 1:
+            raise ValueError("max_size must be positive")
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._unknown = None
+
+    def __len__(self):
+        return len(self._entries) + (self._unknown is not None)
+
+    def __contains__(self, address):
+        if address is None:
+            return self._unknown is not None
+        return address in self._entries
+
+    def __getitem__(self, address):
+        conn = self.get(address)
+        if conn is None:
+            raise KeyError(address)
+        return conn
+
+    def __setitem__(self, address, conn):
+        if address is None:
+            self._unknown = conn
+            return
+        self.expire()
+        if address not in self._entries and self.max_size is not None:
+            while len(self._entries) >= self.max_size:
+                self._evict(next(iter(self._entries)))
+        self._entries[address] = [conn, monotonic(), None]
+        self._entries.move_to_end(address)
+
+    def get(self, address, default=None):
+        """Retrieve a connection and mark it as used
+
+        Arguments:
+        address -- a peer address, or None for the unknown peer connection
+        default -- the value returned if there is no such connection
+
+        Return:
+        the connection, or default
+        """
+
+        if address is None:
+            return default if self._unknown is None else self._unknown
+        entry = self._entries.get(address)
+        if entry is None:
+            return default
+        entry[_LAST_USED] = monotonic()
+        self._entries.move_to_end(address)
+        return entry[_CONN]
+
+    def pop(self, address, default=None):
+        """Remove a connection without closing it
+
+        Arguments:
+        address -- a peer address, or None for the unknown peer connection
+        default -- the value returned if there is no such connection
+
+        Return:
+        the removed connection, or default
+        """
+
+        if address is None:
+            conn, self._unknown = self._unknown, None
+            return default if conn is None else conn
+        entry = self._entries.pop(address, None)
+        if entry is None:
+            return default
+        return entry[_CONN]
+
+    def set_owner(self, address, hook):
+        """Register the eviction hook of a connection's owner
+
+        The hook is invoked with the peer address before the connection is
+        evicted and closed. It must be a bound method: its instance is
+        referenced weakly, and finalizing it removes and closes the
+        connection.
+
+        Arguments:
+        address -- the address of a connection in this table
+        hook -- a bound method
+        """
+
+        entry = self._entries[address]
+        entry[_OWNER] = WeakMethod(
+            hook, lambda ref: self._owner_finalized(address, ref))
+
+    def expire(self):
+        """Evict connections that have been idle for too long
+
+        Return:
+        the number of connections evicted
+        """
+
+        if self.idle_timeout is None:
+            return 0
+        cutoff = monotonic() - self.idle_timeout
+        expired = 0
+        while self._entries:
+            address, entry = next(iter(self._entries.items()))
+            if entry[_LAST_USED] > cutoff:
+                break
+            self._evict(address)
+            expired += 1
+        return expired
+
+    def items(self):
+        """List the table's addresses and connections
+
+        Return:
+        a list of address and connection pairs, including that of the
+        connection for unknown peers
+        """
+
+        items = [(address, entry[_CONN])
+                 for address, entry in self._entries.items()]
+        if self._unknown is not None:
+            items.append((None, self._unknown))
+        return items
+
+    def _evict(self, address):
+        conn, _, owner = self._entries.pop(address)
+        self.evictions += 1
+        _logger.debug("Evicting connection for address: %s", address)
+        hook = owner and owner()
+        if hook:
+            try:
+                hook(address)
+            except Exception:
+                _logger.exception("Unexpected error in eviction hook")
+        conn.close()
+
+    def _owner_finalized(self, address, ref):
+        entry = self._entries.get(address)
+        if entry and entry[_OWNER] is ref:
+            del self._entries[address]
+            entry[_CONN].close()
+            _logger.debug("Closed connection of finalized owner: %s", address)
@@ -36,16 +36,17 @@ import sys
 import array
 import socket
 from logging import getLogger
-from os import path
+from os import path, urandom
 from datetime import timedelta
 from .err import openssl_error, SSL_ERROR_TEXT
-from .err import SSL_ERROR_NONE
+from .err import SSL_ERROR_NONE, SSL_ERROR_WANT_READ, SSL_ERROR_WANT_WRITE
+from .err import SSL_ERROR_ZERO_RETURN
 from .util import _EC_KEY, _BIO
 import ctypes
 from ctypes import CDLL
 from ctypes import CFUNCTYPE
 from ctypes import c_void_p, c_int, c_uint64, c_long, c_uint, c_ulong, c_char_p, c_size_t
-from ctypes import c_short, c_ushort, c_ubyte, c_char
+from ctypes import c_short, c_ushort, c_ubyte, c_char, c_ssize_t, py_object
 from ctypes import byref, POINTER, addressof
 from ctypes import Structure, Union
 from ctypes import create_string_buffer, sizeof, memmove, cast
@@ -76,6 +77,8 @@ BIO_NOCLOSE = 0x00
 BIO_CLOSE = 0x01
 OPENSSL_VERSION = 0
 SSL_OP_NO_QUERY_MTU = 0x00001000
+SSL_OP_COOKIE_EXCHANGE = 0x00002000
+SSL_OP_NO_TICKET = 0x00004000
 SSL_OP_NO_COMPRESSION = 0x00020000
 SSL_VERIFY_NONE = 0x00
 SSL_VERIFY_PEER = 0x01
@@ -131,8 +134,17 @@ SSL_CB_HANDSHAKE_DONE = 0x20
 #
 SSL_CTRL_SET_TMP_ECDH = 4
 SSL_CTRL_SET_MTU = 17
+SSL_CTRL_SESS_NUMBER = 20
+SSL_CTRL_SESS_ACCEPT = 24
+SSL_CTRL_SESS_ACCEPT_GOOD = 25
+SSL_CTRL_SESS_HIT = 27
+SSL_CTRL_SESS_MISSES = 29
+SSL_CTRL_SESS_TIMEOUTS = 30
+SSL_CTRL_SESS_CACHE_FULL = 31
 SSL_CTRL_OPTIONS = 32
 SSL_CTRL_SET_READ_AHEAD = 41
+SSL_CTRL_SET_SESS_CACHE_SIZE = 42
+SSL_CTRL_GET_SESS_CACHE_SIZE = 43
 SSL_CTRL_SET_SESS_CACHE_MODE = 44
 SSL_CTRL_CLEAR_OPTIONS = 77
 SSL_CTRL_GET_CURVES = 90
@@ -144,14 +156,41 @@ SSL_CTRL_SET_SIGALGS = 97
 SSL_CTRL_SET_SIGALGS_LIST = 98
 SSL_CTRL_SET_CLIENT_SIGALGS = 101
 SSL_CTRL_SET_CLIENT_SIGALGS_LIST = 102
+SSL_CTRL_SET_TLSEXT_HOSTNAME = 55
+SSL_CTRL_SET_TLSEXT_TICKET_KEY_CB = 72
 SSL_CTRL_BUILD_CERT_CHAIN = 105
 
+BIO_CTRL_RESET = 1
+BIO_CTRL_EOF = 2
 BIO_CTRL_INFO = 3
+BIO_CTRL_PENDING = 10
+BIO_CTRL_FLUSH = 11
+BIO_CTRL_DUP = 12
+BIO_CTRL_WPENDING = 13
+BIO_CTRL_DGRAM_CONNECT = 31
 BIO_CTRL_DGRAM_SET_CONNECTED = 32
+BIO_CTRL_DGRAM_GET_RECV_TIMER_EXP = 37
+BIO_CTRL_DGRAM_GET_SEND_TIMER_EXP = 38
+BIO_CTRL_DGRAM_MTU_DISCOVER = 39
+BIO_CTRL_DGRAM_QUERY_MTU = 40
+BIO_CTRL_DGRAM_GET_MTU = 41
+BIO_CTRL_DGRAM_SET_MTU = 42
+BIO_CTRL_DGRAM_MTU_EXCEEDED = 43
 BIO_CTRL_DGRAM_SET_PEER = 44
+BIO_CTRL_DGRAM_SET_NEXT_TIMEOUT = 45
 BIO_CTRL_DGRAM_GET_PEER = 46
+BIO_CTRL_DGRAM_GET_FALLBACK_MTU = 47
+BIO_CTRL_DGRAM_GET_MTU_OVERHEAD = 49
+
+BIO_TYPE_SOURCE_SINK = 0x0400
+BIO_FLAGS_READ = 0x01
+BIO_FLAGS_WRITE = 0x02
+BIO_FLAGS_IO_SPECIAL = 0x04
+BIO_FLAGS_RWS = BIO_FLAGS_READ | BIO_FLAGS_WRITE | BIO_FLAGS_IO_SPECIAL
+BIO_FLAGS_SHOULD_RETRY = 0x08
 
 BIO_C_SET_NBIO = 102
+BIO_C_SET_BUF_MEM_EOF_RETURN = 130
 
 DTLS_CTRL_GET_TIMEOUT = 73
 DTLS_CTRL_HANDLE_TIMEOUT = 74
@@ -162,6 +201,11 @@ SSL_CTRL_SET_MAX_SEND_FRAGMENT = 52
 SSL_CTRL_SET_SPLIT_SEND_FRAGMENT = 125
 SSL_CTRL_SET_MAX_PIPELINES = 126
 
+TLSEXT_NAMETYPE_host_name = 0
+TLSEXT_KEYNAME_LENGTH = 16
+TLSEXT_TICKET_KEY_LENGTH = 32  # AES-256-CBC and HMAC-SHA256 keys
+EVP_MAX_IV_LENGTH = 16
+
 X509_NAME_MAXLEN = 256
 GETS_MAXLEN = 2048
 
@@ -283,6 +327,11 @@ class X509(FuncParam):
         super(X509, self).__init__(value)
 
 
+class SSL_SESSION(FuncParam):
+    def __init__(self, value):
+        super(SSL_SESSION, self).__init__(value)
+
+
 class X509_val_st(Structure):
     _fields_ = [("notBefore", c_void_p),
                 ("notAfter", c_void_p)]
@@ -544,7 +593,8 @@ def errcheck_FuncParam(result, func, args):
 #
 # Function prototypes
 #
-def _make_function(name, lib, args, export=True, errcheck="default"):
+def _make_function(name, lib, args, export=True, errcheck="default",
+                   alias=None):
     assert len(args)
 
     def type_subst(map_type):
@@ -561,7 +611,9 @@ def _make_function(name, lib, args, export=True, errcheck="default"):
         pointer_return = False
     if sig not in _sigs:
         _sigs[sig] = CFUNCTYPE(*sig)
-    if export:
+    if alias:
+        glbl_name = alias
+    elif export:
         glbl_name = name
         __all__.append(name)
     else:
@@ -596,7 +648,8 @@ __all__ = [
     # Constants
     "BIO_NOCLOSE", "BIO_CLOSE",
     "OPENSSL_VERSION",
-    "SSL_OP_NO_QUERY_MTU", "SSL_OP_NO_COMPRESSION",
+    "SSL_OP_NO_QUERY_MTU", "SSL_OP_COOKIE_EXCHANGE",
+    "SSL_OP_NO_COMPRESSION", "SSL_OP_NO_TICKET",
     "SSL_VERIFY_NONE", "SSL_VERIFY_PEER",
     "SSL_VERIFY_FAIL_IF_NO_PEER_CERT", "SSL_VERIFY_CLIENT_ONCE",
     "SSL_SESS_CACHE_OFF", "SSL_SESS_CACHE_CLIENT",
@@ -618,11 +671,21 @@ __all__ = [
     "DTLSv1_get_timeout", "DTLSv1_handle_timeout",
     "DTLSv1_listen",
     "DTLS_set_link_mtu", "DTLS_set_timer_cb",
-    "BIO_gets", "BIO_read", "BIO_get_mem_data",
+    "BIO_gets", "BIO_read", "BIO_write", "BIO_get_mem_data",
+    "BIO_reset", "BIO_ctrl_pending", "BIO_set_mem_eof_return",
     "BIO_dgram_set_connected",
     "BIO_dgram_get_peer", "BIO_dgram_set_peer",
+    "BIO_dgram_mtu_discover", "BIO_dgram_query_mtu",
+    "BIO_dgram_mtu_exceeded",
     "BIO_set_nbio",
+    "BIO_meth_new_datagram",
     "SSL_CTX_set_session_cache_mode", "SSL_CTX_set_read_ahead",
+    "SSL_CTX_sess_set_cache_size", "SSL_CTX_sess_get_cache_size",
+    "SSL_CTX_sess_number", "SSL_CTX_sess_accept", "SSL_CTX_sess_accept_good",
+    "SSL_CTX_sess_hits", "SSL_CTX_sess_misses", "SSL_CTX_sess_timeouts",
+    "SSL_CTX_sess_cache_full",
+    "SSL_CTX_sess_set_callbacks",
+    "SSL_get1_session",
     "SSL_CTX_set_options", "SSL_CTX_clear_options", "SSL_CTX_get_options",
     "SSL_CTX_set1_client_sigalgs_list", "SSL_CTX_set1_client_sigalgs",
     "SSL_CTX_set1_sigalgs_list", "SSL_CTX_set1_sigalgs",
@@ -631,16 +694,20 @@ __all__ = [
     "SSL_CTX_build_cert_chain",
     "SSL_CTX_set_ecdh_auto",
     "SSL_CTX_set_tmp_ecdh",
-    "SSL_read", "SSL_write",
+    "SSL_read", "SSL_write", "SSL_pending",
+    "SSL_do_handshake_status", "SSL_read_status", "SSL_write_status",
     "SSL_set_options", "SSL_clear_options", "SSL_get_options",
     "SSL_set1_client_sigalgs_list", "SSL_set1_client_sigalgs",
     "SSL_set1_sigalgs_list", "SSL_set1_sigalgs",
+    "SSL_set_tlsext_host_name",
     "SSL_get1_curves", "SSL_get_shared_curve",
     "SSL_set1_curves", "SSL_set1_curves_list",
     "SSL_set_mtu",
     "SSL_state_string_long", "SSL_alert_type_string_long", "SSL_alert_desc_string_long",
     "SSL_get_peer_cert_chain",
     "SSL_CTX_set_cookie_cb",
+    "SSL_CTX_set_tlsext_ticket_key_cb",
+    "TLSEXT_KEYNAME_LENGTH", "TLSEXT_TICKET_KEY_LENGTH",
     "OBJ_obj2txt", "decode_ASN1_STRING", "ASN1_TIME_print",
     "OBJ_nid2sn",
     "X509_get_notBefore", "X509_get_notAfter",
@@ -688,12 +755,26 @@ list(map(lambda x: _make_function(*x), (
      ((None, "ret"), (SSLCTX, "ctx"), (c_void_p, "app_verify_cookie_cb")), False),
     ("SSL_CTX_set_info_callback", libssl,
      ((None, "ret"), (SSLCTX, "ctx"), (c_void_p, "app_info_cb")), False),
+    ("SSL_CTX_callback_ctrl", libssl,
+     ((c_long_parm, "ret"), (SSLCTX, "ctx"), (c_int, "cmd"), (c_void_p, "fp")), False),
+    ("EVP_aes_256_cbc", libcrypto,
+     ((c_void_p, "ret"),), False),
+    ("EVP_sha256", libcrypto,
+     ((c_void_p, "ret"),), False),
+    ("EVP_EncryptInit_ex", libcrypto,
+     ((c_int, "ret"), (c_void_p, "ctx"), (c_void_p, "type"), (c_void_p, "impl"), (c_char_p, "key"), (c_void_p, "iv")), False),
+    ("EVP_DecryptInit_ex", libcrypto,
+     ((c_int, "ret"), (c_void_p, "ctx"), (c_void_p, "type"), (c_void_p, "impl"), (c_char_p, "key"), (c_void_p, "iv")), False),
+    ("HMAC_Init_ex", libcrypto,
+     ((c_int, "ret"), (c_void_p, "ctx"), (c_char_p, "key"), (c_int, "len"), (c_void_p, "md"), (c_void_p, "impl")), False),
     ("SSL_new", libssl,
      ((SSL, "ret"), (SSLCTX, "ctx"))),
     ("SSL_free", libssl,
      ((None, "ret"), (SSL, "ssl"))),
     ("SSL_set_bio", libssl,
      ((None, "ret"), (SSL, "ssl"), (BIO, "rbio"), (BIO, "wbio"))),
+    ("SSL_set0_wbio", libssl,
+     ((None, "ret"), (SSL, "ssl"), (BIO, "wbio"))),
     ("BIO_new", libcrypto,
      ((BIO, "ret"), (BIO_METHOD, "type"))),
     ("BIO_s_mem", libcrypto,
@@ -708,6 +789,37 @@ list(map(lambda x: _make_function(*x), (
      ((c_int, "ret"), (BIO, "b"), (POINTER(c_char), "buf"), (c_int, "size")), False),
     ("BIO_read", libcrypto,
      ((c_int, "ret"), (BIO, "b"), (c_void_p, "buf"), (c_int, "len")), False),
+    ("BIO_write", libcrypto,
+     ((c_int, "ret"), (BIO, "b"), (c_void_p, "buf"), (c_int, "len")), False),
+    ("BIO_up_ref", libcrypto,
+     ((c_int, "ret"), (BIO, "a"))),
+    ("BIO_get_new_index", libcrypto,
+     ((c_int, "ret"),),
+     False, errcheck_ord),
+    ("BIO_meth_new", libcrypto,
+     ((BIO_METHOD, "ret"), (c_int, "type"), (c_char_p, "name")),
+     False, errcheck_FuncParam),
+    ("BIO_meth_set_write", libcrypto,
+     ((c_int, "ret"), (BIO_METHOD, "biom"), (c_void_p, "write")),
+     False, errcheck_ord),
+    ("BIO_meth_set_read", libcrypto,
+     ((c_int, "ret"), (BIO_METHOD, "biom"), (c_void_p, "read")),
+     False, errcheck_ord),
+    ("BIO_meth_set_ctrl", libcrypto,
+     ((c_int, "ret"), (BIO_METHOD, "biom"), (c_void_p, "ctrl")),
+     False, errcheck_ord),
+    ("BIO_meth_set_create", libcrypto,
+     ((c_int, "ret"), (BIO_METHOD, "biom"), (c_void_p, "create")),
+     False, errcheck_ord),
+    ("BIO_meth_set_destroy", libcrypto,
+     ((c_int, "ret"), (BIO_METHOD, "biom"), (c_void_p, "destroy")),
+     False, errcheck_ord),
+    ("BIO_set_init", libcrypto,
+     ((None, "ret"), (BIO, "a"), (c_int, "init")), False),
+    ("BIO_set_flags", libcrypto,
+     ((None, "ret"), (BIO, "b"), (c_int, "flags")), False),
+    ("BIO_clear_flags", libcrypto,
+     ((None, "ret"), (BIO, "b"), (c_int, "flags")), False),
     ("SSL_CTX_ctrl", libssl,
      ((c_long_parm, "ret"), (SSLCTX, "ctx"), (c_int, "cmd"), (c_long, "larg"), (c_void_p, "parg")), False),
     ("BIO_ctrl", libcrypto,
@@ -760,12 +872,56 @@ list(map(lambda x: _make_function(*x), (
      ((c_int, "ret"), (SSL, "ssl"), (c_void_p, "buf"), (c_int, "num")), False),
     ("SSL_write", libssl,
      ((c_int, "ret"), (SSL, "ssl"), (c_void_p, "buf"), (c_int, "num")), False),
-    ("SSL_pending", libssl,
+    ("SSL_has_pending", libssl,
      ((c_int, "ret"), (SSL, "ssl")), True, None),
     ("SSL_shutdown", libssl,
      ((c_int, "ret"), (SSL, "ssl"))),
     ("SSL_set_read_ahead", libssl,
      ((None, "ret"), (SSL, "ssl"), (c_int, "yes"))),
+    ("SSL_CTX_set_options", libssl,
+     ((c_ulong, "ret"), (SSLCTX, "ctx"), (c_ulong, "op")), False, None),
+    ("SSL_CTX_clear_options", libssl,
+     ((c_ulong, "ret"), (SSLCTX, "ctx"), (c_ulong, "op")), False, None),
+    ("SSL_CTX_get_options", libssl,
+     ((c_ulong, "ret"), (SSLCTX, "ctx")), False, None),
+    ("SSL_set_options", libssl,
+     ((c_ulong, "ret"), (SSL, "ssl"), (c_ulong, "op")), False, None),
+    ("SSL_clear_options", libssl,
+     ((c_ulong, "ret"), (SSL, "ssl"), (c_ulong, "op")), False, None),
+    ("SSL_get_options", libssl,
+     ((c_ulong, "ret"), (SSL, "ssl")), False, None),
+    ("SSL_CTX_set_timeout", libssl,
+     ((c_long_parm, "ret"), (SSLCTX, "ctx"), (c_long, "t"))),
+    ("SSL_CTX_set_session_id_context", libssl,
+     ((c_int, "ret"), (SSLCTX, "ctx"), (c_char_p, "sid_ctx"), (c_uint, "sid_ctx_len"))),
+    ("SSL_CTX_flush_sessions", libssl,
+     ((None, "ret"), (SSLCTX, "ctx"), (c_long, "tm"))),
+    ("SSL_get1_session", libssl,
+     ((SSL_SESSION, "ret"), (SSL, "ssl")), False, None),
+    ("SSL_set_session", libssl,
+     ((c_int, "ret"), (SSL, "ssl"), (SSL_SESSION, "session"))),
+    ("SSL_SESSION_free", libssl,
+     ((None, "ret"), (SSL_SESSION, "session"))),
+    ("SSL_session_reused", libssl,
+     ((c_int, "ret"), (SSL, "ssl")), True, None),
+    ("SSL_is_init_finished", libssl,
+     ((c_int, "ret"), (SSL, "ssl")), True, None),
+    ("SSL_CTX_sess_set_new_cb", libssl,
+     ((None, "ret"), (SSLCTX, "ctx"), (c_void_p, "new_session_cb")), False),
+    ("SSL_CTX_sess_set_get_cb", libssl,
+     ((None, "ret"), (SSLCTX, "ctx"), (c_void_p, "get_session_cb")), False),
+    ("SSL_CTX_sess_set_remove_cb", libssl,
+     ((None, "ret"), (SSLCTX, "ctx"), (c_void_p, "remove_session_cb")), False),
+    ("i2d_SSL_SESSION", libssl,
+     ((c_int, "ret"), (c_void_p, "in"), (POINTER(c_void_p), "pp")), False, None),
+    ("d2i_SSL_SESSION", libssl,
+     ((c_void_p, "ret"), (c_void_p, "a"), (POINTER(c_char_p), "pp"), (c_long, "length")), False, None),
+    ("SSL_SESSION_get_id", libssl,
+     ((c_void_p, "ret"), (c_void_p, "s"), (POINTER(c_uint), "len")), False, None),
+    ("SSL_SESSION_get_time", libssl,
+     ((c_long, "ret"), (c_void_p, "s")), False, None),
+    ("SSL_SESSION_get_timeout", libssl,
+     ((c_long, "ret"), (c_void_p, "s")), False, None),
     ("SSL_get_rbio", libssl,
      ((BIO, "ret"), (SSL, "ssl"))),
     ("X509_free", libcrypto,
@@ -833,6 +989,25 @@ list(map(lambda x: _make_function(*x), (
      ((c_char_p, "ret"), (c_int, "nid")), True, None),
     )))
 
+#
+# Fast path: the data plane's calls, bound to take the c_void_p handles that
+# FuncParam instances hold. Calls through these skip from_param conversion
+# and errcheck hooks; their wrappers map errors only after a call has failed
+#
+def _make_fast_function(name, lib, restype, argtypes):
+    func = CFUNCTYPE(restype, *argtypes)((name, lib))
+    func.func_name = name
+    globals()["_" + name + "_fast"] = func
+
+list(map(lambda x: _make_fast_function(*x), (
+    ("SSL_do_handshake", libssl, c_int, (c_void_p,)),
+    ("SSL_read", libssl, c_int, (c_void_p, c_void_p, c_int)),
+    ("SSL_write", libssl, c_int, (c_void_p, c_void_p, c_int)),
+    ("SSL_pending", libssl, c_int, (c_void_p,)),
+    ("SSL_get_error", libssl, c_int, (c_void_p, c_int)),
+    ("SSL_ctrl", libssl, c_long, (c_void_p, c_int, c_long, c_void_p)),
+    )))
+
 #
 # Wrappers - functions generally equivalent to OpenSSL library macros
 #
@@ -846,15 +1021,51 @@ def SSL_CTX_set_read_ahead(ctx, m):
     # Returns the previous value of m
     return _SSL_CTX_ctrl(ctx, SSL_CTRL_SET_READ_AHEAD, m, None)
 
+def SSL_CTX_sess_set_cache_size(ctx, t):
+    # Returns the previous value of t
+    return _SSL_CTX_ctrl(ctx, SSL_CTRL_SET_SESS_CACHE_SIZE, t, None)
+
+def SSL_CTX_sess_get_cache_size(ctx):
+    return _SSL_CTX_ctrl(ctx, SSL_CTRL_GET_SESS_CACHE_SIZE, 0, None)
+
+def SSL_CTX_sess_number(ctx):
+    return _SSL_CTX_ctrl(ctx, SSL_CTRL_SESS_NUMBER, 0, None)
+
+def SSL_CTX_sess_accept(ctx):
+    return _SSL_CTX_ctrl(ctx, SSL_CTRL_SESS_ACCEPT, 0, None)
+
+def SSL_CTX_sess_accept_good(ctx):
+    return _SSL_CTX_ctrl(ctx, SSL_CTRL_SESS_ACCEPT_GOOD, 0, None)
+
+def SSL_CTX_sess_hits(ctx):
+    return _SSL_CTX_ctrl(ctx, SSL_CTRL_SESS_HIT, 0, None)
+
+def SSL_CTX_sess_misses(ctx):
+    return _SSL_CTX_ctrl(ctx, SSL_CTRL_SESS_MISSES, 0, None)
+
+def SSL_CTX_sess_timeouts(ctx):
+    return _SSL_CTX_ctrl(ctx, SSL_CTRL_SESS_TIMEOUTS, 0, None)
+
+def SSL_CTX_sess_cache_full(ctx):
+    # Sessions removed from the cache to make room for new ones
+    return _SSL_CTX_ctrl(ctx, SSL_CTRL_SESS_CACHE_FULL, 0, None)
+
+def SSL_get1_session(ssl):
+    # Returns an owned reference, or None before a session is established
+    session = _SSL_get1_session(ssl)
+    return SSL_SESSION(session) if session else None
+
+# The option accessors are functions since OpenSSL 1.1.0, which no longer
+# handles the SSL_CTRL_OPTIONS and SSL_CTRL_CLEAR_OPTIONS controls
 def SSL_CTX_set_options(ctx, options):
     # Returns the new option bitmaks after adding the given options
-    return _SSL_CTX_ctrl(ctx, SSL_CTRL_OPTIONS, options, None)
+    return _SSL_CTX_set_options(ctx, options)
 
 def SSL_CTX_clear_options(ctx, options):
-    return _SSL_CTX_ctrl(ctx, SSL_CTRL_CLEAR_OPTIONS, options, None)
+    return _SSL_CTX_clear_options(ctx, options)
 
 def SSL_CTX_get_options(ctx):
-    return _SSL_CTX_ctrl(ctx, SSL_CTRL_OPTIONS, 0, None)
+    return _SSL_CTX_get_options(ctx)
 
 def SSL_CTX_set1_client_sigalgs(ctx, slist, slistlen):
     _slist = (c_int * len(slist))(*slist)
@@ -972,6 +1183,103 @@ def SSL_CTX_set_cookie_cb(ctx, generate, verify):
     _SSL_CTX_set_cookie_verify_cb(ctx, ver_cb)
     return gen_cb, ver_cb
 
+_rint_voidp_ubytep_ubytep_voidp_voidp_int = CFUNCTYPE(c_int, c_void_p,
+                                                     POINTER(c_ubyte),
+                                                     POINTER(c_ubyte),
+                                                     c_void_p, c_void_p, c_int)
+
+def SSL_CTX_set_tlsext_ticket_key_cb(ctx, get_key):
+    # get_key is called with None to retrieve the key with which to encrypt
+    # a new ticket, and with a ticket's key name to retrieve the key with
+    # which to decrypt it; it returns a tuple of key name, HMAC key, AES key,
+    # and whether to renew the ticket, or None if no key applies
+    def py_ticket_key_cb(ssl, key_name, iv, cipher_ctx, hmac_ctx, enc):
+        try:
+            if enc:
+                key = get_key(None)
+                if not key:
+                    return 0  # do not issue a ticket
+                memmove(key_name, key[0], TLSEXT_KEYNAME_LENGTH)
+                memmove(iv, urandom(EVP_MAX_IV_LENGTH), EVP_MAX_IV_LENGTH)
+                _EVP_EncryptInit_ex(cipher_ctx, _EVP_aes_256_cbc(), None,
+                                    key[2], iv)
+            else:
+                key = get_key(ctypes.string_at(key_name,
+                                               TLSEXT_KEYNAME_LENGTH))
+                if not key:
+                    return 0  # unknown key: perform a full handshake
+                _EVP_DecryptInit_ex(cipher_ctx, _EVP_aes_256_cbc(), None,
+                                    key[2], iv)
+            _HMAC_Init_ex(hmac_ctx, key[1], len(key[1]), _EVP_sha256(), None)
+        except:
+            # Without a ticket, or with a ticket that cannot be decrypted,
+            # handshakes still succeed
+            _logger.exception("Ticket key callback failed")
+            return 0
+        return 2 if not enc and key[3] else 1
+
+    ticket_key_cb = _rint_voidp_ubytep_ubytep_voidp_voidp_int(py_ticket_key_cb)
+    _SSL_CTX_callback_ctrl(ctx, SSL_CTRL_SET_TLSEXT_TICKET_KEY_CB,
+                           cast(ticket_key_cb, c_void_p))
+    return ticket_key_cb
+
+_rint_voidp_voidp = CFUNCTYPE(c_int, c_void_p, c_void_p)
+_rvoidp_voidp_ubytep_int_intp = CFUNCTYPE(c_void_p, c_void_p, POINTER(c_ubyte),
+                                          c_int, POINTER(c_int))
+_rvoid_voidp_voidp = CFUNCTYPE(None, c_void_p, c_void_p)
+
+def _SSL_SESSION_id(session):
+    id_len = c_uint()
+    session_id = _SSL_SESSION_get_id(session, byref(id_len))
+    return ctypes.string_at(session_id, id_len.value)
+
+def SSL_CTX_sess_set_callbacks(ctx, new_session, get_session, remove_session):
+    # new_session is called with a new session's id, its DER encoding, and
+    # its expiry time in seconds since the epoch; get_session is called with
+    # a session id, and returns the DER encoding of that session, or None;
+    # remove_session is called with the id of a session that must no longer
+    # be resumed
+    def py_new_session_cb(ssl, session):
+        try:
+            der_len = _i2d_SSL_SESSION(session, None)
+            der = create_string_buffer(der_len)
+            der_p = cast(der, c_void_p)
+            _i2d_SSL_SESSION(session, byref(der_p))
+            new_session(_SSL_SESSION_id(session), der.raw,
+                        _SSL_SESSION_get_time(session) +
+                        _SSL_SESSION_get_timeout(session))
+        except:
+            _logger.exception("Storing session failed")
+        return 0  # no reference to the session is retained
+
+    def py_get_session_cb(ssl, session_id, id_len, copy):
+        try:
+            der = get_session(ctypes.string_at(session_id, id_len))
+            if not der:
+                return
+            der_p = c_char_p(der)
+            session = _d2i_SSL_SESSION(None, byref(der_p), len(der))
+        except:
+            # Without the stored session, the handshake is a full one
+            _logger.exception("Retrieving session failed")
+            return
+        copy[0] = 0  # the library takes over the decoded session
+        return session
+
+    def py_remove_session_cb(ctx, session):
+        try:
+            remove_session(_SSL_SESSION_id(session))
+        except:
+            _logger.exception("Removing session failed")
+
+    new_cb = _rint_voidp_voidp(py_new_session_cb)
+    get_cb = _rvoidp_voidp_ubytep_int_intp(py_get_session_cb)
+    remove_cb = _rvoid_voidp_voidp(py_remove_session_cb)
+    _SSL_CTX_sess_set_new_cb(ctx, new_cb)
+    _SSL_CTX_sess_set_get_cb(ctx, get_cb)
+    _SSL_CTX_sess_set_remove_cb(ctx, remove_cb)
+    return new_cb, get_cb, remove_cb
+
 def BIO_dgram_set_connected(bio, peer_address):
     su = sockaddr_u_from_addr_tuple(peer_address)
     return _BIO_ctrl(bio, BIO_CTRL_DGRAM_SET_CONNECTED, 0, byref(su))
@@ -979,24 +1287,111 @@ def BIO_dgram_set_connected(bio, peer_address):
 def BIO_dgram_get_peer(bio):
     su = sockaddr_u()
     _BIO_ctrl(bio, BIO_CTRL_DGRAM_GET_PEER, 0, byref(su))
+    if not su.ss.ss_family:
+        return  # no peer has been set or received from
     return addr_tuple_from_sockaddr_u(su)
 
 def BIO_dgram_set_peer(bio, peer_address):
     su = sockaddr_u_from_addr_tuple(peer_address)
     return _BIO_ctrl(bio, BIO_CTRL_DGRAM_SET_PEER, 0, byref(su))
 
+def BIO_dgram_mtu_discover(bio):
+    return _BIO_ctrl(bio, BIO_CTRL_DGRAM_MTU_DISCOVER, 0, None)
+
+def BIO_dgram_query_mtu(bio):
+    return _BIO_ctrl(bio, BIO_CTRL_DGRAM_QUERY_MTU, 0, None)
+
+def BIO_dgram_mtu_exceeded(bio):
+    return _BIO_ctrl(bio, BIO_CTRL_DGRAM_MTU_EXCEEDED, 0, None)
+
 def BIO_set_nbio(bio, n):
     return _BIO_ctrl(bio, BIO_C_SET_NBIO, 1 if n else 0, None)
 
+_rint_voidp = CFUNCTYPE(c_int, c_void_p)
+_rint_voidp_voidp_int = CFUNCTYPE(c_int, c_void_p, c_void_p, c_int)
+_rlong_voidp_int_long_voidp = CFUNCTYPE(c_long, c_void_p, c_int, c_long,
+                                        c_void_p)
+
+def BIO_meth_new_datagram(name, write, read, ctrl, destroy=None):
+    """
+    Create a source/sink BIO method implemented by Python callbacks
+
+    The callbacks receive the address of the BIO as their first argument.
+    write(bio, data) returns the number of bytes written; read(bio, length)
+    returns at most length bytes, or None if nothing can be read without
+    blocking, in which case the BIO is flagged for retrying the read;
+    ctrl(bio, cmd, larg, parg) returns the result of a control operation;
+    destroy(bio) is called when the BIO is freed. Exceptions raised by the
+    callbacks are logged, and fail the operation.
+
+    :param name: The name of the BIO method
+    :return: The BIO method, and callback objects that must be kept alive
+             for as long as the method is in use
+    """
+    def py_write(bio, buf, num):
+        _BIO_clear_flags(BIO(bio), BIO_FLAGS_RWS | BIO_FLAGS_SHOULD_RETRY)
+        try:
+            return write(bio, ctypes.string_at(buf, num))
+        except:
+            _logger.exception("BIO write callback failed")
+            return -1
+
+    def py_read(bio, buf, size):
+        _BIO_clear_flags(BIO(bio), BIO_FLAGS_RWS | BIO_FLAGS_SHOULD_RETRY)
+        try:
+            data = read(bio, size)
+        except:
+            _logger.exception("BIO read callback failed")
+            return -1
+        if data is None:
+            _BIO_set_flags(BIO(bio), BIO_FLAGS_READ | BIO_FLAGS_SHOULD_RETRY)
+            return -1
+        memmove(buf, data, len(data))
+        return len(data)
+
+    def py_ctrl(bio, cmd, larg, parg):
+        try:
+            return ctrl(bio, cmd, larg, parg)
+        except:
+            _logger.exception("BIO ctrl callback failed")
+            return 0
+
+    def py_create(bio):
+        _BIO_set_init(BIO(bio), 1)
+        return 1
+
+    def py_destroy(bio):
+        if destroy:
+            try:
+                destroy(bio)
+            except:
+                _logger.exception("BIO destroy callback failed")
+        return 1
+
+    callbacks = (_rint_voidp_voidp_int(py_write),
+                 _rint_voidp_voidp_int(py_read),
+                 _rlong_voidp_int_long_voidp(py_ctrl),
+                 _rint_voidp(py_create),
+                 _rint_voidp(py_destroy))
+    method = _BIO_meth_new(_BIO_get_new_index() | BIO_TYPE_SOURCE_SINK,
+                           name.encode())
+    _BIO_meth_set_write(method, callbacks[0])
+    _BIO_meth_set_read(method, callbacks[1])
+    _BIO_meth_set_ctrl(method, callbacks[2])
+    _BIO_meth_set_create(method, callbacks[3])
+    _BIO_meth_set_destroy(method, callbacks[4])
+    return method, callbacks
+
 def DTLSv1_get_timeout(ssl):
     tv = TIMEVAL()
-    ret = _SSL_ctrl(ssl, DTLS_CTRL_GET_TIMEOUT, 0, byref(tv))
+    ret = _SSL_ctrl_fast(ssl._as_parameter, DTLS_CTRL_GET_TIMEOUT, 0,
+                         byref(tv))
     if ret != 1:
         return
     return timedelta(seconds=tv.tv_sec, microseconds=tv.tv_usec)
 
 def DTLSv1_handle_timeout(ssl):
-    ret = _SSL_ctrl(ssl, DTLS_CTRL_HANDLE_TIMEOUT, 0, None)
+    ret = _SSL_ctrl_fast(ssl._as_parameter, DTLS_CTRL_HANDLE_TIMEOUT, 0, None)
     if ret == 0:
         # It was too early to call: no timer had yet expired
         return False
@@ -1014,6 +1409,9 @@ def DTLSv1_listen(ssl):
     su = sockaddr_u()
     ret = _DTLSv1_listen(ssl, byref(su))
     if ret:
+        if not su.ss.ss_family:
+            # The read BIO does not track peer addresses (memory BIO)
+            return ()
         return addr_tuple_from_sockaddr_u(su)
     return None
 
@@ -1048,35 +1446,131 @@ def remove_from_timer_callbacks(ssl):
         _timer_callbacks_lock.release()
 
 def SSL_read(ssl, length, buffer):
-    if buffer:
+    if buffer is not None:
         length = min(length, len(buffer))
         buf = (c_char * length).from_buffer(buffer)
     else:
         buf = create_string_buffer(length)
-    res_len = _SSL_read(ssl, buf, length)
-    if buffer:
+    res_len = _SSL_read_fast(ssl._as_parameter, buf, length)
+    if res_len <= 0:
+        raise_ssl_error(res_len, _SSL_read, (ssl, buf, length), ssl)
+    if buffer is not None:
         return res_len
-    return buf.raw[:res_len]
+    return ctypes.string_at(buf, res_len)
+
+class _Py_buffer(Structure):
+    _fields_ = [("buf", c_void_p),
+                ("obj", c_void_p),
+                ("len", c_ssize_t),
+                ("itemsize", c_ssize_t),
+                ("readonly", c_int),
+                ("ndim", c_int),
+                ("format", c_char_p),
+                ("shape", c_void_p),
+                ("strides", c_void_p),
+                ("suboffsets", c_void_p),
+                ("internal", c_void_p)]
+
+
+if hasattr(ctypes, "pythonapi"):
+    _PyObject_GetBuffer = ctypes.pythonapi.PyObject_GetBuffer
+    _PyObject_GetBuffer.argtypes = [py_object, POINTER(_Py_buffer), c_int]
+    _PyObject_GetBuffer.restype = c_int
+    _PyBuffer_Release = ctypes.pythonapi.PyBuffer_Release
+    _PyBuffer_Release.argtypes = [POINTER(_Py_buffer)]
+    _PyBuffer_Release.restype = None
+else:
+    _PyObject_GetBuffer = None
+
+def _SSL_write_buffer(write, ssl, data):
+    # Write from a buffer-protocol object without copying it, unless it
+    # is not contiguous
+    view = memoryview(data)
+    if not view.c_contiguous:
+        data = view.tobytes()
+        return write(ssl, data, len(data))
+    if not view.readonly:
+        return write(ssl, (c_char * view.nbytes).from_buffer(view),
+                     view.nbytes)
+    if not _PyObject_GetBuffer:
+        data = view.tobytes()
+        return write(ssl, data, len(data))
+    # ctypes exports writable buffers only: address a read-only one
+    # through the buffer protocol (PyBUF_SIMPLE) for the call's duration
+    pybuf = _Py_buffer()
+    _PyObject_GetBuffer(view, byref(pybuf), 0)
+    try:
+        return write(ssl, pybuf.buf, pybuf.len)
+    finally:
+        _PyBuffer_Release(byref(pybuf))
 
-def SSL_write(ssl, data):
+def _SSL_write_data(write, ssl, data):
+    if type(data) is bytes:
+        return write(ssl, data, len(data))
     if isinstance(data, str):
         data = data.encode()
-    elif isinstance(data, bytearray):
-        data = bytes(data)
-    elif hasattr(data, "tobytes") and callable(data.tobytes):
-        data = data.tobytes()
     elif isinstance(data, ctypes.Array):
-        data = data.raw
-    return _SSL_write(ssl, data, len(data))
+        return write(ssl, data, sizeof(data))
+    elif not isinstance(data, bytes):
+        return _SSL_write_buffer(write, ssl, data)
+    return write(ssl, data, len(data))
+
+def SSL_write(ssl, data):
+    result = _SSL_write_data(_SSL_write_fast, ssl._as_parameter, data)
+    if result <= 0:
+        raise_ssl_error(result, _SSL_write, (ssl, data), ssl)
+    return result
+
+def SSL_pending(ssl):
+    return _SSL_pending_fast(ssl._as_parameter)
+
+#
+# Status functions: instead of raising for the SSL_ERROR_WANT_READ,
+# SSL_ERROR_WANT_WRITE and SSL_ERROR_ZERO_RETURN outcomes, these return
+# the SSL_get_error code; other errors are raised as usual
+#
+def _ssl_status(result, func, args):
+    ssl_error = _SSL_get_error_fast(args[0]._as_parameter, result)
+    if ssl_error not in (SSL_ERROR_WANT_READ, SSL_ERROR_WANT_WRITE,
+                         SSL_ERROR_ZERO_RETURN):
+        raise_ssl_error(result, func, args, args[0])
+    return ssl_error
+
+def SSL_do_handshake_status(ssl):
+    result = _SSL_do_handshake_fast(ssl._as_parameter)
+    if result > 0:
+        return SSL_ERROR_NONE
+    return _ssl_status(result, _SSL_do_handshake_fast, (ssl,))
+
+def SSL_read_status(ssl, length, buffer):
+    # Returns a tuple of status code and data (or length read into buffer)
+    if buffer is not None:
+        length = min(length, len(buffer))
+        buf = (c_char * length).from_buffer(buffer)
+    else:
+        buf = create_string_buffer(length)
+    result = _SSL_read_fast(ssl._as_parameter, buf, length)
+    if result > 0:
+        return SSL_ERROR_NONE, \
+          result if buffer is not None else ctypes.string_at(buf, result)
+    return _ssl_status(result, _SSL_read_fast,
+                       (ssl, buf, length)), None
+
+def SSL_write_status(ssl, data):
+    # Returns a tuple of status code and number of bytes written
+    result = _SSL_write_data(_SSL_write_fast, ssl._as_parameter, data)
+    if result > 0:
+        return SSL_ERROR_NONE, result
+    return _ssl_status(result, _SSL_write_fast, (ssl, data)), None
 
 def SSL_set_options(ssl, op):
-    return _SSL_ctrl(ssl, SSL_CTRL_OPTIONS, op, None)
+    return _SSL_set_options(ssl, op)
 
 def SSL_clear_options(ssl, op):
-    return _SSL_ctrl(ssl, SSL_CTRL_CLEAR_OPTIONS, op, None)
+    return _SSL_clear_options(ssl, op)
 
 def SSL_get_options(ssl):
-    return _SSL_ctrl(ssl, SSL_CTRL_OPTIONS, 0, None)
+    return _SSL_get_options(ssl)
 
 def SSL_set1_client_sigalgs(ssl, slist, slistlen):
     _slist = (c_int * len(slist))(*slist)
@@ -1094,6 +1588,11 @@ def SSL_set1_sigalgs_list(ssl, s):
     _s = cast(s, POINTER(c_char))
     return _SSL_ctrl(ssl, SSL_CTRL_SET_SIGALGS_LIST, 0, _s)
 
+def SSL_set_tlsext_host_name(ssl, name):
+    _name = cast(name, POINTER(c_char))
+    return _SSL_ctrl(ssl, SSL_CTRL_SET_TLSEXT_HOSTNAME,
+                     TLSEXT_NAMETYPE_host_name, _name)
+
 def SSL_get1_curves(ssl, curves=None):
     assert curves is None or isinstance(curves, list)
     if curves is not None:
@@ -1175,7 +1674,19 @@ def BIO_gets(bio):
 def BIO_read(bio, length):
     buf = create_string_buffer(length)
     res_len = _BIO_read(bio, buf, sizeof(buf))
-    return buf.raw[:res_len]
+    return ctypes.string_at(buf, res_len)
+
+def BIO_write(bio, data):
+    return _BIO_write(bio, data, len(data))
+
+def BIO_reset(bio):
+    return _BIO_ctrl(bio, BIO_CTRL_RESET, 0, None)
+
+def BIO_ctrl_pending(bio):
+    return _BIO_ctrl(bio, BIO_CTRL_PENDING, 0, None)
+
+def BIO_set_mem_eof_return(bio, v):
+    return _BIO_ctrl(bio, BIO_C_SET_BUF_MEM_EOF_RETURN, v, None)
 
 def BIO_get_mem_data(bio):
     buf = POINTER(c_ubyte)()
@@ -93,7 +93,10 @@ def _wrap_socket(sock, keyfile=None, certfile=None,
                  suppress_ragged_eofs=True,
                  ciphers=None,
                  cb_user_config_ssl_ctx=None,
-                 cb_user_config_ssl=None):
+                 cb_user_config_ssl=None,
+                 server_hostname=None,
+                 session_cache=None,
+                 ctx_cache_key=None):
 
     return ssl.SSLSocket(sock, keyfile=keyfile, certfile=certfile,
                          server_side=server_side, cert_reqs=cert_reqs,
@@ -101,8 +104,11 @@ def _wrap_socket(sock, keyfile=None, certfile=None,
                          do_handshake_on_connect=do_handshake_on_connect,
                          suppress_ragged_eofs=suppress_ragged_eofs,
                          ciphers=ciphers,
+                         server_hostname=server_hostname,
                          cb_user_config_ssl_ctx=cb_user_config_ssl_ctx,
-                         cb_user_config_ssl=cb_user_config_ssl)
+                         cb_user_config_ssl=cb_user_config_ssl,
+                         session_cache=session_cache,
+                         ctx_cache_key=ctx_cache_key)
 
 
 def _get_server_certificate(addr, ssl_version=PROTOCOL_SSLv23, ca_certs=None):
@@ -151,7 +157,9 @@ def _SSLSocket_init(self, sock=None, keyfile=None, certfile=None,
                     _context=None,
                     _session=None,
                     cb_user_config_ssl_ctx=None,
-                    cb_user_config_ssl=None):
+                    cb_user_config_ssl=None,
+                    session_cache=None,
+                    ctx_cache_key=None):
     is_connection = is_datagram = False
     if isinstance(sock, SSLConnection):
         is_connection = True
@@ -201,11 +209,18 @@ def _SSLSocket_init(self, sock=None, keyfile=None, certfile=None,
     self._makefile_refs = 0
     self._user_config_ssl_ctx = cb_user_config_ssl_ctx
     self._user_config_ssl = cb_user_config_ssl
+    self.server_hostname = server_hostname
+    self._session_cache = session_cache
+    self._ctx_cache_key = ctx_cache_key
 
     # Perform method substitution and addition (without reference cycle)
     self._real_connect = MethodType(_SSLSocket_real_connect, proxy(self))
     self.listen = MethodType(_SSLSocket_listen, proxy(self))
     self.accept = MethodType(_SSLSocket_accept, proxy(self))
+    self.drain = MethodType(_SSLSocket_drain, proxy(self))
+    self.recvfrom_into = MethodType(_SSLSocket_recvfrom_into, proxy(self))
+    self.read_many = MethodType(_SSLSocket_read_many, proxy(self))
+    self.write_many = MethodType(_SSLSocket_write_many, proxy(self))
     self.get_timeout = MethodType(_SSLSocket_get_timeout, proxy(self))
     self.handle_timeout = MethodType(_SSLSocket_handle_timeout, proxy(self))
 
@@ -230,7 +245,10 @@ def _SSLSocket_init(self, sock=None, keyfile=None, certfile=None,
                                          do_handshake_on_connect,
                                          suppress_ragged_eofs, ciphers,
                                          cb_user_config_ssl_ctx=cb_user_config_ssl_ctx,
-                                         cb_user_config_ssl=cb_user_config_ssl)
+                                         cb_user_config_ssl=cb_user_config_ssl,
+                                         server_hostname=server_hostname,
+                                         session_cache=session_cache,
+                                         ctx_cache_key=ctx_cache_key)
             self._connected = True
     else:
         self._connected = True
@@ -280,6 +298,32 @@ def _SSLSocket_accept(self):
     return new_ssl_sock, addr
 
 
+def _SSLSocket_drain(self, max_datagrams=None, max_time=None):
+    if self._connected:
+        raise ValueError("attempt to drain connected SSLSocket!")
+    if not self._sslobj:
+        raise ValueError("attempt to drain SSLSocket prior to listen!")
+    return self._sslobj.drain(max_datagrams, max_time)
+
+
+def _SSLSocket_recvfrom_into(self, buffer, nbytes=None, flags=0):
+    if not self._connected:
+        raise ValueError("attempt to receive on unconnected SSLSocket!")
+    return self.recv_into(buffer, nbytes, flags), self.getpeername()
+
+
+def _SSLSocket_read_many(self, max_records=None, max_bytes=None):
+    if not self._connected:
+        raise ValueError("attempt to read on unconnected SSLSocket!")
+    return self._sslobj.read_many(max_records, max_bytes)
+
+
+def _SSLSocket_write_many(self, messages, mtu=None):
+    if not self._connected:
+        raise ValueError("attempt to write on unconnected SSLSocket!")
+    return self._sslobj.write_many(messages, mtu)
+
+
 def _SSLSocket_real_connect(self, addr, return_errno):
     if self._connected:
         raise ValueError("attempt to connect already-connected SSLSocket!")
@@ -292,7 +336,10 @@ def _SSLSocket_real_connect(self, addr, return_errno):
                                  self.do_handshake_on_connect,
                                  self.suppress_ragged_eofs, self.ciphers,
                                  cb_user_config_ssl_ctx=self._user_config_ssl_ctx,
-                                 cb_user_config_ssl=self._user_config_ssl)
+                                 cb_user_config_ssl=self._user_config_ssl,
+                                 server_hostname=self.server_hostname,
+                                 session_cache=self._session_cache,
+                                 ctx_cache_key=self._ctx_cache_key)
     if hasattr(self, 'timeout'):
         try:
             self._sslobj._sock.settimeout(self.timeout)
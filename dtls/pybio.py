@@ -0,0 +1,280 @@
+# Python BIO's: datagram BIO's whose I/O is performed by Python code.
+
+# Copyright 2017 Ray Brown
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# The License is also distributed with this work in the file named "LICENSE."
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Python BIO's
+
+OpenSSL's datagram BIO sends every record with its own sendto system call, as
+soon as it is written. This module defines a BIO type of its own, whose
+operations are implemented in Python. Its writes do not reach the network:
+the datagrams are appended to an outgoing queue instead, which the
+application flushes when and how it chooses, for example with one sendmmsg
+call per batch, at a limited rate, or over an entirely different transport.
+Its reads take datagrams fed by the application, or else receive from a
+socket without blocking.
+
+Unlike a memory BIO, this BIO answers the control queries that OpenSSL's DTLS
+implementation issues to datagram BIO's: it reports and records the peer
+address, reports the MTU that the application configures, and records the
+retransmission deadlines that OpenSSL's timers set.
+
+Classes:
+
+  QueueBIO -- datagram BIO with a Python-managed outgoing queue
+"""
+
+import socket
+import errno
+from collections import deque
+from ctypes import POINTER, byref, cast, memmove, sizeof
+from logging import getLogger
+from threading import Lock
+from weakref import ref
+from .openssl import BIO_new, BIO_up_ref, BIO_meth_new_datagram, TIMEVAL
+from .openssl import sockaddr_u, sockaddr_in, sockaddr_in6
+from .openssl import addr_tuple_from_sockaddr_u, sockaddr_u_from_addr_tuple
+from .openssl import BIO_CTRL_RESET, BIO_CTRL_PENDING
+from .openssl import BIO_CTRL_WPENDING, BIO_CTRL_FLUSH, BIO_CTRL_DUP
+from .openssl import BIO_CTRL_DGRAM_CONNECT, BIO_CTRL_DGRAM_SET_CONNECTED
+from .openssl import BIO_CTRL_DGRAM_SET_PEER, BIO_CTRL_DGRAM_GET_PEER
+from .openssl import BIO_CTRL_DGRAM_QUERY_MTU, BIO_CTRL_DGRAM_GET_MTU
+from .openssl import BIO_CTRL_DGRAM_SET_MTU, BIO_CTRL_DGRAM_GET_FALLBACK_MTU
+from .openssl import BIO_CTRL_DGRAM_GET_MTU_OVERHEAD
+from .openssl import BIO_CTRL_DGRAM_SET_NEXT_TIMEOUT
+from .util import _BIO
+from .demux.membio import UDP_DEFAULT_MTU, UDP_BATCH_SIZE
+from .demux.mmsg import BatchSender
+
+_logger = getLogger(__name__)
+
+_MIN_MTU = 256 - 64  # smallest MTU OpenSSL accepts, less IPv6 overhead
+
+_method = None
+_method_lock = Lock()
+_instances = {}  # BIO address -> weak reference to its QueueBIO
+
+
+def _get_method():
+    global _method
+    with _method_lock:
+        if not _method:
+            _method = BIO_meth_new_datagram("Python queue datagram BIO",
+                                            _write, _read, _ctrl, _destroy)
+        return _method[0]
+
+
+def _instance(bio):
+    instance = _instances.get(bio)
+    return instance() if instance else None
+
+
+def _write(bio, data):
+    instance = _instance(bio)
+    if not instance:
+        return -1
+    return instance._write(data)
+
+
+def _read(bio, length):
+    instance = _instance(bio)
+    if not instance:
+        return b""
+    return instance._read(length)
+
+
+def _ctrl(bio, cmd, larg, parg):
+    instance = _instance(bio)
+    if not instance:
+        return 0
+    return instance._ctrl(cmd, larg, parg)
+
+
+def _destroy(bio):
+    _instances.pop(bio, None)
+
+
+class QueueBIO(object):
+    """Datagram BIO with a Python-managed outgoing queue
+
+    Datagrams written by OpenSSL are appended to the outgoing deque as
+    (payload, peer address) tuples. Datagrams are read from the incoming
+    deque, which the application fills with feed, and once it is empty, from
+    the read socket without blocking.
+
+    Methods:
+
+      ssl_bio -- create a reference to this BIO for SSL_set_bio
+      feed -- queue a datagram for OpenSSL to read
+      flush -- send the queued outgoing datagrams
+    """
+
+    def __init__(self, sock=None, peer_address=None, mtu=None, rsock=None):
+        """Constructor
+
+        Arguments:
+        sock -- socket through which flush sends; None if the application
+                drains the outgoing deque itself
+        peer_address -- address of the peer; when given, the BIO is
+                        connected to it; otherwise, the peer is the source of
+                        the datagram read last, as with an unconnected
+                        datagram BIO
+        mtu -- the maximum datagram payload length reported to OpenSSL
+        rsock -- socket from which to receive once the incoming deque is
+                 empty; defaults to sock
+        """
+
+        self.outgoing = deque()
+        self.incoming = deque()
+        self.peer_address = peer_address
+        self.connected = peer_address is not None
+        self.mtu = mtu or UDP_DEFAULT_MTU
+        self.next_timeout = None
+        self._sock = sock
+        self._rsock = rsock or sock
+        self._sender = None
+        self._bio = _BIO(BIO_new(_get_method()))
+        _instances[self._bio.raw] = ref(self)
+
+    def ssl_bio(self):
+        """Create a reference to this BIO for SSL_set_bio
+
+        Return:
+        an owned BIO wrapper
+        """
+
+        BIO_up_ref(self._bio.value)
+        return _BIO(self._bio.value)
+
+    def feed(self, payload, peer_address=None):
+        """Queue a datagram for OpenSSL to read
+
+        Arguments:
+        payload -- the datagram's payload
+        peer_address -- the address of the datagram's source
+        """
+
+        self.incoming.append((bytes(payload), peer_address))
+
+    def flush(self):
+        """Send the queued outgoing datagrams
+
+        Datagrams are sent in batches, until either all have been sent, or
+        the socket's send buffer is full. Datagrams that were not sent remain
+        queued.
+
+        Return:
+        the number of datagrams sent
+        """
+
+        if not self._sender:
+            self._sender = BatchSender(UDP_BATCH_SIZE)
+        sent = 0
+        while self.outgoing:
+            datagrams = list(self.outgoing)
+            try:
+                num = self._sender.send(self._sock, datagrams)
+            except socket.error as sock_err:
+                # DTLS recovers lost datagrams through retransmission
+                _logger.debug("Dropping datagram for peer %s: %s",
+                              datagrams[0][1], sock_err)
+                self.outgoing.popleft()
+                continue
+            for _ in range(num):
+                self.outgoing.popleft()
+            sent += num
+            if num < len(datagrams):
+                break
+        return sent
+
+    def _write(self, data):
+        if self.peer_address is None:
+            _logger.debug("Discarding %d bytes for unknown peer", len(data))
+        else:
+            self.outgoing.append((data, self.peer_address))
+        return len(data)
+
+    def _read(self, length):
+        if self.incoming:
+            payload, peer_address = self.incoming.popleft()
+        elif self._rsock:
+            # A socket with a timeout would wait for its datagram, regardless
+            # of the flags passed
+            timeout = self._rsock.gettimeout()
+            if timeout != 0:
+                self._rsock.settimeout(0)
+            try:
+                payload, peer_address = self._rsock.recvfrom(length)
+            except socket.error as sock_err:
+                if sock_err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return None
+                raise
+            finally:
+                if timeout != 0:
+                    self._rsock.settimeout(timeout)
+        else:
+            return None
+        if not self.connected and peer_address is not None:
+            self.peer_address = peer_address
+        return payload[:length]
+
+    def _ctrl(self, cmd, larg, parg):
+        if cmd == BIO_CTRL_RESET:
+            self.incoming.clear()
+            self.outgoing.clear()
+            return 1
+        if cmd == BIO_CTRL_PENDING:
+            return sum(len(i[0]) for i in self.incoming)
+        if cmd == BIO_CTRL_WPENDING:
+            return sum(len(i[0]) for i in self.outgoing)
+        if cmd in (BIO_CTRL_FLUSH, BIO_CTRL_DUP):
+            return 1
+        if cmd in (BIO_CTRL_DGRAM_CONNECT, BIO_CTRL_DGRAM_SET_PEER,
+                   BIO_CTRL_DGRAM_SET_CONNECTED):
+            if parg:
+                self.peer_address = addr_tuple_from_sockaddr_u(
+                    cast(parg, POINTER(sockaddr_u)).contents)
+            if cmd == BIO_CTRL_DGRAM_SET_CONNECTED:
+                self.connected = bool(parg)
+            return 1
+        if cmd == BIO_CTRL_DGRAM_GET_PEER:
+            if self.peer_address is None:
+                return 0
+            su = sockaddr_u_from_addr_tuple(self.peer_address)
+            size = sizeof(sockaddr_in6) if len(self.peer_address) > 2 \
+              else sizeof(sockaddr_in)
+            if larg and larg < size:
+                size = larg
+            memmove(parg, byref(su), size)
+            return size
+        if cmd in (BIO_CTRL_DGRAM_QUERY_MTU, BIO_CTRL_DGRAM_GET_MTU,
+                   BIO_CTRL_DGRAM_GET_FALLBACK_MTU):
+            return self.mtu
+        if cmd == BIO_CTRL_DGRAM_SET_MTU:
+            self.mtu = max(larg, _MIN_MTU)
+            return self.mtu
+        if cmd == BIO_CTRL_DGRAM_GET_MTU_OVERHEAD:
+            return 0  # the MTU is a payload length already
+        if cmd == BIO_CTRL_DGRAM_SET_NEXT_TIMEOUT:
+            tv = cast(parg, POINTER(TIMEVAL)).contents
+            if tv.tv_sec or tv.tv_usec:
+                self.next_timeout = tv.tv_sec + tv.tv_usec / 1000000.0
+            else:
+                self.next_timeout = None
+            return 0
+        # MTU discovery, exceeded-MTU reports, timer expiry, EOF, and the
+        # remaining operations do not apply
+        return 0
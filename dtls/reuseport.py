@@ -0,0 +1,250 @@
+# Reuseport steering: classic BPF programs that assign peers to the sockets
+# of a reuseport group.
+
+# Copyright 2017 Ray Brown
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# The License is also distributed with this work in the file named "LICENSE."
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reuseport Steering
+
+By default, the Linux kernel selects a socket of a reuseport group for a
+datagram by reducing a hash of the datagram's addresses modulo the number of
+sockets in the group. Whenever the group changes, most peers are therefore
+moved to another socket. This module builds classic BPF programs that select
+sockets by a bucket table instead: a peer's source address and port are
+hashed into one of a fixed number of buckets, and the table assigns each
+bucket to the index of a socket in the group. Tables can be grown and shrunk
+while moving only the buckets that must change hands.
+
+The kernel indexes the sockets of a group in the order in which they were
+bound, and fills the slot of a closed socket with the group's last socket.
+Steering is therefore only stable if the sockets are kept open, for example
+by a supervising process (see dtls.sharding). Socket indices that the program
+returns, but that do not exist in the group, select the kernel's default
+behavior.
+
+SO_ATTACH_REUSEPORT_CBPF requires Linux 4.5 or later.
+
+Functions:
+
+  assign_buckets -- create or rebalance a bucket table
+  peer_bucket -- compute the bucket of a peer address
+  steering_program -- build the BPF program for a bucket table
+  attach_steering -- attach a bucket table's program to a reuseport group
+"""
+
+import socket
+import struct
+from ctypes import Structure, POINTER, c_ushort, c_ubyte, c_uint32
+from ctypes import pointer, string_at, sizeof
+from logging import getLogger
+
+_logger = getLogger(__name__)
+
+SO_ATTACH_REUSEPORT_CBPF = getattr(socket, "SO_ATTACH_REUSEPORT_CBPF", 51)
+STEERING_BUCKETS = 256
+_HASH_MULTIPLIER = 0x9E3779B1  # golden ratio multiplicative hashing
+
+#
+# Classic BPF instruction encoding (linux/filter.h)
+#
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_ST = 0x02
+BPF_ALU = 0x04
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_MISC = 0x07
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MEM = 0x60
+BPF_MSH = 0xa0
+BPF_MUL = 0x20
+BPF_RSH = 0x70
+BPF_XOR = 0xa0
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_JGT = 0x20
+BPF_K = 0x00
+BPF_X = 0x08
+BPF_A = 0x10
+BPF_TAX = 0x00
+SKF_NET_OFF = -0x100000
+
+
+class _sock_filter(Structure):
+    _fields_ = [("code", c_ushort),
+                ("jt", c_ubyte),
+                ("jf", c_ubyte),
+                ("k", c_uint32)]
+
+
+class _sock_fprog(Structure):
+    _fields_ = [("len", c_ushort),
+                ("filter", POINTER(_sock_filter))]
+
+
+def _stmt(code, k=0):
+    return code, 0, 0, k & 0xffffffff
+
+
+def _jump(code, k, jt, jf):
+    return code, jt, jf, k & 0xffffffff
+
+
+def assign_buckets(workers, table=None, buckets=STEERING_BUCKETS):
+    """Create or rebalance a bucket table
+
+    Without a previous table, buckets are divided into contiguous, evenly
+    sized ranges. Given a previous table, buckets of socket indices that no
+    longer exist are reassigned, and buckets are taken from the sockets
+    holding the most until each socket holds its share; no other bucket
+    changes hands.
+
+    Arguments:
+    workers -- the number of sockets in the reuseport group
+    table -- a previous bucket table, or None
+    buckets -- the number of buckets of a new table
+
+    Return:
+    a list whose items are the socket indices of the buckets
+    """
+
+    assert workers > 0
+    if table is None:
+        return [bucket * workers // buckets for bucket in range(buckets)]
+    table = list(table)
+    share, extra = divmod(len(table), workers)
+    quota = [share + (index < extra) for index in range(workers)]
+    owned = [[] for _ in range(workers)]
+    free = []
+    for bucket, index in enumerate(table):
+        if index < workers:
+            owned[index].append(bucket)
+        else:
+            free.append(bucket)
+    for index in range(workers):
+        while len(owned[index]) > quota[index]:
+            free.append(owned[index].pop())
+    for index in range(workers):
+        while len(owned[index]) < quota[index]:
+            bucket = free.pop()
+            owned[index].append(bucket)
+            table[bucket] = index
+    return table
+
+
+def peer_bucket(address, buckets=STEERING_BUCKETS):
+    """Compute the bucket of a peer address
+
+    This mirrors the hash computed by the steering program in the kernel.
+    IPv4-mapped IPv6 addresses are hashed as the IPv4 addresses that their
+    datagrams carry.
+
+    Arguments:
+    address -- the peer's address tuple, as returned by recvfrom
+    buckets -- the number of buckets of the bucket table; a power of two
+
+    Return:
+    the peer's bucket
+    """
+
+    host, port = address[:2]
+    if ":" in host and not host.startswith("::ffff:"):
+        words = struct.unpack("!4I", socket.inet_pton(socket.AF_INET6, host))
+        addr = words[0] ^ words[1] ^ words[2] ^ words[3]
+    else:
+        addr = struct.unpack("!I", socket.inet_aton(host.split(":")[-1]))[0]
+    shift = 32 - (buckets.bit_length() - 1)
+    return (((addr ^ port) * _HASH_MULTIPLIER) & 0xffffffff) >> shift
+
+
+def steering_program(table):
+    """Build the BPF program for a bucket table
+
+    The program hashes the source address and port of the datagram into a
+    bucket, as does peer_bucket, and returns the bucket's socket index. It
+    handles both IPv4 and IPv6 datagrams.
+
+    Arguments:
+    table -- a bucket table, whose length is a power of two no greater than
+             65536
+
+    Return:
+    a list of (code, jt, jf, k) instructions
+    """
+
+    buckets = len(table)
+    assert buckets & (buckets - 1) == 0 and 1 < buckets <= 65536
+    prog = [
+        _stmt(BPF_LD | BPF_B | BPF_ABS, SKF_NET_OFF),
+        _stmt(BPF_ALU | BPF_RSH | BPF_K, 4),
+        _jump(BPF_JMP | BPF_JEQ | BPF_K, 6, 5, 0),
+        # IPv4: source address and port
+        _stmt(BPF_LD | BPF_W | BPF_ABS, SKF_NET_OFF + 12),
+        _stmt(BPF_ST, 0),
+        _stmt(BPF_LDX | BPF_B | BPF_MSH, SKF_NET_OFF),
+        _stmt(BPF_LD | BPF_H | BPF_IND, SKF_NET_OFF),
+        _stmt(BPF_JMP | BPF_JA, 12),
+        # IPv6: folded source address and port
+        _stmt(BPF_LD | BPF_W | BPF_ABS, SKF_NET_OFF + 8),
+        _stmt(BPF_MISC | BPF_TAX),
+        _stmt(BPF_LD | BPF_W | BPF_ABS, SKF_NET_OFF + 12),
+        _stmt(BPF_ALU | BPF_XOR | BPF_X),
+        _stmt(BPF_MISC | BPF_TAX),
+        _stmt(BPF_LD | BPF_W | BPF_ABS, SKF_NET_OFF + 16),
+        _stmt(BPF_ALU | BPF_XOR | BPF_X),
+        _stmt(BPF_MISC | BPF_TAX),
+        _stmt(BPF_LD | BPF_W | BPF_ABS, SKF_NET_OFF + 20),
+        _stmt(BPF_ALU | BPF_XOR | BPF_X),
+        _stmt(BPF_ST, 0),
+        _stmt(BPF_LD | BPF_H | BPF_ABS, SKF_NET_OFF + 40),
+        # Hash into a bucket
+        _stmt(BPF_LDX | BPF_MEM, 0),
+        _stmt(BPF_ALU | BPF_XOR | BPF_X),
+        _stmt(BPF_ALU | BPF_MUL | BPF_K, _HASH_MULTIPLIER),
+        _stmt(BPF_ALU | BPF_RSH | BPF_K, 32 - (buckets.bit_length() - 1)),
+    ]
+    # Look up the bucket's socket index in ranges of equal assignment
+    start = 0
+    for bucket in range(1, buckets + 1):
+        if bucket < buckets and table[bucket] == table[start]:
+            continue
+        if bucket < buckets:
+            prog.append(_jump(BPF_JMP | BPF_JGT | BPF_K, bucket - 1, 1, 0))
+        prog.append(_stmt(BPF_RET | BPF_K, table[start]))
+        start = bucket
+    return prog
+
+
+def attach_steering(sock, table):
+    """Attach a bucket table's program to a reuseport group
+
+    The program replaces any program previously attached to the group.
+
+    Arguments:
+    sock -- a socket of the reuseport group
+    table -- the bucket table
+    """
+
+    prog = steering_program(table)
+    filters = (_sock_filter * len(prog))(*prog)
+    fprog = _sock_fprog(len(prog), filters)
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF,
+                    string_at(pointer(fprog), sizeof(fprog)))
+    _logger.debug("Attached steering program of %d instructions", len(prog))
@@ -0,0 +1,349 @@
+# Sans-I/O DTLS: a protocol engine that is driven by its caller's datagrams.
+
+# Copyright 2017 Ray Brown
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# The License is also distributed with this work in the file named "LICENSE."
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sans-I/O DTLS
+
+This module implements the DTLS protocol for a single peer without performing
+any I/O. The engine's OpenSSL instance reads from and writes to a pair of
+memory BIO's; the caller moves datagrams between these and whatever transport
+it uses: it feeds the datagrams it receives from the peer into the engine,
+and sends the datagrams that the engine hands out. Retransmission timers are
+driven by the caller as well: it asks the engine for its timeout, and lets
+the engine handle the timeout once it has expired.
+
+Since the engine neither blocks nor calls back into the transport, it can be
+combined with any I/O loop, such as one built on recvmmsg, io_uring, or
+asyncio, and it can be exercised without sockets. Like SSLConnection's try_
+methods, the engine's methods return the status sentinels of the
+sslconnection module instead of raising exceptions when the engine must wait
+for the peer. Engines are not thread-safe.
+
+Classes:
+
+  SSLEngine -- sans-I/O DTLS peer association
+"""
+
+from logging import getLogger
+from .err import openssl_error, raise_ssl_error, SSL_ERROR_WANT_READ
+from .err import ERR_BOTH_KEY_CERT_FILES, ERR_BOTH_KEY_CERT_FILES_SVR
+from .openssl import *
+from .util import _BIO, _pack_records
+from .demux.membio import UDP_DEFAULT_MTU
+from .sslconnection import SSLConnection, SSL, _SSL, _CallbackProxy
+from .sslconnection import CERT_NONE, PROTOCOL_DTLS
+from .sslconnection import _STATUS
+
+_logger = getLogger(__name__)
+
+
+class SSLEngine(object):
+    """Sans-I/O DTLS peer association
+
+    This class wraps the same OpenSSL library state as SSLConnection, but
+    exchanges datagrams with its caller instead of a socket.
+
+    Methods:
+
+      clone -- create an engine for another peer
+      listen -- server-side cookie exchange with a new peer
+      receive_datagram -- feed a datagram received from the peer
+      datagrams_to_send -- take the datagrams to be sent to the peer
+      get_timeout -- retrieve the retransmission timedelta
+      handle_timeout -- retransmit after the timer has expired
+      do_handshake -- make progress on the handshake
+      read -- read application data
+      write -- write application data
+      shutdown -- send a close-notify alert
+      get_session -- retrieve the session for resumption
+      session_reused -- determine whether the handshake resumed a session
+    """
+
+    # SSL_CTX creation and configuration and connection queries are shared
+    # with SSLConnection, whose attribute names this class uses
+    _verify_mode = SSLConnection._verify_mode
+    _init_ssl_ctx = SSLConnection._init_ssl_ctx
+    _config_ssl_ctx = SSLConnection._config_ssl_ctx
+    get_timeout = SSLConnection.get_timeout
+    getpeercert = SSLConnection.getpeercert
+    cipher = SSLConnection.cipher
+    get_session = SSLConnection.get_session
+    session_reused = SSLConnection.session_reused
+    # Cookies are the ones of SSLConnection, so that a server's engines
+    # and connections verify each other's cookies
+    _make_cookie = SSLConnection._make_cookie
+    _generate_cookie_cb = SSLConnection._generate_cookie_cb
+    _verify_cookie_cb = SSLConnection._verify_cookie_cb
+
+    def __init__(self, server_side=False, keyfile=None, certfile=None,
+                 cert_reqs=CERT_NONE, ssl_version=PROTOCOL_DTLS,
+                 ca_certs=None, ciphers=None, peer_address=None,
+                 mtu=UDP_DEFAULT_MTU,
+                 cb_user_config_ssl_ctx=None, cb_user_config_ssl=None):
+        """Constructor
+
+        Arguments:
+        the arguments shared with SSLConnection have the same meaning, and
+        these are specific to this class:
+
+        peer_address -- the peer's address, which is paired with outgoing
+                        datagrams; if None, the source address of the first
+                        datagram received is used
+        mtu -- the maximum length of outgoing datagrams' payloads
+        """
+
+        if keyfile and not certfile or certfile and not keyfile:
+            raise_ssl_error(ERR_BOTH_KEY_CERT_FILES)
+        if server_side and not keyfile:
+            raise_ssl_error(ERR_BOTH_KEY_CERT_FILES_SVR)
+
+        self._server_side = server_side
+        self._keyfile = keyfile
+        self._certfile = certfile
+        self._cert_reqs = cert_reqs
+        self._ssl_version = ssl_version
+        self._ca_certs = ca_certs
+        self._ciphers = ciphers or "DEFAULT"
+        self._user_config_ssl_ctx = cb_user_config_ssl_ctx
+        self._handshake_done = False
+        self.peer_address = peer_address
+        self.mtu = mtu
+
+        self._init_ssl_ctx(self._verify_mode())
+
+        self._user_config_ssl = cb_user_config_ssl
+        self._cb_keepalive = None
+        self._init_ssl()
+
+    def _init_ssl(self):
+        self._ssl = _SSL(SSL_new(self._ctx.value))
+        self._intf_ssl = SSL(self._ssl.value)
+        if self._server_side:
+            SSL_set_accept_state(self._ssl.value)
+        else:
+            SSL_set_connect_state(self._ssl.value)
+        self._rbio = _BIO(BIO_new(BIO_s_mem()))
+        self._wbio = _BIO(BIO_new(BIO_s_mem()))
+        # Reading from an empty BIO must be retryable, not end of file
+        BIO_set_mem_eof_return(self._rbio.value, -1)
+        SSL_set_bio(self._ssl.value, self._rbio.value, self._wbio.value)
+        self._rbio.disown()
+        self._wbio.disown()
+        # Memory BIO's cannot be queried for the path MTU
+        SSL_set_options(self._ssl.value, SSL_OP_NO_QUERY_MTU)
+        DTLS_set_link_mtu(self._ssl.value, self.mtu)
+        if self._user_config_ssl:
+            self._user_config_ssl(self._intf_ssl)
+
+    def __del__(self):
+        if hasattr(self, "_ssl"):
+            remove_from_timer_callbacks(self._ssl.value)
+            del self._intf_ssl
+            del self._ssl
+
+    def clone(self, peer_address=None):
+        """Create an engine for another peer with this engine's configuration
+
+        The new engine shares this engine's SSL_CTX, so that certificates and
+        keys are loaded only once however many peers a server serves.
+
+        Arguments:
+        peer_address -- the new engine's peer address
+
+        Return:
+        the new SSLEngine instance
+        """
+
+        engine = SSLEngine.__new__(SSLEngine)
+        engine.__dict__.update(
+            (name, value) for name, value in self.__dict__.items()
+            if name not in ("_ssl", "_intf_ssl", "_rbio", "_wbio"))
+        engine._handshake_done = False
+        engine._cb_keepalive = None
+        engine.peer_address = peer_address
+        engine._init_ssl()
+        return engine
+
+    def listen(self, data, address):
+        """Server-side cookie exchange with a new peer
+
+        A datagram from an address without an engine of its own is fed to
+        this engine. A ClientHello without a valid cookie is answered with
+        a HelloVerifyRequest, which the caller takes from datagrams_to_send
+        and sends to the address. No state is kept for the address, so that
+        peers with spoofed addresses cannot use up a server's resources.
+
+        Arguments:
+        data -- the datagram's payload
+        address -- the datagram's source address
+
+        Return:
+        a new engine, created as with clone, which continues the handshake
+        with the peer whose cookie has been verified; None otherwise
+        """
+
+        if not self._cb_keepalive:
+            self._cb_keepalive = SSL_CTX_set_cookie_cb(
+                self._ctx.value,
+                _CallbackProxy(self._generate_cookie_cb),
+                _CallbackProxy(self._verify_cookie_cb))
+        self.peer_address = address
+        try:
+            SSL_set_options(self._ssl.value, SSL_OP_COOKIE_EXCHANGE)
+            BIO_write(self._rbio.value, bytes(data))
+            verified = DTLSv1_listen(self._ssl.value) is not None
+        except openssl_error() as err:
+            _logger.debug("Dropping datagram from %s: %s", address, err)
+            verified = False
+        if not verified:
+            if BIO_ctrl_pending(self._rbio.value):
+                # What is left of the datagram must not be read with the
+                # next one
+                self._init_ssl()
+            return
+        # The new engine continues the handshake with the instance that
+        # has read the peer's ClientHello; the cookie need not be verified
+        # again
+        engine = self.clone(address)
+        for name in "_ssl", "_intf_ssl", "_rbio", "_wbio":
+            value = getattr(self, name)
+            setattr(self, name, getattr(engine, name))
+            setattr(engine, name, value)
+        SSL_clear_options(engine._ssl.value, SSL_OP_COOKIE_EXCHANGE)
+        return engine
+
+    def _get_cookie(self, ssl):
+        return self._make_cookie(self.peer_address)
+
+    def receive_datagram(self, data, address=None):
+        """Feed a datagram received from the peer
+
+        Arguments:
+        data -- the datagram's payload
+        address -- the datagram's source address; datagrams from addresses
+                   other than the peer's are dropped
+
+        Return:
+        True if the datagram was accepted, False if it was dropped
+        """
+
+        if address is not None:
+            if self.peer_address is None:
+                self.peer_address = address
+            elif address != self.peer_address:
+                _logger.debug("Dropping datagram from non-peer %s", address)
+                return False
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        BIO_write(self._rbio.value, data)
+        return True
+
+    def datagrams_to_send(self):
+        """Take the datagrams to be sent to the peer
+
+        The records that OpenSSL has written since the last call are packed
+        into datagrams that do not exceed the MTU.
+
+        Return:
+        list of (payload, peer address) tuples
+        """
+
+        pending = BIO_ctrl_pending(self._wbio.value)
+        if not pending:
+            return []
+        data = BIO_read(self._wbio.value, pending)
+        return [(datagram, self.peer_address)
+                for datagram in _pack_records(data, self.mtu)]
+
+    def handle_timeout(self):
+        """Retransmit after the timer has expired
+
+        The retransmitted datagrams are subsequently returned by
+        datagrams_to_send.
+
+        Return:
+        True if datagrams were retransmitted, False if the timer had not
+        yet expired
+        """
+
+        return DTLSv1_handle_timeout(self._ssl.value)
+
+    def do_handshake(self):
+        """Make progress on the handshake
+
+        Return:
+        None if the handshake is complete, or one of the status sentinels
+        WANT_READ and ZERO_RETURN
+        """
+
+        ssl_error = SSL_do_handshake_status(self._ssl.value)
+        if ssl_error:
+            return _STATUS[ssl_error]
+        self._handshake_done = True
+
+    def read(self, len=1024, buffer=None):
+        """Read application data
+
+        Arguments:
+        len -- maximum number of bytes to read
+        buffer -- optional writable buffer to read into
+
+        Return:
+        string containing read bytes (the number of bytes read if a buffer
+        was given), or one of the status sentinels WANT_READ and ZERO_RETURN
+        """
+
+        ssl_error, ret = SSL_read_status(self._ssl.value, len, buffer)
+        if ssl_error:
+            return _STATUS[ssl_error]
+        return ret
+
+    def write(self, data):
+        """Write application data
+
+        Arguments:
+        data -- buffer containing data to be written
+
+        Return:
+        number of bytes written, or one of the status sentinels WANT_READ
+        and ZERO_RETURN
+        """
+
+        ssl_error, ret = SSL_write_status(self._ssl.value, data)
+        if ssl_error:
+            return _STATUS[ssl_error]
+        self._handshake_done = True
+        return ret
+
+    def shutdown(self):
+        """Send a close-notify alert
+
+        This method can be called again after the peer's datagrams have been
+        received, until the shutdown is complete.
+
+        Return:
+        True if the peer's close-notify alert has been received as well,
+        False otherwise
+        """
+
+        try:
+            SSL_shutdown(self._ssl.value)
+        except openssl_error() as err:
+            if err.result == 0 or err.ssl_error == SSL_ERROR_WANT_READ:
+                return False
+            raise
+        return True
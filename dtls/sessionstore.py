@@ -0,0 +1,231 @@
+# Session stores: server-side sessions shared among worker processes.
+
+# Copyright 2017 Ray Brown
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# The License is also distributed with this work in the file named "LICENSE."
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Session Stores
+
+A server context's session cache is local to its process. When several
+worker processes of a host serve the same clients, a client that reconnects
+to another worker than the one that negotiated its session cannot resume it.
+The stores of this module keep sessions outside of the worker processes.
+SSLContext.set_session_store installs a store's methods as OpenSSL's new,
+get and remove session callbacks, which exchange sessions in their DER
+encoding.
+
+Handshakes invoke these callbacks synchronously, on the thread that serves
+the connection. A store therefore never waits: lookups that cannot be
+completed at once report a miss, at the cost of a full handshake, and
+modifications are queued and applied in the background.
+
+Classes:
+
+  SessionStore -- interface of session stores
+  SQLiteSessionStore -- session store in a SQLite database file
+"""
+
+import sqlite3
+from abc import ABC, abstractmethod
+from logging import getLogger
+from queue import Queue, Full, Empty
+from threading import Thread, Lock, local
+from time import time
+
+_logger = getLogger(__name__)
+
+SESSION_STORE_SIZE = 1024 * 20
+SESSION_STORE_QUEUE_SIZE = 1024
+
+
+class SessionStore(ABC):
+    """Interface of session stores
+
+    Methods:
+
+      add -- store a new session
+      get -- retrieve a stored session
+      remove -- remove a session
+    """
+
+    @abstractmethod
+    def add(self, session_id, session, expires):
+        """Store a new session
+
+        Arguments:
+        session_id -- the session's id
+        session -- the session's DER encoding
+        expires -- the session's expiry time in seconds since the epoch
+        """
+
+    @abstractmethod
+    def get(self, session_id):
+        """Retrieve a stored session
+
+        Arguments:
+        session_id -- the id offered by a client
+
+        Return:
+        the session's DER encoding; None if the session is not available
+        """
+
+    @abstractmethod
+    def remove(self, session_id):
+        """Remove a session that must no longer be resumed
+
+        Arguments:
+        session_id -- the session's id
+        """
+
+
+class SQLiteSessionStore(SessionStore):
+    """Session store in a SQLite database file
+
+    The worker processes of a host each open a store on the same file. The
+    database is placed in write-ahead logging mode, in which lookups proceed
+    while another process writes. A lookup that finds the database locked
+    nevertheless fails immediately, rather than wait.
+
+    Added and removed sessions are queued to a writer thread, which commits
+    them in batches. When the queue is full, modifications are dropped: a
+    dropped session cannot be resumed by other workers, and a dropped
+    removal leaves a session in the store until it expires. After each
+    batch, the writer deletes expired sessions, and the sessions expiring
+    soonest in excess of the store's size.
+
+    Methods:
+
+      flush -- wait until queued modifications have been committed
+      close -- commit queued modifications and close the database
+    """
+
+    def __init__(self, path, size=SESSION_STORE_SIZE,
+                 queue_size=SESSION_STORE_QUEUE_SIZE):
+        """Constructor
+
+        Arguments:
+        path -- the database file, shared among processes
+        size -- maximum number of stored sessions
+        queue_size -- maximum number of queued modifications
+        """
+
+        self._path = path
+        self.size = size
+        self._readers = local()
+        self._reader_conns = []
+        self._reader_lock = Lock()
+        self._writes = Queue(queue_size)
+        # Unlike lookups, setting up may wait for other processes
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions "
+                         "(id BLOB PRIMARY KEY, session BLOB NOT NULL, "
+                         "expires REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires "
+                         "ON sessions (expires)")
+        self._writer = Thread(target=self._write_loop, args=(conn,),
+                              name="SQLiteSessionStore writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def add(self, session_id, session, expires):
+        self._enqueue((session_id, session, expires))
+
+    def get(self, session_id):
+        try:
+            row = self._reader().execute(
+                "SELECT session FROM sessions WHERE id = ? AND expires > ?",
+                (session_id, time())).fetchone()
+        except sqlite3.Error as err:
+            _logger.debug("Session lookup failed: %s", err)
+            return
+        if row:
+            return row[0]
+
+    def remove(self, session_id):
+        self._enqueue((session_id, None, None))
+
+    def flush(self):
+        """Wait until queued modifications have been committed"""
+
+        self._writes.join()
+
+    def close(self):
+        """Commit queued modifications and close the database
+
+        The writer thread stops, and lookups report misses.
+        """
+
+        if self._writer.is_alive():
+            self._writes.put(None)
+            self._writer.join()
+        with self._reader_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            del self._reader_conns[:]
+
+    def _reader(self):
+        # Each thread looks up through its own connection, which close
+        # closes; lookups must not wait
+        conn = getattr(self._readers, "conn", None)
+        if not conn:
+            conn = sqlite3.connect(self._path, timeout=0,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            with self._reader_lock:
+                self._reader_conns.append(conn)
+            self._readers.conn = conn
+        return conn
+
+    def _enqueue(self, write):
+        try:
+            self._writes.put_nowait(write)
+        except Full:
+            _logger.debug("Session store queue full, dropping modification")
+
+    def _write_loop(self, conn):
+        while True:
+            batch = [self._writes.get()]
+            try:
+                while True:
+                    batch.append(self._writes.get_nowait())
+            except Empty:
+                pass
+            stop = None in batch
+            try:
+                with conn:
+                    self._write(conn, [i for i in batch if i])
+            except sqlite3.Error as err:
+                _logger.warning("Session store write failed: %s", err)
+            for _ in batch:
+                self._writes.task_done()
+            if stop:
+                conn.close()
+                return
+
+    def _write(self, conn, batch):
+        for session_id, session, expires in batch:
+            if session is None:
+                conn.execute("DELETE FROM sessions WHERE id = ?",
+                             (session_id,))
+            else:
+                conn.execute("INSERT OR REPLACE INTO sessions "
+                             "VALUES (?, ?, ?)",
+                             (session_id, session, expires))
+        conn.execute("DELETE FROM sessions WHERE expires <= ?", (time(),))
+        conn.execute("DELETE FROM sessions WHERE id IN "
+                     "(SELECT id FROM sessions ORDER BY expires DESC "
+                     "LIMIT -1 OFFSET ?)", (self.size,))
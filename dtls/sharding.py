@@ -0,0 +1,260 @@
+# Sharded listeners: DTLS server worker processes sharing a port.
+
+# Copyright 2017 Ray Brown
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# The License is also distributed with this work in the file named "LICENSE."
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sharded DTLS Listeners
+
+This module runs a DTLS server as a number of worker processes. A supervisor
+binds a listening socket per worker to the same address with SO_REUSEPORT, and
+each worker runs its own listener on its socket. The kernel assigns datagrams
+from unknown peers to one of the listening sockets by a hash of the peer's
+address, so that a peer's cookie exchange is served by a single worker. Once
+the cookie exchange completes, the osnet demux of that worker connects a socket
+to the peer, and the kernel prefers that socket for the peer's datagrams.
+
+All workers are given the same cookie secret, so that a cookie issued by one
+worker is accepted by another, for example by the replacement of a worker
+that has exited. Certificate and other configuration is passed to every
+worker through the arguments of the worker target.
+
+SO_REUSEPORT is available on Linux and some BSD-derived platforms, but not on
+Windows.
+
+Classes:
+
+  ShardedServer -- supervisor of listening worker processes
+"""
+
+import socket
+import multiprocessing
+from multiprocessing.connection import wait
+from os import cpu_count
+from threading import Event
+from time import time
+from logging import getLogger
+from .sslconnection import SSLConnection
+from .reuseport import assign_buckets, attach_steering
+
+_logger = getLogger(__name__)
+
+
+def bind_reuseport(address, family=socket.AF_INET):
+    """Create a listening socket that shares its port
+
+    Arguments:
+    address -- the address to bind to
+    family -- the address family of the socket
+
+    Return:
+    a datagram socket bound to address with SO_REUSEADDR and SO_REUSEPORT
+    """
+
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise NotImplementedError("SO_REUSEPORT is not available on this " +
+                                  "platform")
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+def _run_worker(sock, cookie_key, target, args, kwargs):
+    SSLConnection._rnd_key = cookie_key
+    target(sock, *args, **kwargs)
+
+
+class ShardedServer(object):
+    """Listening worker process supervisor
+
+    This class binds a number of listening sockets to a common address, and
+    starts a worker process for each, which passes its socket to a target
+    callable. The target is expected to wrap the socket for DTLS and serve
+    peers for as long as the worker runs. Workers that exit are restarted
+    until the server is stopped.
+
+    The supervisor keeps the listening sockets open. Datagrams that arrive
+    for an exited worker are therefore queued for its replacement, and the
+    socket group is unchanged by the restart, so that no other peers are
+    moved among the workers. Optionally, the server steers peers with a
+    bucket table (see dtls.reuseport), so that adding workers moves as few
+    peers as possible, too.
+
+    Methods:
+
+      start -- start the worker processes
+      add_worker -- start an additional worker process
+      supervise -- restart workers that exit, until stopped
+      serve_forever -- start and supervise the worker processes
+      stop -- terminate the worker processes
+    """
+
+    def __init__(self, address, target, workers=None, family=socket.AF_INET,
+                 args=(), kwargs=None, restart_delay=1.0, cookie_key=None,
+                 steering=False):
+        """Constructor
+
+        Arguments:
+        address -- the address that the listening sockets bind to; if its
+                   port is zero, then a port is chosen when the server starts
+        target -- the callable run by each worker; it is invoked with the
+                  worker's bound listening socket, followed by args and
+                  kwargs; unless processes are forked, the target and its
+                  arguments must be picklable
+        workers -- the number of worker processes; defaults to the number of
+                   processors
+        family -- the address family of the listening sockets
+        args -- positional arguments passed to target
+        kwargs -- keyword arguments passed to target
+        restart_delay -- the minimum time in seconds between the exit of a
+                         worker and its replacement
+        cookie_key -- the secret from which workers derive DTLS cookies;
+                      defaults to the secret of this process
+        steering -- if True, then peers are assigned to workers by a BPF
+                    program attached to the listening sockets
+        """
+
+        self.address = address
+        self.family = family
+        self.workers = workers or cpu_count() or 1
+        self.sockets = []
+        self.processes = []
+        self.steering_table = None
+        self._target = target
+        self._args = args
+        self._kwargs = kwargs or {}
+        self._restart_delay = restart_delay
+        self._cookie_key = cookie_key or SSLConnection._rnd_key
+        self._steering = steering
+        self._stopped = Event()
+
+    def _bind(self):
+        sock = bind_reuseport(self.address, self.family)
+        # The kernel indexes the group's sockets in the order of binding
+        self.address = sock.getsockname()
+        self.sockets.append(sock)
+        self.processes.append(None)
+
+    def _steer(self):
+        self.steering_table = assign_buckets(len(self.sockets),
+                                             self.steering_table)
+        attach_steering(self.sockets[0], self.steering_table)
+
+    def _spawn(self, index):
+        process = multiprocessing.Process(
+            target=_run_worker,
+            args=(self.sockets[index], self._cookie_key, self._target,
+                  self._args, self._kwargs),
+            name="dtls-shard-%d" % index)
+        process.daemon = True
+        process.start()
+        self.processes[index] = process
+        _logger.debug("Started worker %d, pid: %d", index, process.pid)
+
+    def start(self):
+        """Start the worker processes
+
+        The listening sockets are bound before this method returns. If the
+        server's address has port zero, then the server's address is updated
+        with the chosen port.
+        """
+
+        self._stopped.clear()
+        try:
+            while len(self.sockets) < self.workers:
+                self._bind()
+            if self._steering:
+                self._steer()
+            for index in range(self.workers):
+                self._spawn(index)
+        except:
+            self.stop()
+            raise
+
+    def add_worker(self):
+        """Start an additional worker process
+
+        With steering, the new worker takes over buckets from the other
+        workers, but no bucket changes hands among them.
+
+        Return:
+        the index of the new worker
+        """
+
+        self._bind()
+        index = self.workers
+        self.workers += 1
+        if self._steering:
+            self._steer()
+        self._spawn(index)
+        return index
+
+    def supervise(self):
+        """Restart workers that exit
+
+        This method returns when the stop method is called, for example by
+        another thread or a signal handler.
+        """
+
+        restart_times = {}
+        while not self._stopped.is_set():
+            sentinels = [process.sentinel for process in self.processes
+                         if process.exitcode is None]
+            timeout = 0.5
+            if restart_times:
+                timeout = max(min(restart_times.values()) - time(), 0)
+            wait(sentinels, timeout)
+            if self._stopped.is_set():
+                break
+            for index, process in enumerate(self.processes):
+                if process.exitcode is not None and \
+                  index not in restart_times:
+                    _logger.warning("Worker %d exited with code %d",
+                                    index, process.exitcode)
+                    restart_times[index] = time() + self._restart_delay
+            for index, restart_time in list(restart_times.items()):
+                if restart_time <= time():
+                    del restart_times[index]
+                    self._spawn(index)
+
+    def serve_forever(self):
+        """Start the worker processes, and restart them until stopped"""
+
+        self.start()
+        try:
+            self.supervise()
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Terminate the worker processes, and close the listening sockets"""
+
+        self._stopped.set()
+        for process in self.processes:
+            if process and process.exitcode is None:
+                process.terminate()
+        for process in self.processes:
+            if process:
+                process.join()
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+        self.processes = []
@@ -27,11 +27,18 @@ DTLS server, and of a server with a DTLS client.
 Classes:
 
   SSLConnection -- DTLS peer association
+  ClientSessionCache -- client-side sessions for resumption, per server
 
 Integer constants:
 
   PROTOCOL_DTLSv1
 
+Status sentinels, returned by SSLConnection's try_ methods:
+
+  WANT_READ
+  WANT_WRITE
+  ZERO_RETURN
+
 The cert group must coincide in meaning and value with the one of the standard
 library's ssl module, since its values can be passed to this module.
 
@@ -44,23 +51,32 @@ import sys
 import errno
 import socket
 import hmac
-import datetime
 import hashlib
+from collections import deque, OrderedDict
 from logging import getLogger
-from os import urandom, fsencode
+from os import urandom, fsencode, strerror, stat
 from select import select
+try:
+    from select import poll, POLLIN, POLLOUT
+except ImportError:  # Windows
+    poll = None
+from threading import Lock
+from time import monotonic
 from weakref import proxy
 
 from .err import openssl_error, InvalidSocketError
 from .err import raise_ssl_error
 from .err import SSL_ERROR_WANT_READ, SSL_ERROR_SYSCALL
+from .err import SSL_ERROR_WANT_WRITE, SSL_ERROR_ZERO_RETURN
 from .err import ERR_WRONG_VERSION_NUMBER, ERR_COOKIE_MISMATCH, ERR_NO_SHARED_CIPHER, ERR_SHUTDOWN_IN_INIT
 from .err import ERR_NO_CIPHER, ERR_HANDSHAKE_TIMEOUT, ERR_PORT_UNREACHABLE
 from .err import ERR_READ_TIMEOUT, ERR_WRITE_TIMEOUT
 from .err import ERR_BOTH_KEY_CERT_FILES, ERR_BOTH_KEY_CERT_FILES_SVR, ERR_NO_CERTS
 from .x509 import _X509, decode_cert
 from .openssl import *
-from .util import _Rsrc, _BIO
+from .util import _Rsrc, _BIO, _pack_records, _count_records
+from .demux.membio import UDPDemux as _MemoryDemux, UDP_DEFAULT_MTU
+from .pybio import QueueBIO
 
 _logger = getLogger(__name__)
 
@@ -71,6 +87,43 @@ CERT_NONE = 0
 CERT_OPTIONAL = 1
 CERT_REQUIRED = 2
 
+_MAX_RECORD_PLAINTEXT = 16384  # SSL3_RT_MAX_PLAIN_LENGTH
+SSL_SESSION_CACHE_SIZE = 1024 * 20  # SSL_SESSION_CACHE_MAX_SIZE_DEFAULT
+SSL_SESSION_TIMEOUT = 300  # seconds, OpenSSL's default for (D)TLS 1.2
+CLIENT_SESSION_CACHE_SIZE = 256
+CLIENT_CONTEXT_CACHE_SIZE = 64
+
+
+def _wait_socket(sock, writable, timeout):
+    # Wait until a socket is readable, or writable; unlike select, poll
+    # handles descriptors beyond FD_SETSIZE
+    if poll:
+        poller = poll()
+        poller.register(sock, POLLOUT if writable else POLLIN)
+        if timeout is not None:
+            timeout = max(timeout, 0) * 1000
+        return bool(poller.poll(timeout))
+    if writable:
+        return bool(select([], [sock], [], timeout)[1])
+    return bool(select([sock], [], [], timeout)[0])
+
+
+class _Status(object):
+    """Outcome of a try_ method that did not complete"""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __repr__(self):
+        return self._name
+
+WANT_READ = _Status("WANT_READ")
+WANT_WRITE = _Status("WANT_WRITE")
+ZERO_RETURN = _Status("ZERO_RETURN")
+_STATUS = {SSL_ERROR_WANT_READ: WANT_READ,
+           SSL_ERROR_WANT_WRITE: WANT_WRITE,
+           SSL_ERROR_ZERO_RETURN: ZERO_RETURN}
+
 #
 # One-time global OpenSSL library initialization
 #
@@ -147,6 +200,9 @@ class _CTX(_Rsrc):
 
     def __del__(self):
         _logger.debug("Freeing SSL CTX: %d", self.raw)
+        # The info callback lives as long as the context, however many
+        # connections share it
+        remove_from_info_callback(self._value)
         SSL_CTX_free(self._value)
         self._value = None
 
@@ -163,6 +219,148 @@ class _SSL(_Rsrc):
         self._value = None
 
 
+class _SSL_SESSION(_Rsrc):
+    """SSL_SESSION wrapper"""
+    def __init__(self, value):
+        _logger.debug("Allocating SSL_SESSION: %d", value.raw)
+        super(_SSL_SESSION, self).__init__(value)
+
+    def __del__(self):
+        _logger.debug("Freeing SSL_SESSION: %d", self.raw)
+        SSL_SESSION_free(self._value)
+        self._value = None
+
+
+class ClientSessionCache(object):
+    """Client-side sessions for resumption, per server
+
+    Client connections that share a cache offer the session of the last
+    connection to the same server when they connect to it again. Sessions
+    are keyed by the server's address and the server name indicated, if any.
+    The least recently used sessions are evicted beyond the cache's size.
+
+    A session whose resumption fails is invalidated: when the server
+    declines it, the session of the full handshake replaces it, and when the
+    handshake fails, it is removed. The session of a connection that is
+    closed without being shut down cannot be resumed.
+
+    Methods:
+
+      get -- retrieve the session for a server
+      put -- store the session of a completed handshake
+      invalidate -- remove a session whose resumption failed
+      get_stats -- retrieve the cache's counters
+    """
+
+    def __init__(self, size=CLIENT_SESSION_CACHE_SIZE):
+        self.size = size
+        self._sessions = OrderedDict()
+        self._lock = Lock()
+        self._hits = self._misses = self._invalidations = 0
+
+    def get(self, key):
+        """Retrieve the session for a server
+
+        Arguments:
+        key -- tuple of the server's address and server name
+
+        Return:
+        the session; None if no session is cached for the server
+        """
+
+        with self._lock:
+            session = self._sessions.get(key)
+            if session:
+                self._sessions.move_to_end(key)
+            else:
+                self._misses += 1
+            return session
+
+    def put(self, key, session, reused):
+        """Store the session of a completed handshake
+
+        Arguments:
+        key -- tuple of the server's address and server name
+        session -- the connection's session
+        reused -- whether the handshake resumed the cached session
+        """
+
+        with self._lock:
+            if reused:
+                self._hits += 1
+            self._sessions[key] = session
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.size:
+                self._sessions.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove a session whose resumption failed
+
+        Arguments:
+        key -- tuple of the server's address and server name
+        """
+
+        with self._lock:
+            if self._sessions.pop(key, None):
+                self._invalidations += 1
+
+    def get_stats(self):
+        """Retrieve the cache's counters
+
+        Return:
+        dict with the number of cached sessions ("size"), resumed handshakes
+        ("hits"), connections to servers without a cached session ("misses"),
+        and sessions invalidated because their resumption failed
+        ("invalidations")
+        """
+
+        with self._lock:
+            return {"size": len(self._sessions),
+                    "hits": self._hits,
+                    "misses": self._misses,
+                    "invalidations": self._invalidations}
+
+
+class _ContextCache(object):
+    """Library contexts shared among client connections
+
+    Entries are keyed by the configuration that client connections apply
+    to their contexts. Each entry also records the modification times of
+    the configuration's certificate, key and CA files; when one of them
+    has changed, the entry is discarded, and the next connection loads the
+    files again. A discarded context is freed once the last connection
+    sharing it has been freed. Beyond the cache's size, the least recently
+    used entries are discarded.
+    """
+
+    def __init__(self, size=CLIENT_CONTEXT_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, config, mtimes):
+        with self._lock:
+            entry = self._entries.get(config)
+            if entry and entry[0] == mtimes:
+                self._entries.move_to_end(config)
+                return entry[1]
+            if entry:
+                del self._entries[config]
+
+    def put(self, config, mtimes, contexts):
+        with self._lock:
+            self._entries[config] = mtimes, contexts
+            self._entries.move_to_end(config)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_context_cache = _ContextCache()
+
+
 class _CallbackProxy(object):
     """Callback gateway to an SSLConnection object
 
@@ -266,6 +464,89 @@ class SSLContext(object):
         retVal = SSL_CTX_build_cert_chain(self._ctx, flags)
         return retVal
 
+    def set_session_cache(self, size=SSL_SESSION_CACHE_SIZE,
+                          timeout=SSL_SESSION_TIMEOUT, session_id_context=None):
+        u''' Enable the server-side session cache for abbreviated handshakes
+
+        Used for server only! Connections accepted from a listening
+        connection share its context, and therefore its cache. Clients that
+        offer a cached session resume it without a certificate exchange and
+        without key agreement. Session tickets are disabled, so that every
+        resumption is served by, and counted against, this cache.
+
+        :param int size: Maximum number of cached sessions; the oldest are evicted beyond it
+        :param int timeout: Lifetime of cached sessions in seconds
+        :param bytes session_id_context: Sessions resume only on contexts with the same value, default "PyDTLS"
+        :return: 1 for success and 0 for failure
+        '''
+        SSL_CTX_set_session_cache_mode(self._ctx, SSL_SESS_CACHE_SERVER)
+        SSL_CTX_sess_set_cache_size(self._ctx, size)
+        SSL_CTX_set_timeout(self._ctx, timeout)
+        SSL_CTX_set_options(self._ctx, SSL_OP_NO_TICKET)
+        return self._set_session_id_context(session_id_context)
+
+    def set_session_store(self, store, timeout=SSL_SESSION_TIMEOUT,
+                          session_id_context=None):
+        u''' Keep server-side sessions in an external session store
+
+        Used for server only! Instead of the context's own cache, sessions
+        are looked up in, added to, and removed from the store, which the
+        worker processes of a host can share. Session tickets are disabled,
+        so that clients resume through the store.
+
+        :param store: The store, such as a dtls.sessionstore.SQLiteSessionStore
+        :param int timeout: Lifetime of sessions in seconds
+        :param bytes session_id_context: Sessions resume only on contexts with the same value, default "PyDTLS"
+        :return: 1 for success and 0 for failure
+        '''
+        SSL_CTX_set_session_cache_mode(
+            self._ctx, SSL_SESS_CACHE_SERVER | SSL_SESS_CACHE_NO_INTERNAL)
+        SSL_CTX_set_timeout(self._ctx, timeout)
+        SSL_CTX_set_options(self._ctx, SSL_OP_NO_TICKET)
+        # The callbacks must live as long as the library context
+        self._session_store_cbs = SSL_CTX_sess_set_callbacks(
+            self._ctx, store.add, store.get, store.remove)
+        return self._set_session_id_context(session_id_context)
+
+    def set_session_tickets(self, key_ring, session_id_context=None):
+        u''' Issue and accept session tickets encrypted with a key ring's keys
+
+        Used for server only! The server keeps no session state: clients
+        present tickets, which any server whose key ring derives the same
+        keys, and whose context has the same session id context, decrypts
+        and resumes. Tickets encrypted with a key that is no longer current
+        are replaced with new ones.
+
+        :param key_ring: Source of ticket keys, such as a dtls.tickets.TicketKeyRing
+        :param bytes session_id_context: Sessions resume only on contexts with the same value, default "PyDTLS"
+        :return: 1 for success and 0 for failure
+        '''
+        # The callback must live as long as the library context
+        self._ticket_key_cb = SSL_CTX_set_tlsext_ticket_key_cb(
+            self._ctx, key_ring.get_key)
+        SSL_CTX_clear_options(self._ctx, SSL_OP_NO_TICKET)
+        return self._set_session_id_context(session_id_context)
+
+    def _set_session_id_context(self, session_id_context):
+        if session_id_context is None:
+            session_id_context = b"PyDTLS"
+        return SSL_CTX_set_session_id_context(self._ctx, session_id_context,
+                                              len(session_id_context))
+
+    def get_session_stats(self):
+        u''' Retrieve the counters of the server-side session cache
+
+        :return: dict with the number of cached sessions ("size"), resumed
+                 handshakes ("hits"), sessions offered but not found
+                 ("misses"), sessions offered after expiry ("timeouts"), and
+                 sessions evicted because the cache was full ("evictions")
+        '''
+        return {"size": SSL_CTX_sess_number(self._ctx),
+                "hits": SSL_CTX_sess_hits(self._ctx),
+                "misses": SSL_CTX_sess_misses(self._ctx),
+                "timeouts": SSL_CTX_sess_timeouts(self._ctx),
+                "evictions": SSL_CTX_sess_cache_full(self._ctx)}
+
     def set_ssl_logging(self, enable=False, func=_ssl_logging_cb):
         u''' Enable or disable SSL logging
 
@@ -282,6 +563,7 @@ class SSL(object):
 
     def __init__(self, ssl):
         self._ssl = ssl
+        self.auto_mtu = False
 
     def set_mtu(self, mtu=None):
         if mtu:
@@ -301,10 +583,34 @@ class SSL(object):
             _logger.debug("set mtu to query mode for ssl: %d", self._ssl.raw)
             SSL_clear_options(self._ssl, SSL_OP_NO_QUERY_MTU)
 
+    def set_auto_mtu(self, enable=True):
+        """Follow the kernel's path MTU on connected sockets
+
+        With this mode enabled, a connection whose socket is connected to its
+        peer turns on path MTU discovery, and sets its MTU to the one the
+        kernel reports for the peer. The MTU is refreshed whenever a write
+        fails because the datagram exceeded it.
+        """
+
+        _logger.debug("set auto mtu to: %s for ssl: %d", enable, self._ssl.raw)
+        self.auto_mtu = enable
+        if enable:
+            SSL_clear_options(self._ssl, SSL_OP_NO_QUERY_MTU)
+
     def DTLS_set_timer_cb(self, cb):
         _logger.debug("set timer callback to: %s for ssl: %d", repr(cb), self._ssl.raw)
         DTLS_set_timer_cb(self._ssl, _CallbackProxy(cb))
 
+    def set_session(self, session):
+        """Offer a session for resumption during the next handshake
+
+        The session is one retrieved from a previous connection's get_session
+        method. If the server no longer holds it, a full handshake ensues.
+        """
+
+        _logger.debug("set session for ssl: %d", self._ssl.raw)
+        SSL_set_session(self._ssl, session.value)
+
 
 class SSLConnection(object):
     """DTLS peer association
@@ -315,6 +621,35 @@ class SSLConnection(object):
 
     _rnd_key = urandom(16)
 
+    def _verify_mode(self):
+        if self._cert_reqs == CERT_NONE:
+            return SSL_VERIFY_NONE
+        if not self._server_side:
+            return SSL_VERIFY_PEER
+        if self._cert_reqs == CERT_OPTIONAL:
+            return SSL_VERIFY_PEER | SSL_VERIFY_CLIENT_ONCE
+        return SSL_VERIFY_PEER | SSL_VERIFY_CLIENT_ONCE | \
+          SSL_VERIFY_FAIL_IF_NO_PEER_CERT
+
+    def _init_ssl_ctx(self, verify_mode):
+        if self._server_side:
+            method = DTLS_server_method
+            if self._ssl_version == PROTOCOL_DTLSv1_2:
+                method = DTLSv1_2_server_method
+            elif self._ssl_version == PROTOCOL_DTLSv1:
+                method = DTLSv1_server_method
+        else:
+            # No "any" client method exists, therefore use v1_2 (highest
+            # possible)
+            method = DTLSv1_2_client_method
+            if self._ssl_version == PROTOCOL_DTLSv1:
+                method = DTLSv1_client_method
+        self._ctx = _CTX(SSL_CTX_new(method()))
+        self._intf_ssl_ctx = SSLContext(self._ctx.value)
+        if self._server_side:
+            SSL_CTX_set_session_cache_mode(self._ctx.value, SSL_SESS_CACHE_OFF)
+        self._config_ssl_ctx(verify_mode)
+
     def _config_ssl_ctx(self, verify_mode):
         SSL_CTX_set_verify(self._ctx.value, verify_mode)
         SSL_CTX_set_read_ahead(self._ctx.value, 1)
@@ -344,43 +679,42 @@ class SSLConnection(object):
         if (self._sock.type & socket.SOCK_DGRAM) != socket.SOCK_DGRAM:
             raise InvalidSocketError("sock must be of type SOCK_DGRAM")
 
-        self._wbio = _BIO(BIO_new_dgram(self._sock.fileno(), BIO_NOCLOSE))
         if peer_address:
             # We are connected directly to a client peer, bypassing the demux
             rsock = self._sock
+            self._wbio = _BIO(BIO_new_dgram(self._sock.fileno(), BIO_NOCLOSE))
             BIO_dgram_set_connected(self._wbio.value, peer_address)
         else:
             # We are starting an UDP listening socket
             from .demux import UDPDemux
-            self._udp_demux = UDPDemux(self._sock)
-            rsock = self._udp_demux.get_connection(None)
+            self._udp_demux = UDPDemux(self._sock, **self._demux_options)
+            if getattr(self._udp_demux, "shared", None):
+                # Peers beyond the demux's fd budget share the root socket;
+                # the listening connection must therefore read it through
+                # the shared demux, too
+                self._socket_demux = self._udp_demux
+                self._udp_demux = self._socket_demux.shared
+            if isinstance(self._udp_demux, _MemoryDemux):
+                self._mem_channel = self._udp_demux.get_connection(None)
+                self._rbio, self._wbio = self._mem_channel.ssl_bios()
+                rsock = None
+            else:
+                self._wbio = _BIO(BIO_new_dgram(self._sock.fileno(),
+                                                BIO_NOCLOSE))
+                rsock = self._udp_demux.get_connection(None)
         if rsock is self._sock:
             self._rbio = self._wbio
-        else:
+        elif rsock:
             _logger.debug("Init server with rsock != self._sock")
             self._rsock = rsock
             self._rbio = _BIO(BIO_new_dgram(self._rsock.fileno(), BIO_NOCLOSE))
-        server_method = DTLS_server_method
-        if self._ssl_version == PROTOCOL_DTLSv1_2:
-            server_method = DTLSv1_2_server_method
-        elif self._ssl_version == PROTOCOL_DTLSv1:
-            server_method = DTLSv1_server_method
-        self._ctx = _CTX(SSL_CTX_new(server_method()))
-        self._intf_ssl_ctx = SSLContext(self._ctx.value)
-        SSL_CTX_set_session_cache_mode(self._ctx.value, SSL_SESS_CACHE_OFF)
-        if self._cert_reqs == CERT_NONE:
-            verify_mode = SSL_VERIFY_NONE
-        elif self._cert_reqs == CERT_OPTIONAL:
-            verify_mode = SSL_VERIFY_PEER | SSL_VERIFY_CLIENT_ONCE
-        else:
-            verify_mode = SSL_VERIFY_PEER | SSL_VERIFY_CLIENT_ONCE | \
-              SSL_VERIFY_FAIL_IF_NO_PEER_CERT
-        self._config_ssl_ctx(verify_mode)
+        self._init_ssl_ctx(self._verify_mode())
         if not peer_address:
             # Configure UDP listening socket
             self._listening = False
             self._listening_peer_address = None
             self._pending_peer_address = None
+            self._accept_queue = deque()
             self._cb_keepalive = SSL_CTX_set_cookie_cb(
                 self._ctx.value,
                 _CallbackProxy(self._generate_cookie_cb),
@@ -388,6 +722,8 @@ class SSLConnection(object):
         self._ssl = _SSL(SSL_new(self._ctx.value))
         self._intf_ssl = SSL(self._ssl.value)
         SSL_set_accept_state(self._ssl.value)
+        if self._mem_channel:
+            self._config_memory_ssl(self._ssl)
         if self._user_config_ssl:
             self._user_config_ssl(self._intf_ssl)
         if peer_address and self._do_handshake_on_connect:
@@ -400,55 +736,104 @@ class SSLConnection(object):
 
         self._wbio = _BIO(BIO_new_dgram(self._sock.fileno(), BIO_NOCLOSE))
         self._rbio = self._wbio
-        client_method = DTLSv1_2_client_method  # no "any" exists, therefore use v1_2 (highest possible)
-        if self._ssl_version == PROTOCOL_DTLSv1_2:
-            client_method = DTLSv1_2_client_method
-        elif self._ssl_version == PROTOCOL_DTLSv1:
-            client_method = DTLSv1_client_method
-        self._ctx = _CTX(SSL_CTX_new(client_method()))
-        self._intf_ssl_ctx = SSLContext(self._ctx.value)
-        if self._cert_reqs == CERT_NONE:
-            verify_mode = SSL_VERIFY_NONE
+        verify_mode = self._verify_mode()
+        cache_key = None
+        if self._ctx_cache_key is not None:
+            cache_key = self._ctx_cache_config(verify_mode)
+        contexts = cache_key and _context_cache.get(*cache_key)
+        if contexts:
+            self._ctx, self._intf_ssl_ctx = contexts
         else:
-            verify_mode = SSL_VERIFY_PEER
-        self._config_ssl_ctx(verify_mode)
+            self._init_ssl_ctx(verify_mode)
+            if cache_key:
+                _context_cache.put(cache_key[0], cache_key[1],
+                                   (self._ctx, self._intf_ssl_ctx))
         self._ssl = _SSL(SSL_new(self._ctx.value))
         self._intf_ssl = SSL(self._ssl.value)
         SSL_set_connect_state(self._ssl.value)
+        if self._server_hostname:
+            SSL_set_tlsext_host_name(self._ssl.value,
+                                     self._server_hostname.encode("idna"))
         if self._user_config_ssl:
             self._user_config_ssl(self._intf_ssl)
         if peer_address:
             return lambda: self.connect(peer_address)
 
+    def _ctx_cache_config(self, verify_mode):
+        files = self._certfile, self._keyfile, self._ca_certs
+        try:
+            mtimes = tuple(stat(name).st_mtime_ns if name else None
+                           for name in files)
+        except OSError:
+            return  # loading the files will report the error
+        return (self._server_side, self._ssl_version, files, self._ciphers,
+                verify_mode, self._ctx_cache_key), mtimes
+
     def _copy_server(self):
         source = self._sock
         self._udp_demux = source._udp_demux
-        rsock = self._udp_demux.get_connection(source._pending_peer_address)
         self._ctx = source._ctx
         self._ssl = source._ssl
         self._intf_ssl_ctx = source._intf_ssl_ctx
         self._intf_ssl = source._intf_ssl
-        new_source_wbio = _BIO(BIO_new_dgram(source._sock.fileno(), BIO_NOCLOSE))
-        if hasattr(source, "_rsock"):
-            _logger.debug("Copy server with rsock != self._sock")
-            self._sock = source._sock
-            self._rsock = rsock
-            self._wbio = _BIO(BIO_new_dgram(self._sock.fileno(), BIO_NOCLOSE))
-            self._rbio = _BIO(BIO_new_dgram(self._rsock.fileno(), BIO_NOCLOSE))
-            new_source_rbio = _BIO(BIO_new_dgram(source._rsock.fileno(), BIO_NOCLOSE))
-            BIO_dgram_set_peer(self._wbio.value, source._pending_peer_address)
-            BIO_dgram_set_connected(self._rbio.value, source._pending_peer_address)
-        else:
+        rsock = None
+        if source._socket_demux:
+            rsock = source._socket_demux.get_connection(
+                source._pending_peer_address)
+        if rsock:
+            # Within the fd budget, the new peer is served through a
+            # connected socket, and the channel stays with the listener
+            self._udp_demux = source._socket_demux
+            self._demux_peer_address = source._pending_peer_address
             self._sock = rsock
             self._wbio = _BIO(BIO_new_dgram(self._sock.fileno(), BIO_NOCLOSE))
             self._rbio = self._wbio
-            new_source_rbio = new_source_wbio
             BIO_dgram_set_connected(self._wbio.value, source._pending_peer_address)
+            new_source_rbio, new_source_wbio = \
+              source._mem_channel.ssl_bios()
+        elif source._mem_channel:
+            # The listening SSL instance keeps its memory BIO's, and the
+            # channel follows it to the new peer
+            self._mem_channel = self._udp_demux.adopt_connection(
+                source._pending_peer_address)
+            self._sock = source._sock.dup()
+            self._sock.settimeout(None)  # as are other demuxes' connections
+            self._rbio = source._rbio
+            self._wbio = source._wbio
+            source._mem_channel = self._udp_demux.get_connection(None)
+            new_source_rbio, new_source_wbio = \
+              source._mem_channel.ssl_bios()
+        else:
+            rsock = self._udp_demux.get_connection(
+                source._pending_peer_address)
+            new_source_wbio = _BIO(BIO_new_dgram(source._sock.fileno(),
+                                                 BIO_NOCLOSE))
+            if hasattr(source, "_rsock"):
+                _logger.debug("Copy server with rsock != self._sock")
+                self._sock = source._sock
+                self._rsock = rsock
+                self._wbio = _BIO(BIO_new_dgram(self._sock.fileno(), BIO_NOCLOSE))
+                self._rbio = _BIO(BIO_new_dgram(self._rsock.fileno(), BIO_NOCLOSE))
+                new_source_rbio = _BIO(BIO_new_dgram(source._rsock.fileno(), BIO_NOCLOSE))
+                BIO_dgram_set_peer(self._wbio.value, source._pending_peer_address)
+                BIO_dgram_set_connected(self._rbio.value, source._pending_peer_address)
+                self._udp_demux.connections.set_owner(
+                    source._pending_peer_address, self._evicted_cb)
+            else:
+                self._demux_peer_address = source._pending_peer_address
+                self._sock = rsock
+                self._wbio = _BIO(BIO_new_dgram(self._sock.fileno(), BIO_NOCLOSE))
+                self._rbio = self._wbio
+                new_source_rbio = new_source_wbio
+                BIO_dgram_set_connected(self._wbio.value, source._pending_peer_address)
         source._ssl = _SSL(SSL_new(self._ctx.value))
         source._intf_ssl = SSL(source._ssl.value)
         SSL_set_accept_state(source._ssl.value)
+        if source._mem_channel:
+            source._config_memory_ssl(source._ssl)
         if self._user_config_ssl:
             self._user_config_ssl(self._intf_ssl)  # Why is this not source._intf_ssl? If it is, then the mtu size is not set correctly!?
+        self._update_path_mtu()
         source._rbio = new_source_rbio
         source._wbio = new_source_wbio
         SSL_set_bio(source._ssl.value, new_source_rbio.value, new_source_wbio.value)
@@ -473,8 +858,56 @@ class SSLConnection(object):
         if self._do_handshake_on_connect:
             return lambda: self.do_handshake()
 
+    def _config_memory_ssl(self, ssl):
+        # Memory BIO's cannot be queried for the path MTU
+        SSL_set_options(ssl.value, SSL_OP_NO_QUERY_MTU)
+        DTLS_set_link_mtu(ssl.value, self._udp_demux.mtu)
+
+    def _library_call(self, call):
+        if not self._mem_channel:
+            return call()
+        with self._udp_demux.lock:
+            try:
+                return call()
+            finally:
+                self._mem_channel.flush()
+
+    def _wrap_memory_library_call(self, call, timeout_error):
+        # With memory BIO's, OpenSSL never blocks: this connection receives
+        # from the shared root socket itself whenever OpenSSL wants to read,
+        # and drives retransmission timers in the meantime
+        timeout_sec = self._sock.gettimeout()
+        if timeout_sec is not None:
+            deadline = monotonic() + timeout_sec
+        while True:
+            try:
+                return self._library_call(call)
+            except openssl_error() as err:
+                if err.ssl_error != SSL_ERROR_WANT_READ:
+                    raise
+                if timeout_sec == 0:
+                    if not self._udp_demux.receive(0, self._mem_channel):
+                        raise
+                    continue
+            wait_sec = None
+            if timeout_sec is not None:
+                wait_sec = deadline - monotonic()
+                if wait_sec <= 0:
+                    raise_ssl_error(timeout_error)
+            dtls_timeout = DTLSv1_get_timeout(self._ssl.value)
+            if dtls_timeout is not None:
+                dtls_wait_sec = dtls_timeout.total_seconds()
+                if wait_sec is None or dtls_wait_sec < wait_sec:
+                    wait_sec = dtls_wait_sec
+            if not self._udp_demux.receive(wait_sec, self._mem_channel) and \
+              dtls_timeout is not None:
+                self._library_call(
+                    lambda: DTLSv1_handle_timeout(self._ssl.value))
+
     def _check_nbio(self):
         timeout = self._sock.gettimeout()
+        if self._mem_channel:
+            return timeout  # memory BIO's never block
         if self._wbio_nb != timeout is not None:
             BIO_set_nbio(self._wbio.value, timeout is not None)
             self._wbio_nb = timeout is not None
@@ -485,34 +918,110 @@ class SSLConnection(object):
                 self._rbio_nb = timeout is not None
         return timeout  # read channel timeout
 
+    def _wrap_queue_library_call(self, call, timeout_error):
+        # Queue BIO's never block either: this connection flushes the queue
+        # and waits for the read socket whenever OpenSSL wants to read
+        rsock = self.get_socket(True)
+        timeout_sec = rsock.gettimeout()
+        if timeout_sec is not None:
+            deadline = monotonic() + timeout_sec
+        while True:
+            try:
+                return call()
+            except openssl_error() as err:
+                if err.ssl_error != SSL_ERROR_WANT_READ or timeout_sec == 0:
+                    raise
+            self._queue_bio.flush()
+            wait_sec = None
+            if timeout_sec is not None:
+                wait_sec = deadline - monotonic()
+                if wait_sec <= 0:
+                    raise_ssl_error(timeout_error)
+            dtls_timeout = DTLSv1_get_timeout(self._ssl.value)
+            if dtls_timeout is not None:
+                dtls_wait_sec = dtls_timeout.total_seconds()
+                if wait_sec is None or dtls_wait_sec < wait_sec:
+                    wait_sec = dtls_wait_sec
+            if not _wait_socket(rsock, False, wait_sec) and \
+              dtls_timeout is not None:
+                DTLSv1_handle_timeout(self._ssl.value)
+
     def _wrap_socket_library_call(self, call, timeout_error):
-        timeout_sec_start = timeout_sec = self._check_nbio()
+        self._check_evicted()
+        if self._mem_channel:
+            return self._wrap_memory_library_call(call, timeout_error)
+        if self._queue_bio:
+            return self._wrap_queue_library_call(call, timeout_error)
+        timeout_sec = self._check_nbio()
         # Pass the call if the socket is blocking or non-blocking
         if not timeout_sec:  # None (blocking) or zero (non-blocking)
             return call()
-        start_time = datetime.datetime.now()
-        read_sock = self.get_socket(True)
-        need_select = False
-        while timeout_sec > 0:
-            if need_select:
-                if not select([read_sock], [], [], timeout_sec)[0]:
-                    break
-                timeout_sec = timeout_sec_start - \
-                  (datetime.datetime.now() - start_time).total_seconds()
+        deadline = monotonic() + timeout_sec
+        while True:
             try:
                 return call()
             except openssl_error() as err:
                 if err.ssl_error == SSL_ERROR_WANT_READ:
-                    need_select = True
+                    sock, writable = self.get_socket(True), False
+                elif err.ssl_error == SSL_ERROR_WANT_WRITE:
+                    self._check_mtu_exceeded()
+                    sock, writable = self._sock, True
+                else:
+                    raise
+            wait_sec = deadline - monotonic()
+            if wait_sec <= 0:
+                break
+            # Wake up for handshake retransmissions that fall due earlier
+            dtls_timeout = DTLSv1_get_timeout(self._ssl.value)
+            if dtls_timeout is not None:
+                dtls_wait_sec = dtls_timeout.total_seconds()
+                if dtls_wait_sec < wait_sec:
+                    if not _wait_socket(sock, writable, dtls_wait_sec):
+                        DTLSv1_handle_timeout(self._ssl.value)
                     continue
-                raise
+            if not _wait_socket(sock, writable, wait_sec):
+                break
         raise_ssl_error(timeout_error)
 
+    def _try_library_call(self, call):
+        # A single attempt for the try_ methods; with memory BIO's, whatever
+        # datagrams are waiting on the shared socket are fed in first
+        self._check_evicted()
+        if not self._mem_channel:
+            self._check_nbio()
+            return call()
+        while True:
+            ssl_error, ret = self._library_call(call)
+            if ssl_error != SSL_ERROR_WANT_READ or \
+              not self._udp_demux.receive(0, self._mem_channel):
+                return ssl_error, ret
+
+    def _check_evicted(self):
+        if self._evicted:
+            # The demux has closed this connection's read socket, whose
+            # descriptor may since have been reused
+            raise socket.error(errno.ECONNRESET,
+                               "Connection evicted by the demux")
+
+    def _evicted_cb(self, peer_address):
+        _logger.debug("Connection to peer %s evicted by the demux",
+                      peer_address)
+        self._evicted = True
+
     def _get_cookie(self, ssl):
         _logger.debug("Get cookie for ssl: %d", ssl.raw)
         rbio = SSL_get_rbio(ssl)
-        peer_address = BIO_dgram_get_peer(rbio)
-        cookie_hmac = hmac.new(self._rnd_key, str(peer_address).encode(), hashlib.md5)
+        peer_address = None
+        if self._mem_channel:
+            peer_address = self._udp_demux.get_peer(rbio)
+        if peer_address is None:
+            # Connections within an fd budget read from datagram BIO's
+            peer_address = BIO_dgram_get_peer(rbio)
+        return self._make_cookie(peer_address)
+
+    @classmethod
+    def _make_cookie(cls, peer_address):
+        cookie_hmac = hmac.new(cls._rnd_key, str(peer_address).encode(), hashlib.md5)
         return cookie_hmac.digest()
 
     def _generate_cookie_cb(self, ssl):
@@ -528,12 +1037,30 @@ class SSLConnection(object):
                  do_handshake_on_connect=True,
                  suppress_ragged_eofs=True, ciphers=None,
                  cb_user_config_ssl_ctx=None,
-                 cb_user_config_ssl=None):
+                 cb_user_config_ssl=None,
+                 demux_options=None,
+                 server_hostname=None,
+                 session_cache=None,
+                 ctx_cache_key=None):
         """Constructor
 
         Arguments:
         these arguments match the ones of the SSLSocket class in the
-        standard library's ssl module
+        standard library's ssl module, with the following additions:
+
+        demux_options -- dictionary of keyword arguments for the UDP demux
+                         constructor of a listening server-side connection,
+                         for example {"batch_size": 64}
+        server_hostname -- client-side server name indication
+        session_cache -- client-side ClientSessionCache, through which the
+                         connection offers the session of the last connection
+                         to the same server, and stores its own
+        ctx_cache_key -- client-side hashable value that identifies the
+                         configuration applied by cb_user_config_ssl_ctx;
+                         client connections with equal configurations and
+                         keys share a library context, instead of each
+                         loading its certificate, key and CA files. None
+                         disables sharing.
         """
 
         if keyfile and not certfile or certfile and not keyfile:
@@ -558,11 +1085,24 @@ class SSLConnection(object):
         self._handshake_done = False
         self._wbio_nb = self._rbio_nb = False
         self._server_side = server_side
+        self._mem_channel = None
+        self._socket_demux = None
+        self._demux_peer_address = None
+        self._evicted = False
+        self._path_mtu = None
+        self._queue_bio = None
 
         self._user_config_ssl_ctx = cb_user_config_ssl_ctx
         self._intf_ssl_ctx = None
         self._user_config_ssl = cb_user_config_ssl
         self._intf_ssl = None
+        self._demux_options = demux_options or {}
+        self._server_hostname = server_hostname
+        self._session_cache = session_cache
+        self._session_key = None
+        self._session_offered = False
+        self._connect_address = None
+        self._ctx_cache_key = ctx_cache_key
 
         if isinstance(sock, SSLConnection):
             post_init = self._copy_server()
@@ -590,12 +1130,13 @@ class SSLConnection(object):
             post_init()
 
     def close(self):
+        if self._mem_channel:
+            self._udp_demux.remove_connection(
+                None if hasattr(self, "_listening") else
+                self._mem_channel.peer_address)
         if hasattr(self, '_rsock'):
-            try:
-                peer_address = BIO_dgram_get_peer(self._wbio.value)
-            except AssertionError:
-                pass
-            else:
+            peer_address = BIO_dgram_get_peer(self._wbio.value)
+            if peer_address is not None:
                 conn = self._udp_demux.remove_connection(peer_address)
                 if conn:
                     conn.close()
@@ -604,12 +1145,13 @@ class SSLConnection(object):
                 if conn:
                     conn.close()
             self._rsock.close()
+        if self._demux_peer_address:
+            self._udp_demux.remove_connection(self._demux_peer_address)
         if not self._server_side:
             self._sock.close()
 
     def __del__(self):
         remove_from_timer_callbacks(self._ssl.value)
-        remove_from_info_callback(self._ctx.value)
         if hasattr(self, '_ssl'):
             del self._intf_ssl
             del self._ssl
@@ -632,6 +1174,83 @@ class SSLConnection(object):
             return self._rsock
         return self._sock
 
+    def _update_path_mtu(self):
+        # Apply the kernel's path MTU in auto mode; the query fails, and
+        # nothing changes, unless the write BIO is on a connected socket
+        if not self._intf_ssl or not self._intf_ssl.auto_mtu:
+            return
+        BIO_dgram_mtu_discover(self._wbio.value)
+        mtu = BIO_dgram_query_mtu(self._wbio.value)
+        if mtu > 0 and mtu != self._path_mtu:
+            _logger.debug("Path mtu for ssl: %d is now: %d",
+                          self._ssl.raw, mtu)
+            SSL_set_mtu(self._ssl.value, mtu)
+            self._path_mtu = mtu
+
+    def _check_mtu_exceeded(self):
+        # A datagram exceeding the path MTU fails to send as if it should be
+        # retried; the record was dropped, so raise, and size later writes by
+        # the refreshed MTU
+        if BIO_dgram_mtu_exceeded(self._wbio.value):
+            self._update_path_mtu()
+            raise socket.error(errno.EMSGSIZE, strerror(errno.EMSGSIZE))
+
+    def get_path_mtu(self):
+        """Retrieve the path MTU applied in auto mode
+
+        Return: the largest DTLS record, in bytes, that fits in a datagram
+        to the peer, or None if auto mode has not determined it
+        """
+
+        return self._path_mtu
+
+    def use_queue_bio(self, mtu=None):
+        """Route this connection's datagrams through a queue BIO
+
+        The connection's datagram BIO's are replaced with a Python queue BIO
+        on the same sockets: see the pybio module. The records that OpenSSL
+        writes are then queued instead of being sent, until the application
+        calls the queue BIO's flush method, or until this connection is about
+        to wait for the peer on a blocking socket or one with a timeout: it
+        then flushes the queue itself. Listening connections and connections
+        served by the memory BIO demux do not support queue BIO's.
+
+        Arguments:
+        mtu -- the maximum datagram payload length; defaults to the path MTU
+               in auto mode, or else to a size that is safe on IPv4 and IPv6
+               paths
+
+        Return:
+        the QueueBIO instance
+        """
+
+        if self._mem_channel or hasattr(self, "_listening"):
+            raise ValueError("Connection does not support queue BIO's")
+        if self._queue_bio:
+            return self._queue_bio
+        self._queue_bio = QueueBIO(self._sock,
+                                   BIO_dgram_get_peer(self._wbio.value),
+                                   mtu or self._path_mtu,
+                                   self.get_socket(True))
+        bio = self._queue_bio.ssl_bio()
+        SSL_set_bio(self._ssl.value, bio.value, bio.value)
+        bio.disown()
+        self._rbio = self._wbio = bio
+        if mtu:
+            SSL_set_mtu(self._ssl.value, mtu)
+        return self._queue_bio
+
+    def get_demux_stats(self):
+        """Retrieve the counters of a listening connection's demux
+
+        Return: a dictionary of counters (see the demux's get_stats method),
+        or None if the demux keeps no counters
+        """
+
+        demux = self._socket_demux or getattr(self, "_udp_demux", None)
+        if hasattr(demux, "get_stats"):
+            return demux.get_stats()
+
     def listen(self):
         """Server-side cookie exchange
 
@@ -671,8 +1290,10 @@ class SSLConnection(object):
         # The demux advises that a datagram from a new peer may have arrived
         if type(peer_address) is tuple:
             # For this type of demux, the write BIO must be pointed at the peer
-            BIO_dgram_set_peer(self._wbio.value, peer_address)
-            BIO_dgram_set_connected(self._rbio.value, peer_address)
+            # (the memory BIO demux points the listening channel itself)
+            if not self._mem_channel:
+                BIO_dgram_set_peer(self._wbio.value, peer_address)
+                BIO_dgram_set_connected(self._rbio.value, peer_address)
             self._udp_demux.forward()
             self._listening_peer_address = peer_address
 
@@ -680,11 +1301,12 @@ class SSLConnection(object):
         self._listening = True
         try:
             _logger.debug("Invoking DTLSv1_listen for ssl: %d", self._ssl.raw)
-            start_time = datetime.datetime.now()
+            start_time = monotonic()
             while True:
-                dtls_peer_address = DTLSv1_listen(self._ssl.value)
+                dtls_peer_address = self._library_call(
+                    lambda: DTLSv1_listen(self._ssl.value))
                 if timeout:
-                    if (datetime.datetime.now() - start_time).total_seconds() > timeout:
+                    if monotonic() - start_time > timeout:
                         break
                 if type(dtls_peer_address) is tuple:
                     break
@@ -719,29 +1341,91 @@ class SSLConnection(object):
         _logger.debug("New peer: %s", _pending_peer_address)
         return _pending_peer_address
 
-    def accept(self):
-        """Server-side UDP connection establishment
+    def drain(self, max_datagrams=None, max_time=None):
+        """Server-side cookie exchange for the datagrams at hand
 
-        This method returns a server-side SSLConnection object, connected to
-        that peer most recently returned from the listen method and not yet
-        connected. If there is no such peer, then the listen method is invoked.
+        This method services the listening socket as do repeated calls to
+        the listen method, until no more datagrams are available, or until
+        one of the given budgets is exhausted. Datagrams for known peers are
+        forwarded along the way. Only the first datagram is awaited according
+        to the socket's blocking mode and timeout.
 
-        Return value: SSLConnection connected to a new peer, None if packet
-        forwarding only to an existing peer occurred.
+        Connections are created for new peers whose cookie exchange
+        concludes, and are queued for the accept method, which returns them
+        in order before listening for further peers.
+
+        With the platform-native demux, OpenSSL reads from the listening
+        socket itself, and continues a new peer's cookie exchange with that
+        peer's next datagram. The listening socket should therefore be
+        non-blocking when used with this method.
+
+        Arguments:
+        max_datagrams -- the maximum number of times the socket is serviced;
+                         with batched demux servicing, a batch of datagrams
+                         counts once; None for no limit
+        max_time -- the time in seconds after which no more datagrams are
+                    serviced; None for no limit
+
+        Return:
+        a list of the addresses of new peers, whose connections are ready
+        to be returned by the accept method
         """
 
-        new_peer = self.listen()
-        if not new_peer:
-            _logger.debug("Accept returning without connection")
-            return
+        if not hasattr(self, "_listening"):
+            raise InvalidSocketError("drain called on non-listening socket")
+
+        if max_time is not None:
+            deadline = monotonic() + max_time
+        new_peers = []
+        serviced = 0
+        while max_datagrams is None or serviced < max_datagrams:
+            if serviced and not self._udp_demux.new_peer_pending() and \
+              not _wait_socket(self._sock, False, 0):
+                break
+            new_peer = self.listen()
+            serviced += 1
+            if new_peer:
+                self._accept_queue.append(
+                    (self._accept_connection(new_peer), new_peer))
+                new_peers.append(new_peer)
+            if max_time is not None and monotonic() >= deadline:
+                break
+        _logger.debug("Drain serviced %d times, new peers: %d",
+                      serviced, len(new_peers))
+        return new_peers
+
+    def _accept_connection(self, new_peer):
         self._pending_peer_address = new_peer
-        new_conn = SSLConnection(self, self._keyfile, self._certfile, True,
+        try:
+            return SSLConnection(self, self._keyfile, self._certfile, True,
                                  self._cert_reqs, self._ssl_version,
                                  self._ca_certs, self._do_handshake_on_connect,
                                  self._suppress_ragged_eofs, self._ciphers,
                                  cb_user_config_ssl_ctx=self._user_config_ssl_ctx,
                                  cb_user_config_ssl=self._user_config_ssl)
-        self._pending_peer_address = None
+        finally:
+            self._pending_peer_address = None
+
+    def accept(self):
+        """Server-side UDP connection establishment
+
+        This method returns a server-side SSLConnection object, connected to
+        a new peer. Connections queued by the drain method are returned
+        first, in order. Otherwise, the listen method is invoked, and a
+        connection to the new peer that it encounters, if any, is returned.
+
+        Return value: SSLConnection connected to a new peer, None if packet
+        forwarding only to an existing peer occurred.
+        """
+
+        if self._accept_queue:
+            new_conn, new_peer = self._accept_queue.popleft()
+        else:
+            new_peer = self.listen()
+            if not new_peer:
+                _logger.debug("Accept returning without connection")
+                return
+            new_conn = self._accept_connection(new_peer)
         if self._do_handshake_on_connect:
             # Note that since that connection's socket was just created in its
             # constructor, the following operation must be blocking; hence
@@ -763,10 +1447,12 @@ class SSLConnection(object):
         peer_address - address tuple of server peer
         """
 
+        self._connect_address = peer_address
         self._sock.connect(peer_address)
         peer_address = self._sock.getpeername()  # substituted host addrinfo
         BIO_dgram_set_connected(self._wbio.value, peer_address)
         assert self._wbio is self._rbio
+        self._update_path_mtu()
         if self._do_handshake_on_connect:
             self.do_handshake()
 
@@ -779,9 +1465,9 @@ class SSLConnection(object):
 
         _logger.debug("Initiating handshake...")
         try:
-            self._wrap_socket_library_call(
+            self._session_call(lambda: self._wrap_socket_library_call(
                 lambda: SSL_do_handshake(self._ssl.value),
-                ERR_HANDSHAKE_TIMEOUT)
+                ERR_HANDSHAKE_TIMEOUT))
         except openssl_error() as err:
             if err.ssl_error == SSL_ERROR_SYSCALL and err.result == -1:
                 raise_ssl_error(ERR_PORT_UNREACHABLE, err)
@@ -789,6 +1475,57 @@ class SSLConnection(object):
         self._handshake_done = True
         _logger.debug("...completed handshake")
 
+    def _session_call(self, call):
+        # Every call that can perform a client's handshake goes through
+        # here: a cached session is offered before the handshake starts, and
+        # once it has completed, the negotiated session is stored, or one
+        # that failed to resume is invalidated
+        if self._handshake_done or self._session_cache is None or \
+          self._server_side:
+            return call()
+        if self._session_key is None:
+            self._offer_cached_session()
+            if self._session_key is None:
+                return call()
+        try:
+            ret = call()
+        except openssl_error() as err:
+            if self._session_offered and \
+              err.ssl_error not in (SSL_ERROR_WANT_READ, SSL_ERROR_WANT_WRITE):
+                self._session_cache.invalidate(self._session_key)
+                self._session_offered = False
+            raise
+        if SSL_is_init_finished(self._ssl.value):
+            self._cache_session()
+            self._handshake_done = True
+        return ret
+
+    def _offer_cached_session(self):
+        try:
+            peer_address = self._sock.getpeername()
+        except socket.error:
+            # Unconnected sockets have no peer name; the address that
+            # connect was given identifies the server
+            peer_address = self._connect_address
+            if peer_address is None:
+                return
+        self._session_key = peer_address, self._server_hostname
+        session = self._session_cache.get(self._session_key)
+        if session:
+            _logger.debug("Offering cached session for %s",
+                          self._session_key)
+            SSL_set_session(self._ssl.value, session.value)
+            self._session_offered = True
+
+    def _cache_session(self):
+        reused = self.session_reused()
+        if self._session_offered and not reused:
+            # The server declined the session; its new one replaces it
+            self._session_cache.invalidate(self._session_key)
+        session = self.get_session()
+        if session:
+            self._session_cache.put(self._session_key, session, reused)
+
     def read(self, len=1024, buffer=None):
         """Read data from connection
 
@@ -801,13 +1538,71 @@ class SSLConnection(object):
         """
 
         try:
-            return self._wrap_socket_library_call(
-                lambda: SSL_read(self._ssl.value, len, buffer), ERR_READ_TIMEOUT)
+            return self._session_call(lambda: self._wrap_socket_library_call(
+                lambda: SSL_read(self._ssl.value, len, buffer),
+                ERR_READ_TIMEOUT))
         except openssl_error() as err:
             if err.ssl_error == SSL_ERROR_SYSCALL and err.result == -1:
                 raise_ssl_error(ERR_PORT_UNREACHABLE, err)
             raise
 
+    def read_many(self, max_records=None, max_bytes=None):
+        """Read the records buffered on the connection
+
+        With read-ahead, a single datagram can carry several records. This
+        method reads a first record just as read does, and then keeps reading
+        records for as long as the connection has buffered data, without
+        waiting for the socket.
+
+        Arguments:
+        max_records -- maximum number of records to read; None for no limit
+        max_bytes -- maximum total number of bytes to read; None for no limit
+
+        Return value:
+        list of strings containing the bytes of each record read; empty if
+        max_bytes is not positive
+        """
+
+        def length():
+            if max_bytes is None:
+                return _MAX_RECORD_PLAINTEXT
+            return min(max_bytes - total, _MAX_RECORD_PLAINTEXT)
+
+        if max_bytes is not None and max_bytes <= 0:
+            return []
+        total = 0
+        scratch = bytearray(length())
+        view = memoryview(scratch)
+        nbytes = self.read(len(scratch), scratch)
+        payloads = [bytes(view[:nbytes])]
+        total += nbytes
+        read_sock = self.get_socket(True)
+        blocking = not self._mem_channel and read_sock.gettimeout() is None
+        try:
+            while (max_records is None or len(payloads) < max_records) and \
+              (max_bytes is None or total < max_bytes) and \
+              (SSL_pending(self._ssl.value) or
+               SSL_has_pending(self._ssl.value)):
+                if blocking:
+                    # Buffered records must not wait for the socket
+                    read_sock.settimeout(0)
+                try:
+                    ssl_error, nbytes = self._library_call(
+                        lambda: SSL_read_status(self._ssl.value, length(),
+                                                scratch))
+                except openssl_error() as err:
+                    if err.ssl_error == SSL_ERROR_SYSCALL and err.result == -1:
+                        raise_ssl_error(ERR_PORT_UNREACHABLE, err)
+                    raise
+                if ssl_error:
+                    break
+                payloads.append(bytes(view[:nbytes]))
+                total += nbytes
+        finally:
+            if blocking:
+                read_sock.settimeout(None)
+        return payloads
+
     def write(self, data):
         """Write data to connection
 
@@ -821,9 +1616,10 @@ class SSLConnection(object):
         """
 
         try:
-            ret = self._wrap_socket_library_call(
-                lambda: SSL_write(self._ssl.value, data), ERR_WRITE_TIMEOUT)
+            ret = self._session_call(lambda: self._wrap_socket_library_call(
+                lambda: SSL_write(self._ssl.value, data), ERR_WRITE_TIMEOUT))
         except openssl_error() as err:
+            self._check_mtu_exceeded()
             if err.ssl_error == SSL_ERROR_SYSCALL and err.result == -1:
                 raise_ssl_error(ERR_PORT_UNREACHABLE, err)
             raise
@@ -833,6 +1629,183 @@ class SSLConnection(object):
             self._handshake_done = True
         return ret
 
+    def write_many(self, messages, mtu=None):
+        """Write several messages, packing their records into few datagrams
+
+        Each message is written as a record of its own, as with write, but
+        the records are sent together in as few datagrams as the MTU allows.
+        Writing stops at the first message that cannot be written; an error
+        is raised only if that is the first message. Sending stops at the
+        first datagram that cannot be sent, as write would fail for its
+        records; the messages whose records were not sent are reported as
+        not written, and an error is raised only if no datagram was sent.
+
+        Arguments:
+        messages -- sequence of buffers containing the messages
+        mtu -- maximum datagram payload length; defaults to the path MTU in
+               auto mode, or else to a size that is safe on IPv4 and IPv6
+               paths; connections served by the memory BIO demux use the
+               demux's MTU instead
+
+        Return value:
+        list of the number of bytes written for each message, 0 for messages
+        that were not written
+        """
+
+        self._check_evicted()
+        messages = list(messages)
+        if self._mem_channel:
+            # Records written under one library call are flushed together
+            return self._session_call(lambda: self._library_call(
+                lambda: self._write_records(messages)))
+        wbio = self._wbio.value
+        mem_bio = _BIO(BIO_new(BIO_s_mem()))
+        # Stand in for the write BIO, which keeps a reference meanwhile
+        BIO_up_ref(mem_bio.value)
+        BIO_up_ref(wbio)
+        SSL_set0_wbio(self._ssl.value, mem_bio.value)
+        try:
+            results = self._session_call(
+                lambda: self._write_records(messages))
+        finally:
+            SSL_set0_wbio(self._ssl.value, wbio)
+        pending = BIO_ctrl_pending(mem_bio.value)
+        if not pending:
+            return results
+        datagrams = _pack_records(BIO_read(mem_bio.value, pending),
+                                  mtu or self._path_mtu or UDP_DEFAULT_MTU)
+        if self._queue_bio:
+            for datagram in datagrams:
+                self._queue_bio._write(datagram)
+            return results
+        if hasattr(self, "_rsock"):
+            # Routed connections write through the unconnected socket
+            peer_address = BIO_dgram_get_peer(wbio)
+            send = lambda datagram: self._sock.sendto(datagram, peer_address)
+        else:
+            send = self._sock.send
+        for index, datagram in enumerate(datagrams):
+            try:
+                self._send_datagram(send, datagram)
+            except socket.error as err:
+                if not index and not isinstance(err, BlockingIOError):
+                    raise
+                # The unsent records used up their sequence numbers as lost
+                # datagrams would; their messages were not written
+                sent = sum(_count_records(i) for i in datagrams[:index])
+                _logger.debug("write_many sent %d of %d datagrams: %s",
+                              index, len(datagrams), err)
+                return results[:sent] + [0] * (len(results) - sent)
+        return results
+
+    def _send_datagram(self, send, datagram):
+        # Fail as write fails when the datagram BIO sends a record: the
+        # socket's timeout applies, a full send buffer of a non-blocking
+        # socket raises BlockingIOError, and an exceeded path MTU is refreshed
+        try:
+            send(datagram)
+        except socket.timeout:
+            raise_ssl_error(ERR_WRITE_TIMEOUT)
+        except socket.error as err:
+            if err.errno == errno.EMSGSIZE:
+                self._update_path_mtu()
+            elif err.errno == errno.ECONNREFUSED:
+                raise_ssl_error(ERR_PORT_UNREACHABLE, err)
+            raise
+
+    def _write_records(self, messages):
+        results = []
+        for message in messages:
+            try:
+                ssl_error, written = SSL_write_status(self._ssl.value, message)
+            except openssl_error():
+                if not results:
+                    raise
+                break
+            if ssl_error:
+                break
+            results.append(written)
+        if results:
+            self._handshake_done = True
+        return results + [0] * (len(messages) - len(results))
+
+    def try_handshake(self):
+        """Attempt to make progress on the handshake without blocking
+
+        This method is intended for event loops on non-blocking sockets: the
+        outcomes that call for waiting are returned instead of being raised
+        as exceptions, which are reserved for real errors.
+
+        Return value:
+        None if the handshake is complete, or one of the status sentinels
+        WANT_READ, WANT_WRITE and ZERO_RETURN
+        """
+
+        try:
+            ssl_error = self._session_call(lambda: self._try_library_call(
+                lambda: (SSL_do_handshake_status(self._ssl.value), None)))[0]
+        except openssl_error() as err:
+            if err.ssl_error == SSL_ERROR_SYSCALL and err.result == -1:
+                raise_ssl_error(ERR_PORT_UNREACHABLE, err)
+            raise
+        if ssl_error:
+            return _STATUS[ssl_error]
+        self._handshake_done = True
+
+    def try_read(self, len=1024, buffer=None):
+        """Attempt to read from the connection without blocking
+
+        As with try_handshake, outcomes that call for waiting are returned
+        instead of being raised.
+
+        Arguments:
+        len -- maximum number of bytes to read
+        buffer -- optional writable buffer to read into
+
+        Return value:
+        string containing read bytes (the number of bytes read if a buffer
+        was given), or one of the status sentinels WANT_READ, WANT_WRITE and
+        ZERO_RETURN
+        """
+
+        try:
+            ssl_error, ret = self._session_call(lambda: self._try_library_call(
+                lambda: SSL_read_status(self._ssl.value, len, buffer)))
+        except openssl_error() as err:
+            if err.ssl_error == SSL_ERROR_SYSCALL and err.result == -1:
+                raise_ssl_error(ERR_PORT_UNREACHABLE, err)
+            raise
+        if ssl_error:
+            return _STATUS[ssl_error]
+        return ret
+
+    def try_write(self, data):
+        """Attempt to write to the connection without blocking
+
+        As with try_handshake, outcomes that call for waiting are returned
+        instead of being raised.
+
+        Arguments:
+        data -- buffer containing data to be written
+
+        Return value:
+        number of bytes actually transmitted, or one of the status sentinels
+        WANT_READ, WANT_WRITE and ZERO_RETURN
+        """
+
+        try:
+            ssl_error, ret = self._session_call(lambda: self._try_library_call(
+                lambda: SSL_write_status(self._ssl.value, data)))
+        except openssl_error() as err:
+            if err.ssl_error == SSL_ERROR_SYSCALL and err.result == -1:
+                raise_ssl_error(ERR_PORT_UNREACHABLE, err)
+            raise
+        if ssl_error:
+            self._check_mtu_exceeded()
+            return _STATUS[ssl_error]
+        self._handshake_done = True
+        return ret
+
     def shutdown(self):
         """Shut down the DTLS connection
 
@@ -946,6 +1919,23 @@ class SSLConnection(object):
 
         return SSL_pending(self._ssl.value)
 
+    def get_session(self):
+        """Retrieve the session negotiated by the handshake
+
+        The session can be offered for resumption to a new connection to the
+        same server through its SSL interface's set_session method. Return
+        None if handshaking has not been completed.
+        """
+
+        session = SSL_get1_session(self._ssl.value)
+        if session:
+            return _SSL_SESSION(session)
+
+    def session_reused(self):
+        """Determine whether the handshake resumed an earlier session"""
+
+        return bool(SSL_session_reused(self._ssl.value))
+
     def get_timeout(self):
         """Retrieve the retransmission timedelta
 
@@ -976,7 +1966,8 @@ class SSLConnection(object):
         Raised when retransmissions fail or too many timeouts occur.
         """
 
-        return DTLSv1_handle_timeout(self._ssl.value)
+        return self._library_call(
+            lambda: DTLSv1_handle_timeout(self._ssl.value))
 
     def unwrap(self):
         try:
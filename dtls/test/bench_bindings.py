@@ -0,0 +1,153 @@
+# Binding overhead micro-benchmark for PyDTLS.
+
+# Copyright 2017 Ray Brown
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# The License is also distributed with this work in the file named "LICENSE."
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""PyDTLS binding overhead micro-benchmark
+
+This script measures the per-call cost of the data plane's OpenSSL calls,
+through the checked bindings that _make_function creates (before), and
+through the fast bindings and their wrappers (after). The checked bindings
+convert every SSL argument through FuncParam.from_param and run their errcheck
+hooks; the fast ones take raw handles.
+
+A client and a server engine of the sansio module complete a handshake in
+memory first, so that the record calls operate on an established connection.
+The records that SSL_read consumes are queued in batches, outside the
+measured time, and all of its variants read into the same buffer. Run it with
+"python -m dtls.test.bench_bindings [-n CALLS]".
+"""
+
+from argparse import ArgumentParser
+from ctypes import c_int, c_long, c_void_p, create_string_buffer
+from os import path
+from time import perf_counter
+from timeit import repeat
+from dtls import openssl
+from dtls.openssl import SSL, libssl, SSL_CTRL_OPTIONS
+from dtls.openssl import SSL_read, SSL_write, SSL_pending
+from dtls.sansio import SSLEngine
+
+CERTFILE = path.join(path.dirname(__file__), "certs", "keycert.pem")
+PAYLOAD = b"x" * 1024
+REPEAT = 5
+# Records per batch, which OpenSSL reads from the memory BIO in one piece: a
+# record that straddles the end of its read buffer would be dropped
+READ_BATCH = 8
+
+
+def make_checked_bindings():
+    # The bindings that the data plane used before the fast path
+    for args in (
+        ("SSL_read", libssl,
+         ((c_int, "ret"), (SSL, "ssl"), (c_void_p, "buf"), (c_int, "num")),
+         False, "default", "_SSL_read_checked"),
+        ("SSL_write", libssl,
+         ((c_int, "ret"), (SSL, "ssl"), (c_void_p, "buf"), (c_int, "num")),
+         False, "default", "_SSL_write_checked"),
+        ("SSL_pending", libssl,
+         ((c_int, "ret"), (SSL, "ssl")), False, None, "_SSL_pending_checked"),
+        ("SSL_get_error", libssl,
+         ((c_int, "ret"), (SSL, "ssl"), (c_int, "ret")),
+         False, None, "_SSL_get_error_checked"),
+        ("SSL_ctrl", libssl,
+         ((c_long, "ret"), (SSL, "ssl"), (c_int, "cmd"), (c_long, "larg"),
+          (c_void_p, "parg")), False, None, "_SSL_ctrl_checked"),
+        ):
+        openssl._make_function(*args)
+
+
+def connected_engines():
+    client = SSLEngine()
+    server = SSLEngine(True, CERTFILE, CERTFILE)
+    for _ in range(10):
+        client.do_handshake()
+        for datagram, _ in client.datagrams_to_send():
+            server.receive_datagram(datagram)
+        server.do_handshake()
+        for datagram, _ in server.datagrams_to_send():
+            client.receive_datagram(datagram)
+        if client.do_handshake() is None and server.do_handshake() is None:
+            return client, server
+    raise Exception("In-memory handshake did not complete")
+
+
+def main(calls):
+    make_checked_bindings()
+    client, server = connected_engines()
+    ssl = client._ssl.value
+    handle = ssl._as_parameter
+    buf = create_string_buffer(len(PAYLOAD))
+
+    def time_calls(func):
+        return min(repeat(func, number=calls, repeat=REPEAT))
+
+    # Every read consumes a record that was queued before the clock started
+    def time_reads(read):
+        def run():
+            elapsed = 0
+            for _ in range(0, calls, READ_BATCH):
+                for _ in range(READ_BATCH):
+                    server.write(PAYLOAD)
+                client.receive_datagram(b"".join(
+                    datagram for datagram, _ in server.datagrams_to_send()))
+                start = perf_counter()
+                for _ in range(READ_BATCH):
+                    read()
+                elapsed += perf_counter() - start
+            return elapsed
+        return min(run() for _ in range(REPEAT))
+
+    benchmarks = (
+        ("SSL_pending", time_calls,
+         lambda: openssl._SSL_pending_checked(ssl),
+         lambda: SSL_pending(ssl),
+         lambda: openssl._SSL_pending_fast(handle)),
+        ("SSL_get_error", time_calls,
+         lambda: openssl._SSL_get_error_checked(ssl, 1),
+         None,
+         lambda: openssl._SSL_get_error_fast(handle, 1)),
+        ("SSL_ctrl", time_calls,
+         lambda: openssl._SSL_ctrl_checked(ssl, SSL_CTRL_OPTIONS, 0, None),
+         None,
+         lambda: openssl._SSL_ctrl_fast(handle, SSL_CTRL_OPTIONS, 0, None)),
+        ("SSL_write", time_calls,
+         lambda: (openssl._SSL_write_checked(ssl, PAYLOAD, len(PAYLOAD)),
+                  client.datagrams_to_send()),
+         lambda: (SSL_write(ssl, PAYLOAD), client.datagrams_to_send()),
+         lambda: (openssl._SSL_write_fast(handle, PAYLOAD, len(PAYLOAD)),
+                  client.datagrams_to_send())),
+        ("SSL_read", time_reads,
+         lambda: openssl._SSL_read_checked(ssl, buf, len(buf)),
+         lambda: SSL_read(ssl, len(buf), buf),
+         lambda: openssl._SSL_read_fast(handle, buf, len(buf))),
+        )
+
+    print("Per-call time in microseconds, best of %d runs of %d calls" %
+          (REPEAT, calls))
+    print("%-28s %10s %10s %10s" % ("", "checked", "wrapper", "raw"))
+    for name, timer, checked, wrapper, raw in benchmarks:
+        times = [timer(func) * 1e6 / calls if func else None
+                 for func in (checked, wrapper, raw)]
+        print("%-28s %s" % (name, " ".join(
+            "%10.3f" % t if t is not None else "%10s" % "-" for t in times)))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--calls", type=int, default=100000,
+                        help="number of calls per measurement")
+    main(parser.parse_args().calls)
@@ -4,6 +4,7 @@
 import sys
 import unittest
 import asyncore
+import asyncio
 import socket
 import select
 import gc
@@ -13,6 +14,9 @@ import pprint
 from urllib import parse as urlparse
 import traceback
 import weakref
+import tempfile
+import sqlite3
+import shutil
 import platform
 import threading
 import time
@@ -22,7 +26,22 @@ from http.server import SimpleHTTPRequestHandler
 from collections import OrderedDict
 
 import ssl
-from dtls import do_patch, force_routing_demux, reset_default_demux, err
+from dtls import do_patch, force_routing_demux, force_memory_demux
+from dtls import reset_default_demux, err
+from dtls import BufferPool, SSLEngine, TicketKeyRing
+from dtls.demux import router, mmsg, membio, osnet
+from dtls import sslconnection, openssl
+from dtls.sslconnection import SSLConnection, ClientSessionCache
+from dtls.openssl import BIO_ctrl_pending, BIO_dgram_get_peer
+from dtls.openssl import BIO_dgram_query_mtu, SSL_CTX_flush_sessions
+from dtls.openssl import SSL_CTX_get_options, SSL_CTX_clear_options
+from dtls.openssl import SSL_get_options, SSL_set_options, SSL_clear_options
+from dtls.openssl import SSL_OP_NO_COMPRESSION, SSL_OP_NO_QUERY_MTU
+from dtls.util import _pack_records
+from dtls.sharding import ShardedServer
+from dtls.aio import create_dtls_server, create_dtls_endpoint
+from dtls.reuseport import peer_bucket
+from dtls.sessionstore import SessionStore, SQLiteSessionStore
 
 # from logging import basicConfig, DEBUG
 # basicConfig(level=DEBUG)  # set now for dtls import code
@@ -152,6 +171,276 @@ class BasicSocketTests(unittest.TestCase):
                           ('0.0.0.0', 0) if AF_INET4_6 == socket.AF_INET else
                           ('::', 0))
 
+    def test_options(self):
+        # Options set on a context or a connection read back as set
+        s = socket.socket(AF_INET4_6, socket.SOCK_DGRAM)
+        self.addCleanup(s.close)
+        conn = SSLConnection(s)
+        ctx, ssl_obj = conn._ctx.value, conn._ssl.value
+        self.assertTrue(SSL_CTX_get_options(ctx) & SSL_OP_NO_COMPRESSION)
+        SSL_CTX_clear_options(ctx, SSL_OP_NO_COMPRESSION)
+        self.assertFalse(SSL_CTX_get_options(ctx) & SSL_OP_NO_COMPRESSION)
+        self.assertFalse(SSL_get_options(ssl_obj) & SSL_OP_NO_QUERY_MTU)
+        SSL_set_options(ssl_obj, SSL_OP_NO_QUERY_MTU)
+        self.assertTrue(SSL_get_options(ssl_obj) & SSL_OP_NO_QUERY_MTU)
+        SSL_clear_options(ssl_obj, SSL_OP_NO_QUERY_MTU)
+        self.assertFalse(SSL_get_options(ssl_obj) & SSL_OP_NO_QUERY_MTU)
+
+    def test_sansio_engine(self):
+        client_address, server_address = ("10.0.0.1", 5000), ("10.0.0.2", 443)
+        server = SSLEngine(server_side=True, keyfile=CERTFILE,
+                           certfile=CERTFILE, mtu=600)
+        client = SSLEngine(peer_address=server_address, mtu=600)
+
+        def relay(source, source_address, destination):
+            datagrams = source.datagrams_to_send()
+            for payload, address in datagrams:
+                self.assertLessEqual(len(payload), 600)
+                destination.receive_datagram(payload, source_address)
+            return len(datagrams)
+
+        self.assertIs(client.do_handshake(), sslconnection.WANT_READ)
+        self.assertIsNotNone(client.get_timeout())
+        for _ in range(5):
+            relay(client, client_address, server)
+            server_status = server.do_handshake()
+            relay(server, server_address, client)
+            if client.do_handshake() is None and server_status is None:
+                break
+        self.assertIsNone(client.do_handshake())
+        self.assertEqual(server.peer_address, client_address)
+        self.assertIsNotNone(client.cipher())
+        self.assertFalse(server.receive_datagram(b"x", ("10.0.0.3", 5000)))
+        self.assertEqual(client.write(b"sans-io"), 7)
+        self.assertEqual(relay(client, client_address, server), 1)
+        self.assertEqual(server.read(), b"sans-io")
+        self.assertIs(server.read(), sslconnection.WANT_READ)
+        self.assertFalse(client.shutdown())
+        relay(client, client_address, server)
+        self.assertIs(server.read(), sslconnection.ZERO_RETURN)
+        self.assertTrue(server.shutdown())
+        relay(server, server_address, client)
+        self.assertTrue(client.shutdown())
+
+    def engine_handshake(self, config_ssl_ctx, session=None):
+        server = SSLEngine(server_side=True, keyfile=CERTFILE,
+                           certfile=CERTFILE,
+                           cb_user_config_ssl_ctx=config_ssl_ctx)
+        client = SSLEngine(
+            cb_user_config_ssl=lambda ssl: session and ssl.set_session(session))
+        for _ in range(5):
+            for payload, _ in client.datagrams_to_send():
+                server.receive_datagram(payload)
+            server_status = server.do_handshake()
+            for payload, _ in server.datagrams_to_send():
+                client.receive_datagram(payload)
+            if client.do_handshake() is None and server_status is None:
+                break
+        self.assertIsNone(client.do_handshake())
+        # Sessions of connections closed without shutdown are not resumable
+        client.shutdown()
+        server.shutdown()
+        return client
+
+    def test_session_tickets(self):
+        secret = b"s" * 32
+
+        def handshake(ring, session=None):
+            return self.engine_handshake(
+                lambda ctx: ctx.set_session_tickets(ring), session)
+
+        # A second server instance decrypts the first one's ticket
+        session = handshake(TicketKeyRing(secret)).get_session()
+        client = handshake(TicketKeyRing(secret), session)
+        self.assertTrue(client.session_reused())
+        # One with another secret falls back to a full handshake
+        client = handshake(TicketKeyRing(b"t" * 32), session)
+        self.assertFalse(client.session_reused())
+        self.assertRaises(ValueError, TicketKeyRing, b"short")
+
+    def test_ticket_key_rotation(self):
+        now = [1000.0]
+        ring = TicketKeyRing(b"s" * 32, rotation=100, grace=150,
+                             clock=lambda: now[0])
+        name, hmac_key, aes_key, renew = ring.get_key(None)
+        self.assertEqual(ring.get_key(name), (name, hmac_key, aes_key, False))
+        # A host whose clock is up to a period behind accepts the next key
+        now[0] = 900.0
+        self.assertEqual(ring.get_key(name)[0], name)
+        # The next period rotates the encryption key; the retired one is
+        # accepted, with renewal, until the grace window has passed
+        now[0] = 1100.0
+        self.assertNotEqual(ring.get_key(None)[0], name)
+        self.assertTrue(ring.get_key(name)[3])
+        now[0] = 1249.0
+        self.assertTrue(ring.get_key(name)[3])
+        now[0] = 1250.0
+        self.assertIsNone(ring.get_key(name))
+        self.assertEqual(sorted(ring._periods), [11, 12, 13])
+        # Encrypting prunes expired keys as well
+        now[0] = 5000.0
+        ring.get_key(None)
+        self.assertEqual(sorted(ring._periods), [50])
+        # Keys of periods two or more ahead are rejected
+        now[0] = 800.0
+        self.assertIsNone(ring.get_key(name))
+
+    def test_ticket_secret_reload(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "secret")
+        TicketKeyRing.create_secret_file(path)
+        ring = TicketKeyRing(path=path)
+        name = ring.get_key(None)[0]
+        self.assertEqual(TicketKeyRing(path=path).get_key(None)[0], name)
+        # A replaced secret is picked up by its modification time
+        TicketKeyRing.create_secret_file(path)
+        os.utime(path, ns=(0, 0))
+        self.assertIsNone(ring.get_key(name))
+        self.assertNotEqual(ring.get_key(None)[0], name)
+        # A secret file that cannot be read leaves the last one in use
+        name = ring.get_key(None)[0]
+        os.unlink(path)
+        self.assertEqual(ring.get_key(name)[0], name)
+
+    def test_session_store(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "sessions.db")
+        # Each worker process opens its own store on the shared file
+        workers = [SQLiteSessionStore(path) for _ in range(2)]
+        for store in workers:
+            self.addCleanup(store.close)
+
+        session = self.engine_handshake(
+            lambda ctx: ctx.set_session_store(workers[0])).get_session()
+        workers[0].flush()
+        client = self.engine_handshake(
+            lambda ctx: ctx.set_session_store(workers[1]), session)
+        self.assertTrue(client.session_reused())
+
+        # Expired sessions and those beyond the size bound are dropped
+        store = SQLiteSessionStore(os.path.join(tmpdir, "bounded.db"),
+                                   size=1)
+        self.addCleanup(store.close)
+        store.add(b"expired", b"x", time.time() - 1)
+        store.add(b"evicted", b"x", time.time() + 60)
+        store.add(b"kept", b"x", time.time() + 120)
+        store.flush()
+        self.assertIsNone(store.get(b"expired"))
+        self.assertIsNone(store.get(b"evicted"))
+        self.assertEqual(store.get(b"kept"), b"x")
+        store.remove(b"kept")
+        store.flush()
+        self.assertIsNone(store.get(b"kept"))
+        # Stores implement the whole interface
+        self.assertRaises(TypeError, SessionStore)
+
+    def test_session_store_contention(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        expires = time.time() + 60
+        # A database locked exclusively yields misses instead of waiting.
+        # WAL mode grants an exclusive lock only to a sole connection: the
+        # store's writer is stopped, and this thread has not looked up yet.
+        path = os.path.join(tmpdir, "locked.db")
+        store = SQLiteSessionStore(path)
+        self.addCleanup(store.close)
+        store.add(b"locked", b"x", expires)
+        store._writes.put(None)
+        store._writer.join()
+        locker = sqlite3.connect(path, isolation_level=None)
+        locker.execute("PRAGMA locking_mode=EXCLUSIVE")
+        locker.execute("BEGIN EXCLUSIVE")
+        start = time.time()
+        self.assertIsNone(store.get(b"locked"))
+        self.assertLess(time.time() - start, 1)
+        locker.close()
+        self.assertEqual(store.get(b"locked"), b"x")
+
+        # While another process writes, modifications beyond the queue's
+        # capacity are dropped
+        path = os.path.join(tmpdir, "queued.db")
+        store = SQLiteSessionStore(path, queue_size=1)
+        self.addCleanup(store.close)
+        locker = sqlite3.connect(path, isolation_level=None)
+        self.addCleanup(locker.close)
+        locker.execute("BEGIN IMMEDIATE")
+        store.add(b"first", b"x", expires)
+        deadline = time.time() + 10
+        while store._writes.qsize() and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)  # the writer now waits for the lock
+        store.add(b"queued", b"x", expires)
+        store.add(b"dropped", b"x", expires)
+        locker.execute("COMMIT")
+        store.flush()
+        self.assertEqual(store.get(b"first"), b"x")
+        self.assertEqual(store.get(b"queued"), b"x")
+        self.assertIsNone(store.get(b"dropped"))
+
+    def test_ctx_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        certfile = shutil.copy(CERTFILE, tmpdir)
+        self.addCleanup(sslconnection._context_cache.clear)
+
+        def client(ctx_cache_key=True, **kwargs):
+            sock = socket.socket(AF_INET4_6, socket.SOCK_DGRAM)
+            self.addCleanup(sock.close)
+            return SSLConnection(sock, keyfile=certfile, certfile=certfile,
+                                 ctx_cache_key=ctx_cache_key, **kwargs)
+
+        first = client()
+        self.assertIs(client()._ctx, first._ctx)
+        self.assertIsNot(client(None)._ctx, first._ctx)
+        self.assertIsNot(client("other")._ctx, first._ctx)
+        # A changed file is loaded again; connections keep the old context
+        os.utime(certfile, ns=(0, 0))
+        second = client()
+        self.assertIsNot(second._ctx, first._ctx)
+        self.assertIs(client()._ctx, second._ctx)
+        self.assertTrue(first._ctx.raw)
+        # Beyond the cache's size, the least recently used entry goes
+        cache = sslconnection._context_cache
+        self.addCleanup(setattr, cache, "size", cache.size)
+        cache.size = 2
+        client("other")
+        client()
+        client("third")
+        self.assertIs(client()._ctx, second._ctx)
+        self.assertIsNot(client("other")._ctx, first._ctx)
+        self.assertEqual(len(cache._entries), 2)
+        # An evicted context's info callback goes once its last connection
+        # has been freed
+        logged = client("logged", cb_user_config_ssl_ctx=lambda ctx:
+                        ctx.set_ssl_logging(True))
+        ctx = logged._ctx.value
+        self.assertIn(ctx, openssl._info_callback)
+        client("other")
+        client("third")
+        self.assertIn(ctx, openssl._info_callback)
+        del logged
+        gc.collect()
+        self.assertNotIn(ctx, openssl._info_callback)
+
+        # Connections sharing a context complete their handshakes
+        server = ThreadedEchoServer(CERTFILE, certreqs=ssl.CERT_NONE,
+                                    ssl_version=ssl.PROTOCOL_DTLS,
+                                    chatty=False, connectionchatty=False)
+        flag = threading.Event()
+        server.start(flag)
+        flag.wait()
+        self.addCleanup(server.stop)
+        shared = [client() for _ in range(2)]
+        self.assertIs(shared[0]._ctx, shared[1]._ctx)
+        for conn in shared:
+            conn.get_socket(False).settimeout(10)
+            conn.connect((HOST, server.port))
+            conn.write(b"SHARED")
+            self.assertEqual(conn.read(), b"shared")
+            conn.write(b"over\n")
+
 
 class NetworkedTests(unittest.TestCase):
 
@@ -1346,6 +1635,151 @@ class ThreadedTests(unittest.TestCase):
         finally:
             server.stop()
 
+    def test_write_buffers(self):
+        server = ThreadedEchoServer(CERTFILE,
+                                    certreqs=ssl.CERT_NONE,
+                                    ssl_version=ssl.PROTOCOL_DTLSv1,
+                                    chatty=False,
+                                    connectionchatty=False)
+        flag = threading.Event()
+        server.start(flag)
+        flag.wait()
+        s = ssl.wrap_socket(socket.socket(AF_INET4_6, socket.SOCK_DGRAM),
+                            cert_reqs=ssl.CERT_NONE,
+                            ssl_version=ssl.PROTOCOL_DTLSv1)
+        s.connect((HOST, server.port))
+        try:
+            payload = bytearray(b"xxWRITABLExx")
+            # Writable, read-only and non-contiguous buffers
+            for data in (memoryview(payload)[2:10],
+                         memoryview(bytes(payload))[2:10],
+                         memoryview(b"RxEyAyDx")[::2]):
+                self.assertEqual(s.write(data), len(data))
+                self.assertEqual(s.read(), bytes(data).lower())
+            s.write(b"over\n")
+            s.close()
+        finally:
+            server.stop()
+
+    def test_recvfrom_into(self):
+        server = ThreadedEchoServer(CERTFILE,
+                                    certreqs=ssl.CERT_NONE,
+                                    ssl_version=ssl.PROTOCOL_DTLSv1,
+                                    chatty=False,
+                                    connectionchatty=False)
+        flag = threading.Event()
+        server.start(flag)
+        flag.wait()
+        s = ssl.wrap_socket(socket.socket(AF_INET4_6, socket.SOCK_DGRAM),
+                            cert_reqs=ssl.CERT_NONE,
+                            ssl_version=ssl.PROTOCOL_DTLSv1)
+        s.connect((HOST, server.port))
+        pool = BufferPool(64)
+        try:
+            buf = pool.get()
+            s.write(b"POOLED")
+            self.assertEqual(s.recvfrom_into(buf),
+                             (len(b"pooled"), s.getpeername()))
+            self.assertEqual(buf[:6], b"pooled")
+            # Released buffers are leased again
+            pool.release(buf)
+            self.assertIs(pool.get(), buf)
+            s.write(b"over\n")
+            s.close()
+        finally:
+            server.stop()
+
+    def test_read_many(self):
+        server = ThreadedEchoServer(CERTFILE,
+                                    certreqs=ssl.CERT_NONE,
+                                    ssl_version=ssl.PROTOCOL_DTLSv1,
+                                    chatty=False,
+                                    connectionchatty=False)
+        flag = threading.Event()
+        server.start(flag)
+        flag.wait()
+        # The relay joins the server's datagrams of the next 0.5 seconds
+        relay = socket.socket(AF_INET4_6, socket.SOCK_DGRAM)
+        relay.bind((HOST, 0))
+        relay.settimeout(0.1)
+        coalesce = threading.Event()
+        done = threading.Event()
+        def run_relay():
+            client_address, held = None, []
+            while True:
+                try:
+                    data, address = relay.recvfrom(4096)
+                except socket.timeout:
+                    if held and time.time() > held_until:
+                        relay.sendto(b"".join(held), client_address)
+                        held = []
+                        coalesce.clear()
+                    elif done.is_set():
+                        break
+                    continue
+                if address[1] != server.port:
+                    client_address = address
+                    relay.sendto(data, (HOST, server.port))
+                elif coalesce.is_set():
+                    if not held:
+                        held_until = time.time() + 0.5
+                    held.append(data)
+                else:
+                    relay.sendto(data, client_address)
+        relay_thread = threading.Thread(target=run_relay)
+        relay_thread.start()
+        s = ssl.wrap_socket(socket.socket(AF_INET4_6, socket.SOCK_DGRAM),
+                            cert_reqs=ssl.CERT_NONE,
+                            ssl_version=ssl.PROTOCOL_DTLSv1)
+        try:
+            s.connect(relay.getsockname()[:2])
+            coalesce.set()
+            s.write(b"ONE")
+            s.write(b"TWO")
+            self.assertEqual(s.read_many(), [b"one", b"two"])
+            self.assertEqual(s.read_many(max_bytes=0), [])
+            s.write(b"over\n")
+            s.close()
+        finally:
+            done.set()
+            relay_thread.join(10)
+            relay.close()
+            server.stop()
+
+    def test_try_methods(self):
+        server = ThreadedEchoServer(CERTFILE,
+                                    certreqs=ssl.CERT_NONE,
+                                    ssl_version=ssl.PROTOCOL_DTLSv1,
+                                    chatty=False,
+                                    connectionchatty=False)
+        flag = threading.Event()
+        server.start(flag)
+        flag.wait()
+        sock = socket.socket(AF_INET4_6, socket.SOCK_DGRAM)
+        sock.settimeout(0)
+        conn = SSLConnection(sock, ssl_version=ssl.PROTOCOL_DTLSv1,
+                             do_handshake_on_connect=False)
+        conn.connect((HOST, server.port))
+        try:
+            deadline = time.time() + 10
+            status = conn.try_handshake()
+            while status is not None and time.time() < deadline:
+                self.assertIs(status, sslconnection.WANT_READ)
+                select.select([sock], [], [], 0.1)
+                status = conn.try_handshake()
+            self.assertIsNone(status)
+            self.assertIs(conn.try_read(), sslconnection.WANT_READ)
+            self.assertEqual(conn.try_write(b"TRY"), 3)
+            data = conn.try_read()
+            while data is sslconnection.WANT_READ and time.time() < deadline:
+                select.select([sock], [], [], 0.1)
+                data = conn.try_read()
+            self.assertEqual(data, b"try")
+            conn.try_write(b"over\n")
+        finally:
+            server.stop()
+            sock.close()
+
     def test_handshake_timeout(self):
         # Issue #5103: SSL handshake must respect the socket timeout
         server = socket.socket(AF_INET4_6, socket.SOCK_DGRAM)
@@ -1374,6 +1808,753 @@ class ThreadedTests(unittest.TestCase):
         finally:
             server.close()
 
+    def test_handshake_retransmission(self):
+        # Handshakes under a timeout retransmit on the DTLS timer's schedule
+        server = socket.socket(AF_INET4_6, socket.SOCK_DGRAM)
+        server.bind((HOST, 0))
+        server.settimeout(0)
+        c = socket.socket(AF_INET4_6, socket.SOCK_DGRAM)
+        c.settimeout(2.5)
+        c = ssl.wrap_socket(c)
+        try:
+            self.assertRaisesRegex(ssl.SSLError, "timed out",
+                                   c.connect, (HOST, server.getsockname()[1]))
+            hellos = 0
+            while select.select([server], [], [], 0)[0]:
+                server.recv(4096)
+                hellos += 1
+            self.assertGreaterEqual(hellos, 2)
+        finally:
+            c.close()
+            server.close()
+
+    def test_drain(self):
+        server = ssl.wrap_socket(socket.socket(AF_INET4_6, socket.SOCK_DGRAM),
+                                 server_side=True, certfile=CERTFILE)
+        server.bind((HOST, 0))
+        server.settimeout(0)
+        server.listen(0)
+        clients = [ssl.wrap_socket(socket.socket(AF_INET4_6,
+                                                 socket.SOCK_DGRAM))
+                   for _ in range(2)]
+        threads = [threading.Thread(target=client.connect,
+                                    args=(server.getsockname()[:2],))
+                   for client in clients]
+        done = threading.Event()
+        try:
+            for thread in threads:
+                thread.start()
+            new_peers = []
+            deadline = time.time() + 10
+            while len(new_peers) < 2 and time.time() < deadline:
+                select.select([server], [], [], 0.1)
+                new_peers += server.drain(max_time=1.0)
+            self.assertEqual(sorted(new_peers),
+                             sorted(client.getsockname()[:2]
+                                    for client in clients))
+            # The routing demux forwards handshake datagrams while draining
+            def pump():
+                while not done.is_set():
+                    select.select([server], [], [], 0.05)
+                    server.drain()
+            threads.append(threading.Thread(target=pump))
+            threads[-1].start()
+            # Queued connections are accepted in order
+            accepted = [server.accept() for _ in new_peers]
+            self.assertEqual([addr for _, addr in accepted], new_peers)
+            for thread in threads[:-1]:
+                thread.join(10)
+            for client in clients:
+                client.write(b"drained")
+            for conn, _ in accepted:
+                conn.settimeout(5)
+                self.assertEqual(conn.read(), b"drained")
+                conn.close()
+        finally:
+            done.set()
+            for thread in threads:
+                thread.join(10)
+            for client in clients:
+                client.close()
+            server.close()
+
+    def test_write_many(self):
+        server = ssl.wrap_socket(socket.socket(AF_INET4_6, socket.SOCK_DGRAM),
+                                 server_side=True, certfile=CERTFILE)
+        server.bind((HOST, 0))
+        server.settimeout(0)
+        server.listen(0)
+        client = ssl.wrap_socket(socket.socket(AF_INET4_6, socket.SOCK_DGRAM))
+        threads = [threading.Thread(target=client.connect,
+                                    args=(server.getsockname()[:2],))]
+        done = threading.Event()
+        def pump():
+            while not done.is_set():
+                select.select([server], [], [], 0.05)
+                server.drain()
+        try:
+            threads[0].start()
+            new_peers = []
+            deadline = time.time() + 10
+            while not new_peers and time.time() < deadline:
+                select.select([server], [], [], 0.1)
+                new_peers += server.drain(max_time=1.0)
+            threads.append(threading.Thread(target=pump))
+            threads[-1].start()
+            conn, _ = server.accept()
+            threads[0].join(10)
+            messages = [b"one", b"two", b"three"]
+            self.assertEqual(client.write_many(messages), [3, 3, 5])
+            # A single datagram carries all three records
+            conn.settimeout(5)
+            self.assertEqual(conn.read_many(), messages)
+            conn.close()
+            done.set()
+            threads[-1].join(10)
+            server.close()
+            if sys.platform.startswith("linux"):
+                # The first datagram draws a port unreachable error, which
+                # fails the send of the second; its record is not reported
+                # as written, and later ones are not sent
+                self.assertEqual(client.write_many(messages, mtu=1),
+                                 [3, 0, 0])
+        finally:
+            done.set()
+            for thread in threads:
+                thread.join(10)
+            client.close()
+            server.close()
+
+    def session_server(self, config_ctx):
+        server = ssl.wrap_socket(socket.socket(AF_INET4_6, socket.SOCK_DGRAM),
+                                 server_side=True, certfile=CERTFILE,
+                                 do_handshake_on_connect=False,
+                                 cb_user_config_ssl_ctx=config_ctx)
+        server.bind((HOST, 0))
+        server.settimeout(0)
+        server.listen(0)
+        def connect(session=None, **kwargs):
+            client = ssl.wrap_socket(
+                socket.socket(AF_INET4_6, socket.SOCK_DGRAM),
+                cb_user_config_ssl=session and
+                  (lambda ssl_intf: ssl_intf.set_session(session)),
+                **kwargs)
+            def handshake():
+                client.connect(server.getsockname()[:2])
+                if not client.do_handshake_on_connect:
+                    # The first write performs the handshake
+                    client._sslobj.try_write(b"session")
+            thread = threading.Thread(target=handshake)
+            try:
+                thread.start()
+                new_peers = []
+                deadline = time.time() + 10
+                while not new_peers and time.time() < deadline:
+                    select.select([server], [], [], 0.1)
+                    new_peers += server.drain(max_time=1.0)
+                conn, _ = server.accept()
+                # This thread both forwards the handshake's datagrams and
+                # drives the accepted connection's side of the handshake
+                while conn._sslobj.try_handshake() is not None and \
+                  time.time() < deadline:
+                    select.select([server], [], [], 0.05)
+                    server.drain()
+            finally:
+                thread.join(10)
+            if client.do_handshake_on_connect:
+                client.write(b"session")
+            conn.settimeout(5)
+            self.assertEqual(conn.read(), b"session")
+            return client, conn
+        return server, connect
+
+    def test_session_cache(self):
+        contexts = []
+        def config_ctx(ctx):
+            ctx.set_session_cache(size=16, timeout=60)
+            contexts.append(ctx)
+        server, connect = self.session_server(config_ctx)
+        connections = []
+        try:
+            connections.append(connect())
+            client, conn = connections[0]
+            self.assertFalse(client._sslobj.session_reused())
+            session = client._sslobj.get_session()
+            # The accepted connection's abbreviated handshake hits the cache
+            connections.append(connect(session))
+            client, conn = connections[1]
+            self.assertTrue(client._sslobj.session_reused())
+            self.assertTrue(conn._sslobj.session_reused())
+            stats = contexts[0].get_session_stats()
+            self.assertEqual(stats["size"], 1)
+            self.assertEqual(stats["hits"], 1)
+            self.assertEqual(stats["evictions"], 0)
+        finally:
+            for client, conn in connections:
+                client.close()
+                conn.close()
+            server.close()
+
+    def test_session_cache_evictions(self):
+        contexts = []
+        def config_ctx(ctx):
+            ctx.set_session_cache(size=2, timeout=60)
+            contexts.append(ctx)
+        server, connect = self.session_server(config_ctx)
+        connections = []
+        try:
+            # Every full handshake adds a session; the third evicts one
+            for _ in range(3):
+                connections.append(connect())
+            stats = contexts[0].get_session_stats()
+            self.assertEqual(stats["size"], 2)
+            self.assertEqual(stats["evictions"], 1)
+        finally:
+            for client, conn in connections:
+                client.close()
+                conn.close()
+            server.close()
+
+    def test_client_session_cache(self):
+        contexts = []
+        def config_ctx(ctx):
+            ctx.set_session_cache(size=16, timeout=60)
+            contexts.append(ctx)
+        server, connect = self.session_server(config_ctx)
+        cache = ClientSessionCache()
+        connections = []
+        try:
+            for _ in range(2):
+                connections.append(connect(session_cache=cache))
+            self.assertFalse(connections[0][0]._sslobj.session_reused())
+            self.assertTrue(connections[1][0]._sslobj.session_reused())
+            # The server no longer holds the session: the entry is replaced
+            SSL_CTX_flush_sessions(contexts[0]._ctx, 2 ** 31 - 1)
+            connections.append(connect(session_cache=cache))
+            self.assertFalse(connections[2][0]._sslobj.session_reused())
+            # Another server name is another entry
+            connections.append(connect(session_cache=cache,
+                                       server_hostname="collector"))
+            self.assertFalse(connections[3][0]._sslobj.session_reused())
+            self.assertEqual(cache.get_stats(), {"size": 2, "hits": 1,
+                                                 "misses": 2,
+                                                 "invalidations": 1})
+            # Implicit handshakes offer and store sessions as well
+            connections.append(connect(session_cache=cache,
+                                       do_handshake_on_connect=False))
+            self.assertTrue(connections[4][0]._sslobj.session_reused())
+            self.assertEqual(cache.get_stats()["hits"], 2)
+            # Unconnected sockets are keyed by the address given to connect
+            unconnected = SSLConnection(
+                socket.socket(AF_INET4_6, socket.SOCK_DGRAM),
+                session_cache=cache, do_handshake_on_connect=False)
+            unconnected._connect_address = server.getsockname()[:2]
+            unconnected._offer_cached_session()
+            self.assertTrue(unconnected._session_offered)
+        finally:
+            for client, conn in connections:
+                client.close()
+                conn.close()
+            server.close()
+
+    def test_queue_bio(self):
+        server = ThreadedEchoServer(CERTFILE,
+                                    certreqs=ssl.CERT_NONE,
+                                    ssl_version=ssl.PROTOCOL_DTLSv1,
+                                    chatty=False,
+                                    connectionchatty=False)
+        flag = threading.Event()
+        server.start(flag)
+        flag.wait()
+        sock = socket.socket(AF_INET4_6, socket.SOCK_DGRAM)
+        sock.settimeout(10)
+        conn = SSLConnection(sock, ssl_version=ssl.PROTOCOL_DTLSv1,
+                             do_handshake_on_connect=False)
+        try:
+            qbio = conn.use_queue_bio(mtu=1200)
+            conn.connect((HOST, server.port))
+            bio = qbio.ssl_bio()
+            self.assertEqual(BIO_dgram_get_peer(bio.value), sock.getpeername())
+            self.assertEqual(BIO_dgram_query_mtu(bio.value), 1200)
+            # The handshake flushes the queue while waiting for the server
+            conn.do_handshake()
+            self.assertIsNone(qbio.next_timeout)
+            conn.write(b"QUEUED")
+            self.assertEqual(len(qbio.outgoing), 1)
+            self.assertEqual(qbio.flush(), 1)
+            self.assertEqual(conn.read(), b"queued")
+            conn.write(b"over\n")
+            qbio.flush()
+        finally:
+            server.stop()
+            sock.close()
+
+    def test_asyncio_endpoints(self):
+        class EchoProtocol(asyncio.Protocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def data_received(self, data):
+                self.transport.write(data.lower())
+
+        class ClientProtocol(asyncio.Protocol):
+            def __init__(self):
+                self.received = asyncio.Queue()
+                self.lost = False
+
+            def data_received(self, data):
+                self.received.put_nowait(data)
+
+            def connection_lost(self, exc):
+                self.lost = True
+
+        async def exchange():
+            server = await create_dtls_server(EchoProtocol, (HOST, 0),
+                                              CERTFILE, CERTFILE, loop=loop)
+            try:
+                transport, protocol = await create_dtls_endpoint(
+                    ClientProtocol, server.sockname[:2], loop=loop,
+                    handshake_timeout=10)
+                engine = transport.get_extra_info("ssl_engine")
+                self.assertTrue(engine.getpeercert(True))
+                self.assertEqual(len(server.get_transports()), 1)
+                for indata in b"FOO", b"BAR":
+                    transport.write(indata)
+                    outdata = await asyncio.wait_for(protocol.received.get(),
+                                                     10)
+                    self.assertEqual(outdata, indata.lower())
+                # The server handles the close-notify alert
+                transport.close()
+                for _ in range(100):
+                    if not server.get_transports():
+                        break
+                    await asyncio.sleep(0.01)
+                self.assertEqual(server.get_transports(), [])
+                self.assertTrue(protocol.lost)
+            finally:
+                server.close()
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(exchange())
+        finally:
+            loop.close()
+
+    def test_asyncio_verification(self):
+        async def connect(ca_certs):
+            server = await create_dtls_server(asyncio.Protocol, (HOST, 0),
+                                              CERTFILE, CERTFILE, loop=loop)
+            try:
+                transport, _ = await create_dtls_endpoint(
+                    asyncio.Protocol, server.sockname[:2], loop=loop,
+                    cert_reqs=ssl.CERT_REQUIRED, ca_certs=ca_certs,
+                    handshake_timeout=10)
+                try:
+                    return transport.get_extra_info("peercert")
+                finally:
+                    transport.close()
+            finally:
+                # The client's alert makes the server drop a failed peer
+                for _ in range(100):
+                    if not server.get_transports():
+                        break
+                    await asyncio.sleep(0.01)
+                self.assertEqual(server.get_transports(), [])
+                server.close()
+
+        loop = asyncio.new_event_loop()
+        try:
+            with self.assertRaises(ssl.SSLError):
+                loop.run_until_complete(connect(OTHER_CERTFILE))
+            self.assertTrue(loop.run_until_complete(connect(ISSUER_CERTFILE)))
+        finally:
+            loop.close()
+
+    def test_asyncio_server_limits(self):
+        async def exchange():
+            server = await create_dtls_server(asyncio.Protocol, (HOST, 0),
+                                              CERTFILE, CERTFILE, loop=loop,
+                                              max_peers=1,
+                                              handshake_timeout=2)
+            raw = socket.socket(AF_INET4_6, socket.SOCK_DGRAM)
+            raw.setblocking(False)
+            try:
+                raw.connect(server.sockname[:2])
+                engine = SSLEngine()
+                engine.do_handshake()
+                hello = engine.datagrams_to_send()[0][0]
+                # A ClientHello without a cookie leaves no state behind
+                await loop.sock_sendall(raw, hello)
+                reply = await asyncio.wait_for(loop.sock_recv(raw, 4096), 10)
+                self.assertEqual((reply[0], reply[13]), (22, 3))
+                self.assertEqual(server.get_transports(), [])
+                engine.receive_datagram(reply)
+                engine.do_handshake()
+                for datagram, _ in engine.datagrams_to_send():
+                    await loop.sock_sendall(raw, datagram)
+                await asyncio.wait_for(loop.sock_recv(raw, 4096), 10)
+                self.assertEqual(len(server.get_transports()), 1)
+                # The stalled handshake holds the only slot
+                with self.assertRaises(asyncio.TimeoutError):
+                    await create_dtls_endpoint(asyncio.Protocol,
+                                               server.sockname[:2],
+                                               loop=loop,
+                                               handshake_timeout=0.5)
+                for _ in range(100):
+                    if not server.get_transports():
+                        break
+                    await asyncio.sleep(0.05)
+                self.assertEqual(server.get_transports(), [])
+                transport, _ = await create_dtls_endpoint(
+                    asyncio.Protocol, server.sockname[:2], loop=loop,
+                    handshake_timeout=10)
+                transport.close()
+            finally:
+                raw.close()
+                server.close()
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(exchange())
+        finally:
+            loop.close()
+
+    def test_fd_budget(self):
+        import dtls.demux
+        if dtls.demux.UDPDemux is not osnet.UDPDemux:
+            self.skipTest("fd budgets require the platform-native demux")
+        root = socket.socket(AF_INET4_6, socket.SOCK_DGRAM)
+        root.bind((HOST, 0))
+        root.settimeout(0)
+        server = SSLConnection(root, keyfile=CERTFILE, certfile=CERTFILE,
+                               server_side=True,
+                               demux_options={"fd_budget": 1})
+        clients = [ssl.wrap_socket(socket.socket(AF_INET4_6,
+                                                 socket.SOCK_DGRAM))
+                   for _ in range(2)]
+        threads = [threading.Thread(target=client.connect,
+                                    args=(root.getsockname()[:2],))
+                   for client in clients]
+        try:
+            for thread in threads:
+                thread.start()
+            new_peers = []
+            deadline = time.time() + 10
+            while len(new_peers) < 2 and time.time() < deadline:
+                select.select([root], [], [], 0.1)
+                new_peers += server.drain(max_time=1.0)
+            # The first peer gets a connected socket, the second shares root
+            accepted = [server.accept() for _ in new_peers]
+            for thread in threads:
+                thread.join(10)
+            for client in clients:
+                client.write(b"budget")
+            for conn, _ in accepted:
+                self.assertEqual(conn.read(), b"budget")
+            self.assertEqual(server.get_demux_stats(),
+                             {"socket_peers": 1, "shared_peers": 1,
+                              "socket_peers_total": 1,
+                              "shared_peers_total": 1})
+        finally:
+            for client in clients:
+                client.close()
+            root.close()
+
+    def test_auto_mtu(self):
+        if not sys.platform.startswith("linux"):
+            self.skipTest("path MTU queries are supported on Linux")
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        client = SSLConnection(socket.socket(socket.AF_INET,
+                                             socket.SOCK_DGRAM),
+                               do_handshake_on_connect=False,
+                               cb_user_config_ssl=lambda s: s.set_auto_mtu())
+        try:
+            self.assertIsNone(client.get_path_mtu())
+            client.connect(peer.getsockname())
+            # The loopback device's MTU, less the IP and UDP headers
+            self.assertGreater(client.get_path_mtu(), 1500)
+        finally:
+            client.close()
+            peer.close()
+
+
+class RoutingDemuxTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.root.bind(("127.0.0.1", 0))
+        self.root.settimeout(1.0)
+        self.peers = []
+        for _ in range(2):
+            peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            peer.bind(("127.0.0.1", 0))
+            self.peers.append(peer)
+
+    def tearDown(self):
+        for sock in [self.root] + self.peers:
+            sock.close()
+
+    def test_service_batch(self):
+        demux = router.UDPDemux(self.root, batch_size=16)
+        known, unknown = self.peers
+        conn = demux.get_connection(known.getsockname())
+        conn.settimeout(1.0)
+        for i in range(3):
+            known.sendto(b"known%d" % i, self.root.getsockname())
+            unknown.sendto(b"new%d" % i, self.root.getsockname())
+        time.sleep(0.1)
+        # Known-peer datagrams are forwarded in the same pass, new-peer
+        # datagrams are handed out one at a time
+        self.assertEqual(demux.service(), unknown.getsockname())
+        self.assertEqual(demux.payload, b"new0")
+        self.assertEqual([conn.recv(100) for _ in range(3)],
+                         [b"known0", b"known1", b"known2"])
+        default_conn = demux.get_connection(None)
+        demux.forward()
+        self.assertEqual(default_conn.recv(100), b"new0")
+        self.assertEqual(demux.service(), unknown.getsockname())
+        self.assertEqual(demux.payload, b"new1")
+
+    def test_buffer_pool(self):
+        demux = router.UDPDemux(self.root, mtu=16)
+        peer = self.peers[0]
+        peer.sendto(b"short", self.root.getsockname())
+        peer.sendto(b"x" * 100, self.root.getsockname())
+        default_conn = demux.get_connection(None)
+        default_conn.settimeout(1.0)
+        # Datagrams up to the MTU are received into pooled buffers, which are
+        # reused once forwarded; longer ones overflow into copies
+        self.assertEqual(demux.service(), peer.getsockname())
+        self.assertIsInstance(demux.payload, memoryview)
+        buf = demux.payload.obj
+        demux.forward()
+        self.assertEqual(default_conn.recv(200), b"short")
+        self.assertEqual(demux.service(), peer.getsockname())
+        self.assertEqual(demux.payload, b"x" * 100)
+        demux.forward()
+        self.assertEqual(default_conn.recv(200), b"x" * 100)
+        self.assertIs(demux._pool.get(), buf)
+
+    def test_batch_sender(self):
+        sender = mmsg.BatchSender(4)
+        dest = self.root.getsockname()
+        datagrams = [(b"dgram%d" % i, dest) for i in range(10)]
+        self.assertEqual(sender.send(self.peers[0], datagrams), 10)
+        self.assertEqual([self.root.recvfrom(100)[0] for _ in range(10)],
+                         [payload for payload, _ in datagrams])
+        # A failing first datagram raises; later ones are not attempted
+        self.assertRaises(socket.error, sender.send, self.peers[0],
+                          [(b"x" * 70000, dest), (b"y", dest)])
+        self.assertEqual(sender.send(self.peers[0],
+                                     [(b"y", dest), (b"x" * 70000, dest)]), 1)
+        self.assertEqual(self.root.recvfrom(100)[0], b"y")
+
+    def test_connection_table(self):
+        class Owner(object):
+            evicted = None
+            def hook(self, address):
+                self.evicted = address
+        demux = router.UDPDemux(self.root, max_connections=2)
+        default_conn = demux.get_connection(None)
+        conns = [demux.get_connection(("127.0.0.1", port))
+                 for port in (1, 2)]
+        owner = Owner()
+        demux.connections.set_owner(("127.0.0.1", 1), owner.hook)
+        # The least recently used connection is evicted and closed
+        demux.connections.get(("127.0.0.1", 2))
+        demux.get_connection(("127.0.0.1", 3))
+        self.assertEqual(owner.evicted, ("127.0.0.1", 1))
+        self.assertEqual(conns[0].fileno(), -1)
+        self.assertEqual(len(demux.connections), 3)
+        self.assertIs(demux.connections[None], default_conn)
+        # Finalizing an owner closes its connection
+        demux.connections.set_owner(("127.0.0.1", 2), Owner().hook)
+        gc.collect()
+        self.assertNotIn(("127.0.0.1", 2), demux.connections)
+        self.assertEqual(conns[1].fileno(), -1)
+        # Idle connections expire
+        demux.connections.idle_timeout = 0
+        self.assertEqual(demux.connections.expire(), 1)
+        self.assertEqual(demux.connections.items(), [(None, default_conn)])
+
+
+class MemoryDemuxTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.root.bind(("127.0.0.1", 0))
+        self.root.settimeout(1.0)
+        self.known = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.known.bind(("127.0.0.1", 0))
+        self.unknown = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.unknown.bind(("127.0.0.1", 0))
+
+    def tearDown(self):
+        for sock in self.root, self.known, self.unknown:
+            sock.close()
+
+    def test_receive(self):
+        demux = membio.UDPDemux(self.root)
+        channel = demux.get_connection(self.known.getsockname())
+        self.known.sendto(b"known0", self.root.getsockname())
+        self.unknown.sendto(b"new0", self.root.getsockname())
+        self.known.sendto(b"known1", self.root.getsockname())
+        time.sleep(0.1)
+        # Non-blocking callers leave new-peer datagrams at the root socket
+        self.assertEqual(demux.receive(0, channel), 1)
+        self.assertEqual(BIO_ctrl_pending(channel.rbio.value), 6)
+        # Waiting callers queue them for the listening connection
+        channel.reset()
+        self.assertEqual(demux.receive(1.0), 2)
+        self.assertEqual(BIO_ctrl_pending(channel.rbio.value), 6)
+        self.assertEqual(demux.service(), self.unknown.getsockname())
+        self.assertEqual(demux.payload, b"new0")
+
+    def test_handshake_echo(self):
+        force_memory_demux()
+        self.addCleanup(reset_default_demux)
+        server = SSLConnection(self.root, keyfile=CERTFILE, certfile=CERTFILE,
+                               server_side=True)
+        client = SSLConnection(self.known)
+        thread = threading.Thread(target=client.connect,
+                                  args=(self.root.getsockname(),))
+        thread.start()
+        try:
+            # The handshake crosses the listening connection's memory channel
+            # and then the accepted connection's
+            accepted = None
+            deadline = time.time() + 10
+            while not accepted and time.time() < deadline:
+                accepted = server.accept()
+            conn, peer = accepted
+            thread.join(10)
+            self.assertEqual(peer, self.known.getsockname())
+            self.assertTrue(server._mem_channel and conn._mem_channel)
+            client.write(b"echo")
+            conn.write(conn.read())
+            self.assertEqual(client.read(), b"echo")
+        finally:
+            thread.join(10)
+
+    def test_pack_records(self):
+        records = [b"\x16" + b"\0" * 10 + bytes([0, n]) + b"r" * n
+                   for n in (20, 30, 40)]
+        stream = b"".join(records)
+        self.assertEqual(_pack_records(stream, 100),
+                         [records[0] + records[1], records[2]])
+        self.assertEqual(_pack_records(stream, 10), records)
+        self.assertEqual(_pack_records(stream, 1000), [stream])
+
+
+def sharded_echo(sock):
+    while True:
+        data, addr = sock.recvfrom(100)
+        sock.sendto(str(os.getpid()).encode(), addr)
+
+
+def sharded_dtls_echo(sock, certfile):
+    listener = SSLConnection(sock, keyfile=certfile, certfile=certfile,
+                             server_side=True)
+    reply = ("%d %s" % (os.getpid(), SSLConnection._rnd_key.hex())).encode()
+    while True:
+        accepted = listener.accept()
+        if accepted:
+            conn = accepted[0]
+            conn.read()
+            conn.write(reply)
+
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "needs SO_REUSEPORT")
+class ShardedServerTests(unittest.TestCase):
+
+    def test_sharded_server(self):
+        server = ShardedServer(("127.0.0.1", 0), sharded_dtls_echo,
+                               workers=2, args=(CERTFILE,), restart_delay=0.1)
+        server.start()
+        supervisor = threading.Thread(target=server.supervise)
+        supervisor.start()
+        try:
+            pids = set(str(process.pid) for process in server.processes)
+            # Clients handshake with whichever worker the kernel picks; all
+            # workers serve the same certificate and cookie secret
+            keys = {}
+            certs = set()
+            for _ in range(64):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.settimeout(5)
+                client = SSLConnection(sock)
+                try:
+                    client.connect(server.address)
+                    client.write(b"ping")
+                    pid, key = client.read().decode().split()
+                    certs.add(client.getpeercert(True))
+                finally:
+                    client.close()
+                keys[pid] = key
+                if len(keys) == len(pids):
+                    break
+            self.assertEqual(set(keys), pids)
+            self.assertEqual(set(keys.values()), {server._cookie_key.hex()})
+            self.assertEqual(len(certs), 1)
+            first_pid = server.processes[0].pid
+            server.processes[0].terminate()
+            deadline = time.time() + 5
+            while server.processes[0].pid == first_pid or \
+              not server.processes[0].is_alive():
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.05)
+        finally:
+            server.stop()
+            supervisor.join()
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "needs Linux")
+    def test_steering(self):
+        server = ShardedServer(("127.0.0.1", 0), sharded_echo, workers=3,
+                               restart_delay=0.1, steering=True)
+        server.start()
+        supervisor = threading.Thread(target=server.supervise)
+        supervisor.start()
+        clients = []
+        try:
+            for _ in range(24):
+                client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                client.bind(("127.0.0.1", 0))
+                client.settimeout(5)
+                clients.append(client)
+
+            def workers():
+                pids = [str(process.pid) for process in server.processes]
+                indices = []
+                for client in clients:
+                    client.sendto(b"ping", server.address)
+                    indices.append(pids.index(client.recv(100).decode()))
+                return indices
+
+            table = server.steering_table
+            before = workers()
+            self.assertEqual(before, [table[peer_bucket(c.getsockname())]
+                                      for c in clients])
+            first_pid = server.processes[1].pid
+            server.processes[1].terminate()
+            deadline = time.time() + 5
+            while server.processes[1].pid == first_pid or \
+              not server.processes[1].is_alive():
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.05)
+            # No peer moves across the restart
+            self.assertEqual(workers(), before)
+            # Only peers moved to an added worker change workers
+            server.add_worker()
+            after = workers()
+            for old, new in zip(before, after):
+                self.assertIn(new, (old, 3))
+        finally:
+            for client in clients:
+                client.close()
+            server.stop()
+            supervisor.join()
+
 
 def hostname_for_protocol(protocol):
     global HOST
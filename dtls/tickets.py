@@ -0,0 +1,189 @@
+# Session tickets: rotating ticket keys shared among processes and hosts.
+
+# Copyright 2017 Ray Brown
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# The License is also distributed with this work in the file named "LICENSE."
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Session Ticket Keys
+
+With session tickets, a server does not cache sessions: it encrypts the
+session's state into a ticket that the client keeps, and that the client
+presents when it reconnects. Any server that holds the key with which the
+ticket was encrypted can resume the session. Servers behind a load balancer,
+whose clients reconnect to whichever worker process or host the balancer
+picks, must therefore share their ticket keys.
+
+This module derives ticket keys from a secret that the servers share, and
+from the current rotation period. Servers thus agree on their keys without
+communicating, and a key that leaks exposes the tickets of a single period
+only. The secret is given by the caller, or read from a file, for example one
+that is distributed to all hosts.
+
+Classes:
+
+  TicketKeyRing -- rotating ticket keys derived from a shared secret
+"""
+
+import hashlib
+import hmac
+import os
+import struct
+from logging import getLogger
+from threading import Lock
+from time import time
+from .openssl import TLSEXT_KEYNAME_LENGTH
+
+_logger = getLogger(__name__)
+
+TICKET_KEY_ROTATION = 12 * 3600  # seconds during which a key is current
+TICKET_KEY_GRACE = 24 * 3600  # seconds during which retired keys decrypt
+TICKET_SECRET_LENGTH = 48
+_MIN_SECRET_LENGTH = 32
+
+
+class TicketKeyRing(object):
+    """Rotating ticket keys derived from a shared secret
+
+    Time is divided into rotation periods, counted from the epoch. New
+    tickets are encrypted with the key of the current period. Tickets
+    encrypted with the key of a period that ended no longer than the grace
+    window ago are still accepted, and are replaced with new tickets. So that
+    hosts whose clocks disagree by less than a rotation period interoperate,
+    tickets encrypted with the key of the following period are accepted as
+    well.
+
+    A secret file is read again whenever its modification time changes.
+    Replacing the file therefore replaces the secret in all processes that
+    read it; tickets encrypted under the previous secret are then rejected,
+    and their clients perform full handshakes.
+
+    Methods:
+
+      get_key -- retrieve a ticket key for the ticket key callback
+      create_secret_file -- write a new random secret to a file
+    """
+
+    def __init__(self, secret=None, path=None, rotation=TICKET_KEY_ROTATION,
+                 grace=TICKET_KEY_GRACE, clock=time):
+        """Constructor
+
+        Arguments:
+        secret -- shared secret of at least 32 bytes
+        path -- file from which to read the shared secret instead
+        rotation -- length of rotation periods in seconds
+        grace -- seconds for which a key that is no longer current
+                 remains accepted
+        clock -- callable returning the seconds since the epoch
+        """
+
+        if (secret is None) == (path is None):
+            raise ValueError("Either secret or path must be given")
+        if rotation <= 0 or grace < 0:
+            raise ValueError("Invalid rotation period or grace window")
+        self.rotation = rotation
+        self.grace = grace
+        self._clock = clock
+        self._path = path
+        self._mtime = None
+        self._lock = Lock()
+        if secret is not None:
+            self._set_secret(secret)
+        else:
+            self._load()
+
+    @staticmethod
+    def create_secret_file(path, length=TICKET_SECRET_LENGTH):
+        """Write a new random secret to a file
+
+        The file is replaced atomically, and is readable by its owner only.
+
+        Arguments:
+        path -- the name of the file
+        length -- the secret's length in bytes
+        """
+
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            with os.fdopen(fd, "wb") as secret_file:
+                secret_file.write(os.urandom(length))
+            os.replace(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def get_key(self, key_name):
+        """Retrieve a ticket key for the ticket key callback
+
+        Arguments:
+        key_name -- the key name of the ticket to be decrypted, or None to
+                    retrieve the key for encrypting a new ticket
+
+        Return:
+        tuple of key name, HMAC key, AES key, and whether the ticket should be
+        renewed; None if the key name is not accepted
+        """
+
+        with self._lock:
+            if self._path:
+                try:
+                    self._load()
+                except (IOError, OSError, ValueError) as err:
+                    # Keep serving with the secret loaded last
+                    _logger.warning("Failed to reload ticket secret: %s", err)
+            now = self._clock()
+            current = int(now // self.rotation)
+            oldest = int((now - self.grace) // self.rotation)
+            for period in [i for i in self._periods if i < oldest]:
+                del self._names[self._periods.pop(period)[0]]
+            if key_name is None:
+                return self._derive(current) + (False,)
+            for period in range(oldest, current + 2):
+                self._derive(period)
+            period = self._names.get(key_name)
+            if period is None or period > current + 1:
+                return
+            return self._periods[period] + (period < current,)
+
+    def _set_secret(self, secret):
+        if len(secret) < _MIN_SECRET_LENGTH:
+            raise ValueError("Ticket secret must be at least %d bytes long" %
+                             _MIN_SECRET_LENGTH)
+        self._secret = bytes(secret)
+        self._periods = {}  # period -> (key name, HMAC key, AES key)
+        self._names = {}  # key name -> period
+
+    def _load(self):
+        mtime = os.stat(self._path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        with open(self._path, "rb") as secret_file:
+            self._set_secret(secret_file.read())
+        self._mtime = mtime
+        _logger.debug("Loaded ticket secret from %s", self._path)
+
+    def _derive(self, period):
+        key = self._periods.get(period)
+        if not key:
+            info = struct.pack("!Q", period)
+            key = tuple(hmac.new(self._secret, label + info,
+                                 hashlib.sha256).digest()
+                        for label in (b"PyDTLS ticket key name",
+                                      b"PyDTLS ticket HMAC key",
+                                      b"PyDTLS ticket AES key"))
+            key = (key[0][:TLSEXT_KEYNAME_LENGTH],) + key[1:]
+            self._periods[period] = key
+            self._names[key[0]] = period
+        return key
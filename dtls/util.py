@@ -26,6 +26,9 @@ from logging import getLogger
 
 _logger = getLogger(__name__)
 
+DTLS_RECORD_HEADER_LEN = 13
+DTLS_APPLICATION_DATA = 23
+
 
 class _Rsrc(object):
     """Wrapper base for library-owned resources"""
@@ -71,3 +74,42 @@ class _EC_KEY(_Rsrc):
         from .openssl import EC_KEY_free
         EC_KEY_free(self._value)
         self._value = None
+
+
+def _pack_records(data, mtu):
+    """Pack a stream of DTLS records into datagrams
+
+    OpenSSL emits DTLS records back to back when writing to a memory BIO. This
+    function splits such a byte stream at record boundaries, as given by the
+    length field of each record header, and packs consecutive records into
+    datagrams whose length does not exceed mtu. A single record that is
+    longer than mtu is placed into a datagram of its own.
+
+    Return:
+    a list of datagram payloads
+    """
+
+    datagrams = []
+    start = pos = 0
+    end = len(data)
+    while pos + DTLS_RECORD_HEADER_LEN <= end:
+        record_end = pos + DTLS_RECORD_HEADER_LEN + \
+          (data[pos + 11] << 8 | data[pos + 12])
+        if record_end - start > mtu and pos > start:
+            datagrams.append(data[start:pos])
+            start = pos
+        pos = record_end
+    if start < end:
+        datagrams.append(data[start:end])
+    return datagrams
+
+
+def _count_records(data, content_type=DTLS_APPLICATION_DATA):
+    """Count the DTLS records of the given content type in a datagram"""
+
+    count = pos = 0
+    while pos + DTLS_RECORD_HEADER_LEN <= len(data):
+        if data[pos] == content_type:
+            count += 1
+        pos += DTLS_RECORD_HEADER_LEN + (data[pos + 11] << 8 | data[pos + 12])
+    return count
@@ -49,14 +49,17 @@ def wrap_client(sock, keyfile=None, certfile=None,
                 do_handshake_on_connect=True, suppress_ragged_eofs=True,
                 ciphers=None, curves=None, sigalgs=None, user_mtu=None,
                 client_cert_options=ssl.SSL_BUILD_CHAIN_FLAG_NONE,
-                ssl_logging=False, handshake_timeout=None):
+                ssl_logging=False, handshake_timeout=None,
+                server_hostname=None, session_cache=None, share_ctx=False):
 
     return DtlsSocket(sock=sock, keyfile=keyfile, certfile=certfile, server_side=False,
                       cert_reqs=cert_reqs, ssl_version=ssl_version, ca_certs=ca_certs,
                       do_handshake_on_connect=do_handshake_on_connect, suppress_ragged_eofs=suppress_ragged_eofs,
                       ciphers=ciphers, curves=curves, sigalgs=sigalgs, user_mtu=user_mtu,
                       server_key_exchange_curve=None, server_cert_options=client_cert_options,
-                      ssl_logging=ssl_logging, handshake_timeout=handshake_timeout)
+                      ssl_logging=ssl_logging, handshake_timeout=handshake_timeout,
+                      server_hostname=server_hostname, session_cache=session_cache,
+                      share_ctx=share_ctx)
 
 
 def wrap_server(sock, keyfile=None, certfile=None,
@@ -125,6 +128,9 @@ class DtlsSocket(object):
             cb_ignore_ssl_exception_in_handshake=None,
             cb_ignore_ssl_exception_read=None,
             cb_ignore_ssl_exception_write=None,
+            server_hostname=None,
+            session_cache=None,
+            share_ctx=False,
     ):
 
         if server_cert_options is None:
@@ -144,6 +150,13 @@ class DtlsSocket(object):
         self._cb_ignore_ssl_exception_read = cb_ignore_ssl_exception_read
         self._cb_ignore_ssl_exception_write = cb_ignore_ssl_exception_write
 
+        # Clients with the same configuration share a library context;
+        # user_config_ssl_ctx applies the settings that the key lists
+        ctx_cache_key = None
+        if share_ctx and not self._server_side:
+            ctx_cache_key = (type(self), self._ssl_logging, self._curves,
+                             self._sigalgs, self._server_cert_options)
+
         # Default socket creation
         if isinstance(sock, socket.socket):
             _sock = sock
@@ -161,7 +174,10 @@ class DtlsSocket(object):
                                      suppress_ragged_eofs=suppress_ragged_eofs,
                                      ciphers=self._ciphers,
                                      cb_user_config_ssl_ctx=self.user_config_ssl_ctx,
-                                     cb_user_config_ssl=self.user_config_ssl)
+                                     cb_user_config_ssl=self.user_config_ssl,
+                                     server_hostname=server_hostname,
+                                     session_cache=session_cache,
+                                     ctx_cache_key=ctx_cache_key)
 
         if self._server_side:
             self._clients = {}
@@ -200,7 +216,9 @@ class DtlsSocket(object):
 
         :param SSL _ssl:
         """
-        if self._user_mtu:
+        if self._user_mtu == "auto":
+            _ssl.set_auto_mtu()
+        elif self._user_mtu:
             _ssl.set_link_mtu(self._user_mtu)
 
         _ssl.DTLS_set_timer_cb(self._dtls_timer_cb)
@@ -231,7 +249,53 @@ class DtlsSocket(object):
         else:
             return self._recvfrom_on_client_side(bufsize, flags=flags)
 
-    def _recvfrom_on_server_side(self, bufsize, flags):
+    def recvfrom_into(self, buffer, nbytes=0, flags=0):
+        """Receive a record into a caller-supplied buffer
+
+        Reusing the buffer, or leasing buffers from a BufferPool, avoids
+        allocating for each received record.
+
+        Arguments:
+        buffer -- a writable buffer, such as a bytearray
+        nbytes -- the maximum number of bytes to receive; 0 for the
+                  buffer's length
+        flags -- as with recvfrom
+
+        Return:
+        a (number of bytes received, peer address) tuple
+        """
+
+        nbytes = nbytes or len(buffer)
+        if self._server_side:
+            return self._recvfrom_on_server_side(nbytes, flags=flags,
+                                                 buffer=buffer)
+        else:
+            return self._recvfrom_on_client_side(nbytes, flags=flags,
+                                                 buffer=buffer)
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        return self.recvfrom_into(buffer, nbytes, flags)[0]
+
+    def recvfrom_many(self, max_records=None, max_bytes=None):
+        """Receive the records buffered on a readable connection
+
+        Arguments:
+        max_records -- maximum number of records to receive; None for no limit
+        max_bytes -- maximum total number of bytes to receive; None for no
+                     limit
+
+        Return:
+        a (list of records, peer address) tuple
+        """
+
+        many = max_records, max_bytes
+        if self._server_side:
+            return self._recvfrom_on_server_side(None, 0, many=many)
+        else:
+            return self._recvfrom_on_client_side(None, 0, many=many)
+
+    def _recvfrom_on_server_side(self, bufsize, flags, buffer=None,
+                                 many=None):
         while True:
             want_read = False
             try:
@@ -269,7 +333,8 @@ class DtlsSocket(object):
                                 self._clientDoHandshake(conn)
                             # Normal read
                             else:
-                                buf = self._clientRead(conn, bufsize)
+                                buf = self._clientRead(conn, bufsize, buffer,
+                                                       many)
                                 if buf:
                                     self._clients[conn].updateTimestamp()
                                     if conn in self._clients:
@@ -310,9 +375,15 @@ class DtlsSocket(object):
         # __No_data__ received from any client
         raise socket.timeout
 
-    def _recvfrom_on_client_side(self, bufsize, flags):
+    def _recvfrom_on_client_side(self, bufsize, flags, buffer=None,
+                                 many=None):
         try:
-            buf = self._sock.recv(bufsize, flags)
+            if many:
+                buf = self._sock.read_many(*many)
+            elif buffer is None:
+                buf = self._sock.recv(bufsize, flags)
+            else:
+                buf = self._sock.recv_into(buffer, bufsize, flags)
 
         except ssl.SSLError as e:
             if e.errno == ssl.ERR_READ_TIMEOUT or e.args[0] == ssl.SSL_ERROR_WANT_READ:
@@ -420,13 +491,20 @@ class DtlsSocket(object):
                     return
                 raise e
 
-    def _clientRead(self, conn, bufsize=4096):
+    def _clientRead(self, conn, bufsize=4096, buffer=None, many=None):
         _logger.debug('*' * 60)
         ret = None
 
         try:
-            ret = conn.recv(bufsize)
-            _logger.info('From client %s ... bytes received %s' % (str(self._clients[conn].getAddr()), str(len(ret))))
+            if many:
+                ret = conn.read_many(*many)
+                nbytes = sum(len(payload) for payload in ret)
+            elif buffer is None:
+                ret = conn.recv(bufsize)
+                nbytes = len(ret)
+            else:
+                ret = nbytes = conn.recv_into(buffer, bufsize)
+            _logger.info('From client %s ... bytes received %s' % (str(self._clients[conn].getAddr()), str(nbytes)))
 
         except ssl.SSLError as e:
             if e.args[0] == ssl.SSL_ERROR_WANT_READ: